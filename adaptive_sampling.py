@@ -0,0 +1,227 @@
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+import numpy as np
+import scipy.sparse as sparse
+from bundle_projection import bundle_targets, stage_spec as bundle_stage_spec
+from instrumentation import append_metrics, run_logged
+from pipeline_state import is_up_to_date, record_stage
+from post_probtrack import NORMALIZATION, matrix_shape, normalize_fingerprint, read_coomat_csr, read_waytotal
+import run_probtrack
+
+"""
+Runs ProbtrackX2 with a sample count adapted to each subject.
+
+With a fixed `-P 5000`, every seed gets 5000 streamlines even when its fingerprint has
+stopped changing long before. Here, with PROBTRACK_ROUND_SAMPLES set in run_probtrack,
+tractography runs in rounds of that many samples per seed, each with its own random
+seed. The round matrices are summed, and after each round the 72-dimensional fingerprint
+of the running sum is compared with the previous round's:
+
+    frobenius     ||F_k - F_k-1|| / ||F_k||, on fingerprints scaled per sample
+    correlation   1 - the mean Pearson correlation of the seeds' fingerprints
+
+Sampling stops once the change falls below CONVERGENCE_THRESHOLD, or when the -P of
+PROBTRACK_OPTIONS is reached. The summed matrix is saved as the fdt_matrix2.npz that
+post_probtrack would convert a fixed run's fdt_matrix2.dot to, with the seed and target
+coordinates and the summed waytotal, so it is never written and parsed again as text.
+The samples used, the rounds and the change after each round are saved to samples.json
+in the output directory and appended to the probtrack metrics log.
+
+Rounds run unsharded and need the subject's bundle projection (bundle_targets), so the
+cohort scheduler runs that stage first in adaptive mode.
+"""
+
+# Define the root data directory
+DATA_DIRECTORY = "/home/test/lmq/data/HCP"
+
+CONVERGENCE_METRICS = ('frobenius', 'correlation')
+
+# Files of a round's output kept for the summed matrix
+COORDS_FILES = ("coords_for_fdt_matrix2", "tract_space_coords_for_fdt_matrix2")
+
+
+def max_samples(options=run_probtrack.PROBTRACK_OPTIONS):
+    """
+    Reads the number of samples per seed (-P) from the probtrackx options.
+    Args:
+        options (str): Sampling options.
+    Returns:
+        int: Samples per seed of a fixed run.
+    """
+    match = re.search(r"-P\s+(\d+)", options)
+    if not match:
+        raise ValueError(f"No -P sample count in the probtrackx options: {options}")
+    return int(match.group(1))
+
+
+def round_options(samples, round_index, options=run_probtrack.PROBTRACK_OPTIONS):
+    """
+    Returns the probtrackx options of one round: its sample count and random seed.
+    Args:
+        samples (int): Samples per seed in the round.
+        round_index (int): Round number, used as the random seed.
+        options (str): Sampling options of a fixed run.
+    Returns:
+        str: Options of the round.
+    """
+    return re.sub(r"-P\s+\d+", f"-P {samples}", options) + f" --rseed={round_index + 1}"
+
+
+def round_fingerprint(mat, bundles, roi_size, samples, waytotal=None, normalization=NORMALIZATION):
+    """
+    Computes the fingerprint of an accumulated matrix, scaled to one sample per seed so
+    that fingerprints after different numbers of samples are comparable.
+    Args:
+        mat (scipy.sparse.csr_matrix): Summed seed x target counts.
+        bundles (scipy.sparse.csr_matrix): Target x bundle matrix.
+        roi_size (np.ndarray): Bundle sizes.
+        samples (int): Samples per seed summed in `mat`.
+        waytotal (float): Summed waytotal, for the waytotal normalization.
+        normalization (str): One of post_probtrack.NORMALIZATION_MODES.
+    Returns:
+        np.ndarray: Dense (seeds, bundles) fingerprint.
+    """
+    fp = mat.dot(bundles) / samples
+    if waytotal is not None:
+        waytotal = waytotal / samples
+    return normalize_fingerprint(fp, roi_size, normalization, waytotal).toarray()
+
+
+def fingerprint_change(previous, current, metric=run_probtrack.CONVERGENCE_METRIC):
+    """
+    Measures how much the fingerprint changed between two rounds.
+    Args:
+        previous (np.ndarray): Fingerprint after the previous round.
+        current (np.ndarray): Fingerprint after this round.
+        metric (str): 'frobenius' or 'correlation'.
+    Returns:
+        float: Change, 0 when the fingerprints are identical.
+    """
+    if metric not in CONVERGENCE_METRICS:
+        raise ValueError(f"Unknown convergence metric {metric!r}; expected one of {CONVERGENCE_METRICS}.")
+    if metric == 'frobenius':
+        norm = np.linalg.norm(current)
+        return float(np.linalg.norm(current - previous) / norm) if norm else 0.0
+    # Seeds whose fingerprint is constant in either round have no defined correlation
+    a = previous - previous.mean(axis=1, keepdims=True)
+    b = current - current.mean(axis=1, keepdims=True)
+    denominator = np.sqrt((a * a).sum(axis=1) * (b * b).sum(axis=1))
+    valid = denominator > 0
+    if not valid.any():
+        return 0.0
+    correlation = (a[valid] * b[valid]).sum(axis=1) / denominator[valid]
+    return float(1.0 - correlation.mean())
+
+
+def run_adaptive(subject_dir, data_directory, hemisphere, gpu=0):
+    """
+    Runs ProbtrackX2 in rounds for a given subject and hemisphere until the fingerprint
+    converges, and saves the summed matrix where post_probtrack reads its converted matrices.
+    Args:
+        subject_dir (str): The subject's directory name.
+        data_directory (str): The root directory containing all subject data.
+        hemisphere (str): Hemisphere to process ('left' or 'right').
+        gpu (int): CUDA device to run on.
+    Returns:
+        bool: True if the connectivity matrix is up to date, either already or after this run.
+    """
+    subject_path = os.path.join(data_directory, subject_dir)
+    output_dir = Path(subject_path) / f"probtrackx_{hemisphere[0].upper()}_omatrix2"
+    spec = run_probtrack.stage_spec(subject_path, hemisphere)
+    if is_up_to_date(subject_path, spec):
+        print(f"ProbtrackX2 already processed for subject: {subject_dir}, hemisphere: {hemisphere}")
+        return True
+    # The bundle projection is computed below when missing, so its own inputs are checked instead
+    projection = bundle_stage_spec(subject_path)
+    missing = [file for file in run_probtrack.missing_inputs(spec) if file not in projection.outputs]
+    missing += [file for file in projection.inputs if not os.path.exists(file)]
+    if missing:
+        print(f"Missing required file for subject {subject_dir}, hemisphere {hemisphere}: {missing[0]}")
+        return False
+
+    print(f"Running adaptive ProbtrackX2 for subject: {subject_dir}, hemisphere: {hemisphere}")
+    seed_mask = run_probtrack.prepare_seed_mask(subject_path, hemisphere, str(output_dir))
+    bundles, roi_size = bundle_targets(subject_path)
+    use_waytotal = NORMALIZATION == 'waytotal'
+    budget = max_samples()
+    total, previous, waytotal = None, None, 0.0
+    samples, changes, converged = 0, [], False
+    round_index = 0
+    while samples < budget and not converged:
+        round_samples = min(run_probtrack.PROBTRACK_ROUND_SAMPLES, budget - samples)
+        round_dir = output_dir / f"round_{round_index:03d}"
+        command = (f"export CUDA_VISIBLE_DEVICES={gpu}; " + run_probtrack.probtrackx_command(
+            subject_path, hemisphere, seed_mask, str(round_dir), round_options(round_samples, round_index)))
+        returncode = run_logged(command, subject_path, spec.name, step=f"round{round_index:03d}")
+        if returncode != 0:
+            print(f"Error running command: {command}\nExit status: {returncode}")
+            return False
+
+        mat = read_coomat_csr(round_dir / "fdt_matrix2.dot", matrix_shape(round_dir))
+        total = mat if total is None else total + mat
+        waytotal += read_waytotal(round_dir / "waytotal")
+        samples += round_samples
+        current = round_fingerprint(total, bundles, roi_size, samples, waytotal if use_waytotal else None)
+        if previous is not None:
+            changes.append(fingerprint_change(previous, current))
+            converged = changes[-1] < run_probtrack.CONVERGENCE_THRESHOLD
+            print(f"Round {round_index}: {samples} samples, {run_probtrack.CONVERGENCE_METRIC} change {changes[-1]:.4g}")
+        previous = current
+        round_index += 1
+
+    # Hand the summed matrix to post_probtrack as the converted output of a fixed run
+    for name in COORDS_FILES:
+        shutil.copyfile(output_dir / "round_000" / name, output_dir / name)
+    with open(output_dir / "waytotal", "w") as f:
+        f.write(f"{waytotal:.17g}\n")
+    # A .dot left by an earlier fixed run would be converted over the summed matrix
+    if (output_dir / "fdt_matrix2.dot").exists():
+        os.remove(output_dir / "fdt_matrix2.dot")
+    tmp_file = output_dir / f"fdt_matrix2.{os.getpid()}.tmp.npz"
+    sparse.save_npz(tmp_file, total)
+    os.replace(tmp_file, spec.outputs[0])
+    for index in range(round_index):
+        shutil.rmtree(output_dir / f"round_{index:03d}")
+
+    record = {"samples": samples, "max_samples": budget, "rounds": round_index, "converged": converged,
+              "metric": run_probtrack.CONVERGENCE_METRIC, "changes": changes}
+    with open(output_dir / "samples.json", "w") as f:
+        json.dump(record, f, indent=2)
+    append_metrics(subject_path, spec.name, dict(record, step="adaptive_sampling"))
+    print(f"Used {samples} of {budget} samples per seed for subject: {subject_dir}, hemisphere: {hemisphere}")
+    return record_stage(subject_path, spec)
+
+
+def run_tractography(subject_dir, data_directory, hemisphere, gpu=0):
+    """
+    Runs ProbtrackX2 adaptively when PROBTRACK_ROUND_SAMPLES is set, and with the fixed
+    sample count otherwise.
+    Args:
+        subject_dir (str): The subject's directory name.
+        data_directory (str): The root directory containing all subject data.
+        hemisphere (str): Hemisphere to process ('left' or 'right').
+        gpu (int): CUDA device to run on.
+    Returns:
+        bool: True if the connectivity matrix is up to date.
+    """
+    if run_probtrack.PROBTRACK_ROUND_SAMPLES > 0:
+        return run_adaptive(subject_dir, data_directory, hemisphere, gpu)
+    return run_probtrack.run_probtrack(subject_dir, data_directory, hemisphere, gpu)
+
+
+def main():
+    """
+    Main function to process all subjects with adaptive ProbtrackX2.
+    """
+    for subject_dir in os.listdir(DATA_DIRECTORY):
+        subject_path = os.path.join(DATA_DIRECTORY, subject_dir)
+        if os.path.isdir(subject_path):
+            for hemisphere in ["left", "right"]:
+                run_tractography(subject_dir, DATA_DIRECTORY, hemisphere)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import adaptive_sampling
+import bundle_projection
+import post_probtrack
+import run_probtrack
+
+"""
+Runs ProbtrackX2 and the post-processing of its output as one overlapping pipeline.
+
+Running run_probtrack.py and post_probtrack.py as separate passes leaves the CPUs idle
+while the GPUs track and the GPUs idle while the CPUs parse. Here, one asyncio task per
+GPU slot runs the tractography jobs one after the other, and as soon as a job's
+fdt_matrix2.dot is complete its (subject, hemisphere) is put on a bounded queue.
+A set of CPU tasks takes items off that queue and runs PostProbtrack and
+get_fiber_fingerprint (post_probtrack.process_hemisphere) in a process pool, while the
+GPUs go on with the next jobs. The bundle projection both hemispheres need is built
+once per subject, in the process pool while the subject's first job tracks, and a
+hemisphere is queued only once it is ready. Adaptive sampling needs it before tracking.
+
+The queue is bounded: when post-processing falls behind, the GPU tasks wait before
+starting another job, so unconverted .dot files (several GB each) do not pile up on disk.
+
+The upstream stages (bedpostX, seeds, masks, TractSeg) are expected to be done; use
+cohort_scheduler.py to run everything. For a run without FSL or a GPU, set
+PROBTRACKX_COMMAND="python benchmarks/stub_probtrackx.py", which writes synthetic .dot files.
+"""
+
+# Define the root data directory
+DATA_DIRECTORY = "/home/test/lmq/data/HCP"
+
+HEMISPHERES = {"left": "L", "right": "R"}
+
+
+def subject_projection(projections, subject_path, cpu_pool):
+    """
+    Starts computing a subject's bundle projection in the process pool, once per subject.
+    Args:
+        projections (dict): Subject path -> future of bundle_projection.process_subject.
+        subject_path (str): Path to the subject's folder.
+        cpu_pool (ProcessPoolExecutor): Processes running the post-processing.
+    Returns:
+        asyncio.Future: True once the projection is up to date.
+    """
+    if subject_path not in projections:
+        projections[subject_path] = asyncio.get_running_loop().run_in_executor(
+            cpu_pool, bundle_projection.process_subject, subject_path)
+    return projections[subject_path]
+
+
+async def wait_projection(projection, subject_path):
+    """
+    Waits for a subject's bundle projection.
+    Args:
+        projection (asyncio.Future): Future returned by subject_projection.
+        subject_path (str): Path to the subject's folder.
+    Returns:
+        bool: True if it is up to date.
+    """
+    try:
+        return await projection
+    except Exception as e:
+        print(f"Bundle projection failed for {subject_path}: {e}")
+        return False
+
+
+async def tractography_worker(gpu, jobs, ready, data_directory, gpu_pool, cpu_pool, projections, stats):
+    """
+    Runs tractography jobs on one GPU slot and queues their outputs for post-processing.
+    Args:
+        gpu (int): CUDA device of the slot.
+        jobs (asyncio.Queue): (subject_dir, hemisphere) jobs still to track.
+        ready (asyncio.Queue): Bounded queue of (subject_path, hemisphere) outputs to post-process.
+        data_directory (str): The root directory containing all subject data.
+        gpu_pool (ThreadPoolExecutor): Threads waiting on the tractography processes.
+        cpu_pool (ProcessPoolExecutor): Processes computing the bundle projections.
+        projections (dict): Bundle projections started so far, see subject_projection.
+        stats (dict): Run statistics, updated in place.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            subject_dir, hemisphere = jobs.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        subject_path = os.path.join(data_directory, subject_dir)
+        projection = subject_projection(projections, subject_path, cpu_pool)
+        start = time.perf_counter()
+        # Adaptive sampling compares the fingerprints of successive rounds
+        if run_probtrack.PROBTRACK_ROUND_SAMPLES > 0 and not await wait_projection(projection, subject_path):
+            tracked = False
+        else:
+            try:
+                tracked = await loop.run_in_executor(gpu_pool, adaptive_sampling.run_tractography,
+                                                     subject_dir, data_directory, hemisphere, gpu)
+            except Exception as e:
+                print(f"ProbtrackX2 failed for subject {subject_dir}, hemisphere {hemisphere}: {e}")
+                tracked = False
+        stats["gpu_seconds"] += time.perf_counter() - start
+        if tracked and await wait_projection(projection, subject_path):
+            # Blocks while the queue is full, holding the GPU slot back
+            await ready.put((subject_path, HEMISPHERES[hemisphere]))
+        else:
+            stats["failed"] += 1
+
+
+async def post_processing_worker(ready, cpu_pool, stats):
+    """
+    Post-processes tractography outputs as they become ready, until it receives None.
+    Args:
+        ready (asyncio.Queue): Queue of (subject_path, hemisphere) outputs to post-process.
+        cpu_pool (ProcessPoolExecutor): Processes running the post-processing.
+        stats (dict): Run statistics, updated in place.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await ready.get()
+        try:
+            if item is None:
+                return
+            subject_path, hemisphere = item
+            try:
+                # False when an input is missing or the stage could not be recorded
+                if await loop.run_in_executor(cpu_pool, post_probtrack.process_hemisphere, subject_path, hemisphere):
+                    stats["post_processed"] += 1
+                else:
+                    stats["failed"] += 1
+            except Exception as e:
+                print(f"Post-processing failed for {subject_path}, hemisphere {hemisphere}: {e}")
+                stats["failed"] += 1
+        finally:
+            ready.task_done()
+
+
+async def run_pipeline(data_directory, gpus, cpu_workers, queue_size=None):
+    """
+    Tracks every subject and hemisphere on the GPU slots while post-processing finished
+    outputs on the CPUs.
+    Args:
+        data_directory (str): The root directory containing all subject data.
+        gpus (list): CUDA device ids, one GPU slot each.
+        cpu_workers (int): Number of post-processing processes.
+        queue_size (int): Maximum number of tracked outputs waiting for post-processing;
+            defaults to the number of CPU workers.
+    Returns:
+        dict: Counts of post-processed and failed jobs, elapsed and GPU-busy seconds.
+    """
+    subjects = sorted(d for d in os.listdir(data_directory) if os.path.isdir(os.path.join(data_directory, d)))
+    jobs = asyncio.Queue()
+    for subject_dir in subjects:
+        for hemisphere in HEMISPHERES:
+            jobs.put_nowait((subject_dir, hemisphere))
+    ready = asyncio.Queue(maxsize=queue_size or cpu_workers)
+    stats = {"post_processed": 0, "failed": 0, "gpu_seconds": 0.0}
+    projections = {}
+
+    start = time.perf_counter()
+    # Workers come from a fork server: forking from this process while a GPU thread is in
+    # Popen would hand the worker Popen's exec-status pipe and stall that thread
+    cpu_context = multiprocessing.get_context("forkserver")
+    with ThreadPoolExecutor(max_workers=len(gpus)) as gpu_pool, \
+            ProcessPoolExecutor(max_workers=cpu_workers, mp_context=cpu_context) as cpu_pool:
+        post_tasks = [asyncio.create_task(post_processing_worker(ready, cpu_pool, stats)) for _ in range(cpu_workers)]
+        await asyncio.gather(*(tractography_worker(gpu, jobs, ready, data_directory, gpu_pool, cpu_pool, projections, stats)
+                               for gpu in gpus))
+        for _ in post_tasks:
+            await ready.put(None)
+        await asyncio.gather(*post_tasks)
+
+    stats["seconds"] = time.perf_counter() - start
+    print(f"Post-processed {stats['post_processed']} hemisphere(s), {stats['failed']} failed, in "
+          f"{stats['seconds']:.1f}s (GPU slots busy {stats['gpu_seconds'] / max(stats['seconds'] * len(gpus), 1e-9):.0%})")
+    return stats
+
+
+def main():
+    """
+    Main function to run tractography and post-processing over all subjects.
+    """
+    parser = argparse.ArgumentParser(description="Overlap ProbtrackX2 on the GPUs with post-processing on the CPUs.")
+    parser.add_argument("--data-directory", default=DATA_DIRECTORY)
+    parser.add_argument("--gpus", default="0", help="Comma-separated CUDA device ids, one GPU slot each.")
+    parser.add_argument("--cpu-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="Tracked outputs allowed to wait for post-processing (default: --cpu-workers).")
+    args = parser.parse_args()
+    asyncio.run(run_pipeline(args.data_directory, [int(gpu) for gpu in args.gpus.split(",")],
+                             args.cpu_workers, args.queue_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import scipy.sparse as sparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sparse_store import load_csr, save_csr
+
+"""
+Compares load time and peak RSS of fdt_matrix2 stored with sparse.save_npz and in the
+memory-mappable sparse_store layout, for a full load, a slice of seed rows and the
+fingerprint product with a 72-column fiber matrix. Each measurement runs in a fresh
+process so that peak RSS is not shared between them.
+
+Usage: python benchmarks/bench_sparse_store.py [n_seeds] [n_targets] [nnz_per_seed]
+"""
+
+
+def measure(fmt, path, task):
+    """
+    Runs one load task in this process and returns its wall time and peak RSS.
+    """
+    fiber = sparse.random(int(sys.argv[5]), 72, density=0.1, format='csr', random_state=0)
+    start = time.perf_counter()
+    if fmt == 'npz':
+        mat = sparse.load_npz(path)
+    else:
+        mat = load_csr(path)
+    if task == 'rows':
+        part = mat[:1000] if fmt == 'npz' else mat.rows(0, 1000)
+        part.sum()
+    elif task == 'product':
+        mat.dot(fiber)
+    seconds = time.perf_counter() - start
+    return {'format': fmt, 'task': task, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in MB. VmHWM is used where
+    available because ru_maxrss carries over the parent's peak across fork and exec.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        print(json.dumps(measure(sys.argv[2], sys.argv[3], sys.argv[4])))
+        return
+
+    n_seeds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    n_targets = int(sys.argv[2]) if len(sys.argv) > 2 else 60000
+    nnz_per_seed = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    rng = np.random.default_rng(0)
+    indptr = np.arange(n_seeds + 1, dtype=np.int64) * nnz_per_seed
+    indices = np.sort(rng.integers(0, n_targets, (n_seeds, nnz_per_seed)), axis=1).astype(np.int32).ravel()
+    data = rng.integers(1, 500, indices.size).astype(np.float32)
+    mat = sparse.csr_matrix((data, indices, indptr), shape=(n_seeds, n_targets))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {'npz': os.path.join(tmp_dir, 'fdt_matrix2.npz'), 'csr': os.path.join(tmp_dir, 'fdt_matrix2_csr')}
+        sparse.save_npz(paths['npz'], mat)
+        save_csr(paths['csr'], mat)
+        del mat
+        for task in ('load', 'rows', 'product'):
+            for fmt, path in paths.items():
+                output = subprocess.run([sys.executable, __file__, '--child', fmt, path, task, str(n_targets)],
+                                        check=True, capture_output=True, text=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{task:<8} {fmt:<4} {result['seconds']:7.3f} s  peak RSS {result['peak_rss_mb']:8.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_sparse_store import peak_rss_mb
+from split_dwi import part_path, part_sizes, read_part, split_parts
+
+"""
+Compares the two ways of splitting diffusion data into xfibres_gpu parts on a synthetic
+int16 DWI volume: the split_parts_gpu path (gunzip data.nii.gz to data.nii, load the
+whole 4D volume, write the parts) and the streaming split of split_dwi. Each runs in a
+fresh process; the wall time, peak RSS and bytes written to disk are reported, and the
+parts of both are checked to be identical.
+
+Usage: python benchmarks/bench_split_dwi.py [x] [y] [z] [volumes] [njobs]
+"""
+
+
+def split_legacy(data_path, mask_path, njobs, out_dir):
+    """
+    Splits the data as bedpostx_gpu_local.sh and split_parts_gpu do.
+    """
+    uncompressed = os.path.join(out_dir, "data.nii")
+    with gzip.open(data_path, "rb") as src, open(uncompressed, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    data = nib.load(uncompressed).get_fdata()
+    mask = np.asanyarray(nib.load(mask_path).dataobj) != 0
+    voxels = data.reshape(-1, data.shape[3], order="F")[np.flatnonzero(mask.ravel(order="F"))]
+    written = os.path.getsize(uncompressed)
+    start = 0
+    for part, size in enumerate(part_sizes(voxels.shape[0], njobs)):
+        with open(part_path(out_dir, part), "wb") as f:
+            f.write(np.ascontiguousarray(voxels[start:start + size].T).tobytes())
+        written += os.path.getsize(part_path(out_dir, part))
+        start += size
+    return {"nvox": int(voxels.shape[0]), "nmeas": int(data.shape[3]), "written_bytes": written}
+
+
+def measure(method, data_path, mask_path, njobs, out_dir):
+    """
+    Runs one split in this process and returns its wall time, peak RSS and disk footprint.
+    """
+    start = time.perf_counter()
+    if method == "fsl":
+        result = split_legacy(data_path, mask_path, njobs, out_dir)
+    else:
+        result = split_parts(data_path, mask_path, njobs, out_dir)
+    return {"method": method, "seconds": time.perf_counter() - start, "peak_rss_mb": peak_rss_mb(),
+            "written_bytes": result["written_bytes"], "nvox": result["nvox"], "nmeas": result["nmeas"]}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        print(json.dumps(measure(sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]), sys.argv[6])))
+        return
+
+    shape = tuple(int(value) for value in sys.argv[1:4]) if len(sys.argv) > 3 else (96, 96, 64)
+    n_volumes = int(sys.argv[4]) if len(sys.argv) > 4 else 90
+    njobs = int(sys.argv[5]) if len(sys.argv) > 5 else 4
+    rng = np.random.default_rng(0)
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij"))
+    mask = ((grid ** 2).sum(axis=0) < 0.8).astype(np.uint8)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, "data.nii.gz")
+        mask_path = os.path.join(tmp_dir, "nodif_brain_mask.nii.gz")
+        nib.save(nib.Nifti1Image(mask, np.eye(4)), mask_path)
+        data = np.empty(shape + (n_volumes,), dtype=np.int16)
+        for volume in range(n_volumes):
+            data[..., volume] = rng.integers(0, 3000, shape) * mask
+        nib.save(nib.Nifti1Image(data, np.eye(4)), data_path)
+        del data
+        print(f"Synthetic DWI {shape + (n_volumes,)}, {int(mask.sum())} brain voxels, "
+              f"data.nii.gz {os.path.getsize(data_path) / 1e6:.0f} MB, {njobs} parts")
+
+        results = {}
+        for method in ("fsl", "stream"):
+            out_dir = os.path.join(tmp_dir, method)
+            os.makedirs(out_dir)
+            output = subprocess.run([sys.executable, __file__, '--child', method, data_path, mask_path,
+                                     str(njobs), out_dir], check=True, capture_output=True, text=True).stdout
+            results[method] = json.loads(output.strip().splitlines()[-1])
+            result = results[method]
+            print(f"{method:<7} {result['seconds']:7.2f} s  peak RSS {result['peak_rss_mb']:8.1f} MB  "
+                  f"written {result['written_bytes'] / 1e6:8.1f} MB")
+
+        nmeas = results["stream"]["nmeas"]
+        for part in range(njobs):
+            legacy = read_part(part_path(os.path.join(tmp_dir, "fsl"), part), nmeas)
+            stream = read_part(part_path(os.path.join(tmp_dir, "stream"), part), nmeas)
+            if not np.array_equal(legacy, stream):
+                raise AssertionError(f"Part {part} differs between the two splits.")
+        print("Parts identical")
+
+
+if __name__ == "__main__":
+    main()
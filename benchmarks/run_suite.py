@@ -0,0 +1,185 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import scipy
+import scipy.sparse as sparse
+from pathlib import Path
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import bundle_projection
+import generate_seeds
+import post_probtrack
+from bench_sparse_store import peak_rss_mb
+from synthetic import generate_subject
+
+"""
+Times the post-processing hot paths on a synthetic subject (see synthetic.py) and saves
+the results as JSON, so that performance can be compared between commits.
+
+Every case runs in a fresh process. Its untimed setup runs first, then the timed call;
+the wall time, CPU time, peak RSS of the whole process and the peak RSS reached before
+the timed call are recorded. With --repeat, the fastest run and the largest peak RSS
+are kept.
+
+Usage:
+    python benchmarks/run_suite.py [--seeds N] [--targets N] [--nnz-per-seed N] [--repeat N]
+                                   [--output results.json] [--compare baseline.json]
+"""
+
+CASES = ('read_coomat', 'compress_sparse', 'fiber2target', 'project_bundles_nearest', 'project_bundles_partial',
+         'normalize_fingerprint', 'get_fiber_fingerprint', 'generate_label_masks', 'resample_to_3mm')
+
+
+def setup_case(case, subject_path, scratch):
+    """
+    Performs the untimed preparation of a case and returns the call to time.
+    """
+    dti = os.path.join(subject_path, 'DTI')
+    mask, fibers = os.path.join(dti, 'LowResMask.nii.gz'), os.path.join(dti, 'LowRes_Fibers.nii.gz')
+    dot = os.path.join(subject_path, 'probtrackx_R_omatrix2', 'fdt_matrix2.dot')
+    wmparc = os.path.join(subject_path, 'T1', 'wmparc.nii.gz')
+
+    if case == 'read_coomat':
+        return lambda: post_probtrack.read_coomat(dot)
+    if case == 'compress_sparse':
+        # compress_sparse deletes the .dot file it converts, so work on a copy
+        copy = os.path.join(scratch, 'fdt_matrix2.dot')
+        shutil.copyfile(dot, copy)
+        return lambda: post_probtrack.compress_sparse(Path(copy), overwrite=True)
+    if case == 'fiber2target':
+        return lambda: post_probtrack.fiber2target(mask, fibers)
+    if case.startswith('project_bundles_'):
+        bundles = os.path.join(subject_path, 'tractseg_output', 'bundle_segmentations.nii.gz')
+        return lambda: bundle_projection.project_bundles(bundles, mask, case[len('project_bundles_'):])
+    if case == 'normalize_fingerprint':
+        mat, roi_size = post_probtrack.fiber2target(mask, fibers)
+        fp = sparse.load_npz(os.path.join(subject_path, 'probtrackx_R_omatrix2', 'fdt_matrix2.npz')).dot(mat)
+        return lambda: post_probtrack.normalize_fingerprint(fp, roi_size)
+    if case == 'get_fiber_fingerprint':
+        # Project the bundles beforehand, so that only the fingerprint itself is timed
+        bundle_projection.bundle_targets(subject_path)
+        return lambda: post_probtrack.get_fiber_fingerprint(subject_path, 'R', recreation=True)
+    if case == 'generate_label_masks':
+        return lambda: generate_seeds.generate_label_masks(wmparc, scratch)
+    if case == 'resample_to_3mm':
+        with contextlib.redirect_stdout(io.StringIO()):
+            masks = generate_seeds.generate_label_masks(wmparc, scratch)
+        striatum = masks[('striatum', 'left')]
+        return lambda: generate_seeds.resample_to_3mm(striatum, os.path.join(scratch, 'L_striatum_mask_3mm.nii.gz'))
+    raise ValueError(f"Unknown benchmark case {case!r}; expected one of {CASES}.")
+
+
+def run_case(case, subject_path):
+    """
+    Runs one case in this process and returns its measurements.
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        func = setup_case(case, subject_path, scratch)
+        setup_rss = peak_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return {'case': case, 'seconds': wall, 'cpu_seconds': cpu, 'peak_rss_mb': peak_rss_mb(), 'setup_rss_mb': setup_rss}
+
+
+def prepare_subject(subject_path, n_seeds, n_targets, nnz_per_seed):
+    """
+    Generates the synthetic subject and the converted matrix the fingerprint cases read.
+    """
+    paths = generate_subject(subject_path, n_seeds, n_targets, nnz_per_seed)
+    out_dir = os.path.dirname(paths['dot'])
+    sparse.save_npz(os.path.join(out_dir, 'fdt_matrix2.npz'), post_probtrack.read_coomat_csr(Path(paths['dot'])))
+    return paths
+
+
+def git_commit():
+    """
+    Returns the commit of the working tree, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file):
+    """
+    Prints the change of every case against a previously saved result file.
+    """
+    with open(baseline_file) as f:
+        baseline = {result['case']: result for result in json.load(f)['results']}
+    print(f"\nAgainst {baseline_file}:")
+    for result in results:
+        old = baseline.get(result['case'])
+        if old:
+            print(f"{result['case']:<24} time x{result['seconds'] / max(old['seconds'], 1e-9):5.2f}  "
+                  f"peak RSS x{result['peak_rss_mb'] / max(old['peak_rss_mb'], 1e-9):5.2f}")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        print(json.dumps(run_case(sys.argv[2], sys.argv[3])))
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark the post-processing hot paths on synthetic data.")
+    parser.add_argument('--seeds', type=int, default=20000)
+    parser.add_argument('--targets', type=int, default=60000)
+    parser.add_argument('--nnz-per-seed', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--cases', default=','.join(CASES), help="Comma-separated subset of the cases.")
+    parser.add_argument('--output', default=None, help="JSON file to save; defaults to bench_<commit>.json.")
+    parser.add_argument('--compare', default=None, help="Earlier JSON result to compare against.")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        subject_path = os.path.join(tmp_dir, 'subject')
+        start = time.perf_counter()
+        paths = prepare_subject(subject_path, args.seeds, args.targets, args.nnz_per_seed)
+        print(f"Generated synthetic subject in {time.perf_counter() - start:.1f} s "
+              f"(.dot {os.path.getsize(paths['dot']) / 1e6:.0f} MB)")
+        for case in args.cases.split(','):
+            runs = []
+            for _ in range(args.repeat):
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', case, subject_path],
+                                        check=True, capture_output=True, text=True).stdout
+                runs.append(json.loads(output.strip().splitlines()[-1]))
+            result = min(runs, key=lambda run: run['seconds'])
+            result['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+            results.append(result)
+            print(f"{case:<24} {result['seconds']:8.3f} s  cpu {result['cpu_seconds']:8.3f} s  "
+                  f"peak RSS {result['peak_rss_mb']:8.1f} MB (setup {result['setup_rss_mb']:.1f} MB)")
+
+    report = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'params': {'seeds': args.seeds, 'targets': args.targets, 'nnz_per_seed': args.nnz_per_seed, 'repeat': args.repeat},
+        'results': results,
+    }
+    output = args.output or f"bench_{commit or 'local'}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Saved results to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
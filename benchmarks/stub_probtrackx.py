@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import numpy as np
+import nibabel as nib
+
+"""
+Stand-in for probtrackx2_gpu that writes a synthetic `--omatrix2` output, to exercise
+the pipeline on machines without FSL or a GPU:
+
+    PROBTRACKX_COMMAND="python benchmarks/stub_probtrackx.py" python async_pipeline.py ...
+
+It reads the seed mask (-x) and the target mask (--target2) and writes to --dir:
+
+    fdt_matrix2.dot          seeds x targets, STUB_NNZ_PER_SEED non-zeros per row
+    coords_for_fdt_matrix2   one "x y z 0 row" line per seed, seeds in Fortran (x fastest) order
+    tract_space_coords_for_fdt_matrix2
+                             the same for the targets
+    waytotal                 sum of the matrix values
+
+Seeds and targets are numbered like probtrackx does, x fastest. The row of a seed only
+depends on its voxel coordinates, so a seed-sharded run (seed_shards.py) merges to the
+same matrix as an unsharded one. STUB_PROBTRACKX_SECONDS adds a delay standing in for
+the GPU run time.
+
+The counts follow the sample count (-P, relative to 5000) with noise drawn from the
+random seed (--rseed), so the rounds of adaptive_sampling.py converge like real ones.
+"""
+
+NNZ_PER_SEED = int(os.environ.get("STUB_NNZ_PER_SEED", "50"))
+RUN_SECONDS = float(os.environ.get("STUB_PROBTRACKX_SECONDS", "0"))
+
+
+def parse_args(argv):
+    """
+    Extracts the seed mask, target mask, output directory, sample count and random seed
+    from probtrackx arguments.
+    """
+    options = dict(arg.split("=", 1) for arg in argv if arg.startswith("--") and "=" in arg)
+    samples = int(argv[argv.index("-P") + 1]) if "-P" in argv else 5000
+    return (argv[argv.index("-x") + 1], options["--target2"], options["--dir"], samples,
+            int(options.get("--rseed", "0")))
+
+
+def _mix(hashed):
+    """
+    Scrambles the bits of unsigned 64-bit integers.
+    """
+    hashed = hashed ^ (hashed >> np.uint64(13))
+    hashed = hashed * np.uint64(0x9E3779B97F4A7C15)
+    return hashed ^ (hashed >> np.uint64(29))
+
+
+def mask_voxels(path):
+    """
+    Returns the voxel coordinates of a mask in Fortran order, as an (n, 3) array.
+    """
+    data = np.asanyarray(nib.load(path).dataobj)
+    return np.column_stack(np.unravel_index(np.flatnonzero(data.ravel(order="F")), data.shape, order="F"))
+
+
+def write_seed_dot(path, seeds, n_targets, nnz_per_seed=NNZ_PER_SEED, samples=5000, rseed=0):
+    """
+    Writes a row-sorted `.dot` matrix whose row for a seed is a hash of its coordinates
+    and the random seed.
+    """
+    nnz_per_seed = min(nnz_per_seed, n_targets)
+    stride = n_targets // nnz_per_seed
+    key = (seeds[:, 0] + 1000 * seeds[:, 1] + 1000000 * seeds[:, 2]).astype(np.uint64)
+    hashed = key[:, np.newaxis] * np.uint64(2654435761) + np.arange(nnz_per_seed, dtype=np.uint64) * np.uint64(40503)
+    hashed = _mix(hashed)
+    # One column per stride of the target range keeps each row sorted and distinct
+    cols = np.arange(nnz_per_seed) * stride + (hashed % np.uint64(stride)).astype(np.int64)
+    expected = (1 + ((hashed >> np.uint64(32)) % np.uint64(499)).astype(np.float64)) * samples / 5000
+    # Unit-variance uniform noise, scaled like the spread of a streamline count
+    # The hash wraps around modulo 2**64 by design
+    with np.errstate(over='ignore'):
+        noise = _mix(hashed + np.uint64(rseed) * np.uint64(0x632BE59BD9B4E019))
+    noise = ((noise >> np.uint64(11)).astype(np.float64) / 2.0 ** 53 - 0.5) * np.sqrt(12)
+    values = np.maximum(np.rint(expected + np.sqrt(expected) * noise), 0).astype(np.int64)
+    rows = np.repeat(np.arange(1, len(seeds) + 1), nnz_per_seed)
+    keep = values.ravel() > 0
+    block = np.column_stack((rows[keep], cols.ravel()[keep] + 1, values.ravel()[keep])).ravel().tolist()
+    with open(path, "w") as f:
+        f.write("%d  %d  %d\n" * int(keep.sum()) % tuple(block))
+
+
+def main():
+    start = time.perf_counter()
+    seed_mask, target_mask, out_dir, samples, rseed = parse_args(sys.argv[1:])
+    seeds = mask_voxels(seed_mask)
+    targets = mask_voxels(target_mask)
+    n_targets = len(targets)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Write under a temporary name so that a consumer never sees a partial matrix
+    dot_file = os.path.join(out_dir, "fdt_matrix2.dot")
+    write_seed_dot(dot_file + ".tmp", seeds, n_targets, samples=samples, rseed=rseed)
+    os.replace(dot_file + ".tmp", dot_file)
+    for name, voxels in (("coords_for_fdt_matrix2", seeds), ("tract_space_coords_for_fdt_matrix2", targets)):
+        rows = np.column_stack((voxels, np.zeros(len(voxels), dtype=int), np.arange(1, len(voxels) + 1)))
+        np.savetxt(os.path.join(out_dir, name), rows, fmt="%d")
+    with open(dot_file) as f:
+        waytotal = sum(int(line.split()[2]) for line in f)
+    with open(os.path.join(out_dir, "waytotal"), "w") as f:
+        f.write(f"{waytotal}\n")
+    time.sleep(max(RUN_SECONDS - (time.perf_counter() - start), 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import os
+import sys
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from generate_seeds import MASK_LABELS
+
+"""
+Generates synthetic subjects with the files the post-processing stages read, at a
+configurable scale, so the hot paths can be timed without HCP data or FSL:
+
+    <subject>/T1/wmparc.nii.gz                         label volume using the MASK_LABELS ranges
+    <subject>/DTI/LowResMask.nii.gz                    3mm target mask with n_targets voxels
+    <subject>/DTI/LowRes_Fibers.nii.gz                 72-channel bundle volume on the 3mm grid
+    <subject>/tractseg_output/bundle_segmentations.nii.gz
+                                                       72-channel bundle volume on the 1.25mm DTI grid
+    <subject>/probtrackx_R_omatrix2/fdt_matrix2.dot    n_seeds x n_targets, nnz_per_seed per row
+
+Usage: python benchmarks/synthetic.py <output_dir> [n_seeds] [n_targets] [nnz_per_seed]
+"""
+
+# Grids of the HCP structural images (0.7mm), diffusion images (1.25mm) and of the 3mm target space
+WMPARC_SHAPE = (260, 311, 260)
+DTI_SHAPE = (145, 174, 145)
+LOWRES_SHAPE = (60, 72, 60)
+N_BUNDLES = 72
+
+# Rows of the .dot file formatted per write
+_DOT_ROWS_PER_WRITE = 2000
+
+
+def write_dot(path, n_seeds, n_targets, nnz_per_seed, rng):
+    """
+    Writes a row-sorted probtrackx coordinate matrix (`i  j  v`, 1-based).
+
+    Args:
+        path (str): Output `.dot` file.
+        n_seeds (int): Number of rows.
+        n_targets (int): Number of columns.
+        nnz_per_seed (int): Number of non-zeros per row.
+        rng (np.random.Generator): Random generator.
+    """
+    nnz_per_seed = min(nnz_per_seed, n_targets)
+    with open(path, 'w') as f:
+        for start in range(0, n_seeds, _DOT_ROWS_PER_WRITE):
+            stop = min(start + _DOT_ROWS_PER_WRITE, n_seeds)
+            # One column per stride of the target range keeps each row sorted and distinct
+            stride = n_targets // nnz_per_seed
+            cols = np.arange(nnz_per_seed) * stride + rng.integers(0, stride, (stop - start, nnz_per_seed))
+            rows = np.repeat(np.arange(start + 1, stop + 1), nnz_per_seed)
+            values = rng.integers(1, 500, rows.size)
+            block = np.column_stack((rows, cols.ravel() + 1, values)).ravel().tolist()
+            f.write('%d  %d  %d\n' * rows.size % tuple(block))
+
+
+def write_wmparc(path, shape=WMPARC_SHAPE, rng=None):
+    """
+    Writes a label volume in which every label of the MASK_LABELS ranges covers a random
+    set of blocks, with the remaining voxels labelled 0.
+
+    Args:
+        path (str): Output NIfTI file.
+        shape (tuple): Volume shape.
+        rng (np.random.Generator): Random generator.
+    """
+    rng = rng or np.random.default_rng(0)
+    labels = [0]
+    for hemispheres in MASK_LABELS.values():
+        for ranges in hemispheres.values():
+            for low, high in ranges:
+                labels.extend(range(low, high + 1))
+    labels = np.array(labels, dtype=np.int32)
+    block = 4
+    coarse = rng.choice(labels, size=tuple(-(-n // block) for n in shape))
+    data = np.repeat(np.repeat(np.repeat(coarse, block, 0), block, 1), block, 2)[:shape[0], :shape[1], :shape[2]]
+    nib.save(nib.Nifti1Image(data, np.diag([0.7, 0.7, 0.7, 1])), path)
+
+
+def write_target_mask(mask_path, n_targets, shape=LOWRES_SHAPE, rng=None):
+    """
+    Writes a 3mm target mask with `n_targets` voxels.
+
+    Args:
+        mask_path (str): Output mask NIfTI file.
+        n_targets (int): Number of voxels in the mask.
+        shape (tuple): Grid shape.
+        rng (np.random.Generator): Random generator.
+    """
+    rng = rng or np.random.default_rng(0)
+    mask = np.zeros(int(np.prod(shape)), dtype=np.uint8)
+    mask[rng.choice(mask.size, min(n_targets, mask.size), replace=False)] = 1
+    nib.save(nib.Nifti1Image(mask.reshape(shape), np.diag([3.0, 3.0, 3.0, 1])), mask_path)
+
+
+def write_bundles(path, shape, voxel_size, rng=None):
+    """
+    Writes a 72-channel bundle volume, each bundle being a random ball of 9 to 30mm radius.
+
+    Args:
+        path (str): Output bundle NIfTI file.
+        shape (tuple): Grid shape.
+        voxel_size (float): Isotropic voxel size in mm.
+        rng (np.random.Generator): Random generator.
+    """
+    rng = rng or np.random.default_rng(0)
+    grid = np.indices(shape, dtype=np.float32)
+    fibers = np.zeros(shape + (N_BUNDLES,), dtype=np.uint8)
+    for bundle in range(N_BUNDLES):
+        centre = rng.uniform(0, shape).astype(np.float32)
+        radius = rng.uniform(9, 30) / voxel_size
+        dist2 = sum((grid[axis] - centre[axis]) ** 2 for axis in range(3))
+        fibers[..., bundle] = dist2 <= radius ** 2
+    nib.save(nib.Nifti1Image(fibers, np.diag([voxel_size] * 3 + [1])), path)
+
+
+def generate_subject(subject_path, n_seeds=20000, n_targets=60000, nnz_per_seed=2000, seed=0):
+    """
+    Generates one synthetic subject.
+
+    Args:
+        subject_path (str): Output subject folder.
+        n_seeds (int): Rows of fdt_matrix2.
+        n_targets (int): Columns of fdt_matrix2, i.e. voxels of the target mask.
+        nnz_per_seed (int): Non-zeros per row of fdt_matrix2.
+        seed (int): Random seed.
+
+    Returns:
+        dict: Paths of the generated files.
+    """
+    rng = np.random.default_rng(seed)
+    n_targets = min(n_targets, int(np.prod(LOWRES_SHAPE)))
+    paths = {
+        'wmparc': os.path.join(subject_path, 'T1', 'wmparc.nii.gz'),
+        'mask': os.path.join(subject_path, 'DTI', 'LowResMask.nii.gz'),
+        'fibers': os.path.join(subject_path, 'DTI', 'LowRes_Fibers.nii.gz'),
+        'bundles': os.path.join(subject_path, 'tractseg_output', 'bundle_segmentations.nii.gz'),
+        'dot': os.path.join(subject_path, 'probtrackx_R_omatrix2', 'fdt_matrix2.dot'),
+    }
+    for path in paths.values():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_wmparc(paths['wmparc'], rng=rng)
+    write_target_mask(paths['mask'], n_targets, rng=rng)
+    write_bundles(paths['fibers'], LOWRES_SHAPE, 3.0, rng)
+    write_bundles(paths['bundles'], DTI_SHAPE, 1.25, rng)
+    write_dot(paths['dot'], n_seeds, n_targets, nnz_per_seed, rng)
+    return paths
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python benchmarks/synthetic.py <output_dir> [n_seeds] [n_targets] [nnz_per_seed]")
+        return
+    args = [int(arg) for arg in sys.argv[2:5]]
+    paths = generate_subject(sys.argv[1], *args)
+    for name, path in paths.items():
+        print(f"{name:<7} {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
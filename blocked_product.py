@@ -0,0 +1,136 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.sparse as sparse
+
+"""
+Out-of-core, multithreaded product of the connectivity matrix with the fiber matrix.
+
+`fdt_matrix2` has one row per seed voxel and one column per target voxel, while the fiber
+matrix only has one column per bundle (72). The product is computed in blocks of seed
+rows: each block is read from the memory-mapped matrix (see sparse_store.LazyCSR),
+multiplied against the fiber matrix in a thread pool and handed on in row order, so only
+the blocks in flight are ever held in memory.
+
+Every fingerprint row only depends on the matching connectivity row, and scipy computes
+each output row from the input row alone, so the blocked result is bit-identical to the
+in-memory `sps_mat.dot(mat)`, including the order of the non-zeros within a row.
+"""
+
+# Memory budget (in MB) for the connectivity rows and partial products held at once
+PRODUCT_MEMORY_MB = 1024
+
+# Number of threads multiplying blocks
+PRODUCT_WORKERS = min(8, os.cpu_count() or 1)
+
+# Approximate bytes held per connectivity non-zero while its block is in flight: the
+# float32 value and int32 column read from disk, and the float64 copy of the value made
+# when scipy upcasts the block to the dtype of the fiber matrix
+_BYTES_PER_NNZ = 4 + 4 + 8
+
+
+def row_blocks(indptr, max_nnz):
+    """
+    Splits the rows of a CSR matrix into contiguous blocks holding at most `max_nnz`
+    non-zeros each. A single row with more non-zeros than that forms its own block.
+
+    Args:
+        indptr (np.ndarray): Row pointer of the matrix (may be memory-mapped).
+        max_nnz (int): Maximum number of non-zeros per block.
+
+    Returns:
+        list: (start, stop) row ranges covering all rows.
+    """
+    indptr = np.asarray(indptr)
+    n_rows = indptr.size - 1
+    blocks, start = [], 0
+    while start < n_rows:
+        stop = int(np.searchsorted(indptr, indptr[start] + max_nnz, side='right')) - 1
+        stop = min(max(stop, start + 1), n_rows)
+        blocks.append((start, stop))
+        start = stop
+    return blocks
+
+
+def block_nnz(memory_budget_mb, workers, n_cols):
+    """
+    Derives the number of connectivity non-zeros per block from a memory budget.
+
+    Args:
+        memory_budget_mb (float): Memory budget in MB.
+        workers (int): Number of threads; twice as many blocks may be in flight.
+        n_cols (int): Number of columns of the product, which bounds the output per row.
+
+    Returns:
+        int: Maximum number of non-zeros per block.
+    """
+    in_flight = 2 * workers
+    return max(int(memory_budget_mb * 1024 * 1024 / (in_flight * (_BYTES_PER_NNZ + n_cols))), 1)
+
+
+def iter_blocked_dot(mat, other, memory_budget_mb=PRODUCT_MEMORY_MB, workers=PRODUCT_WORKERS):
+    """
+    Multiplies a row-sliceable matrix by a small matrix block by block.
+
+    Args:
+        mat (LazyCSR or sparse matrix): Left operand; a LazyCSR is read from disk block by block.
+        other (sparse matrix): Right operand, small enough to be shared by all threads.
+        memory_budget_mb (float): Memory budget in MB for the blocks in flight.
+        workers (int): Number of threads.
+
+    Yields:
+        tuple: (start, stop, block), the product rows start..stop-1 as a CSR matrix, in row order.
+    """
+    if not hasattr(mat, 'rows'):
+        mat = sparse.csr_matrix(mat)
+    other = sparse.csr_matrix(other)
+    blocks = row_blocks(mat.indptr, block_nnz(memory_budget_mb, workers, other.shape[1]))
+
+    def multiply(start, stop):
+        rows = mat.rows(start, stop) if hasattr(mat, 'rows') else mat[start:stop]
+        return sparse.csr_matrix(rows.dot(other))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Keep at most two blocks per thread in flight and hand them on in row order
+        in_flight = deque()
+        for start, stop in blocks:
+            in_flight.append((start, stop, pool.submit(multiply, start, stop)))
+            if len(in_flight) >= 2 * workers:
+                start, stop, future = in_flight.popleft()
+                yield start, stop, future.result()
+        while in_flight:
+            start, stop, future = in_flight.popleft()
+            yield start, stop, future.result()
+
+
+def blocked_dot(mat, other, writer=None, transform=None, memory_budget_mb=PRODUCT_MEMORY_MB, workers=PRODUCT_WORKERS):
+    """
+    Computes `mat.dot(other)` out of core.
+
+    Args:
+        mat (LazyCSR or sparse matrix): Left operand.
+        other (sparse matrix): Right operand.
+        writer (CSRWriter): If given, the product rows are appended to it as they are
+            computed instead of being collected in memory.
+        transform (callable): Row-wise function applied to every block before it is
+            written, e.g. a row-local normalization.
+        memory_budget_mb (float): Memory budget in MB for the blocks in flight.
+        workers (int): Number of threads.
+
+    Returns:
+        The product as a CSR matrix, or the written LazyCSR when `writer` is given.
+    """
+    collected = []
+    for _, _, block in iter_blocked_dot(mat, other, memory_budget_mb, workers):
+        if transform is not None:
+            block = transform(block)
+        if writer is not None:
+            writer.append(block)
+        else:
+            collected.append(block)
+    if writer is not None:
+        return writer.close()
+    if not collected:
+        return sparse.csr_matrix((mat.shape[0], other.shape[1]), dtype=np.result_type(mat.dtype, other.dtype))
+    return sparse.vstack(collected, format='csr')
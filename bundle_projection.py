@@ -0,0 +1,241 @@
+import os
+import threading
+import numpy as np
+import nibabel as nib
+import scipy.sparse as sparse
+from instrumentation import track_stage
+from pipeline_state import StageSpec, is_up_to_date, record_stage
+from resample import image_geometry, resample_array, source_coordinates
+from volume_cache import load_volume
+
+"""
+Projects the TractSeg bundle segmentation directly onto the probtrackx target space.
+
+post_probtrack needs, for every target voxel (a column of fdt_matrix2) and every bundle,
+how much of the 3mm voxel the bundle occupies, plus the size of every bundle on the 3mm
+grid. This used to take a flirt resampling of bundle_segmentations.nii.gz to a
+LowRes_Fibers.nii.gz file, which was then read back and gathered at the target voxels.
+Here the high-resolution segmentation is read once and reduced straight to the
+target x bundle sparse matrix, with one of two occupancies:
+
+    nearest   the bundle label of the nearest high-resolution voxel, as
+              `flirt -applyisoxfm 3 -interp nearestneighbour` gives. The matrix is the
+              same as the one computed from LowRes_Fibers.
+    partial   the fraction of the 3mm voxel covered by high-resolution voxels of the
+              bundle (partial-volume occupancy), from separable per-axis overlaps.
+
+NIfTI stores each bundle as a contiguous volume, so the segmentation is read in slabs of
+SLAB_BUNDLES bundles, front to back through one open file, which bounds memory to one slab.
+
+The result is cached per subject in DTI/bundle_targets.npz and recorded as the
+"bundle_targets" stage, so it is only recomputed when the segmentation, the target mask
+or the occupancy changes.
+"""
+
+# Define the root data directory
+DATA_DIRECTORY = "/home/test/lmq/data/HCP"
+
+# Occupancy of a target voxel by a bundle: 'nearest' or 'partial'
+BUNDLE_OCCUPANCY = 'nearest'
+OCCUPANCY_MODES = ('nearest', 'partial')
+
+# Resolution of the probtrackx target space in mm
+TARGET_RESOLUTION = 3
+
+# Number of bundles read and projected at a time
+SLAB_BUNDLES = 8
+
+
+def overlap_weights(coordinates, n_src, half_width):
+    """
+    Computes the fraction of every output voxel covered by every input voxel along one axis.
+    Args:
+        coordinates (np.ndarray): Input voxel coordinate of every output voxel centre.
+        n_src (int): Number of input voxels along the axis.
+        half_width (float): Half the output voxel size, in input voxels.
+    Returns:
+        scipy.sparse.csr_matrix: (n_out, n_src) weights; rows sum to the fraction of the
+        output voxel that lies inside the input.
+    """
+    low, high = coordinates - half_width, coordinates + half_width
+    first = np.floor(low + 0.5).astype(np.intp)
+    rows, cols, weights = [], [], []
+    for offset in range(int(np.ceil(2 * half_width)) + 2):
+        src = first + offset
+        overlap = np.minimum(high, src + 0.5) - np.maximum(low, src - 0.5)
+        keep = (overlap > 0) & (src >= 0) & (src < n_src)
+        rows.append(np.flatnonzero(keep))
+        cols.append(src[keep])
+        weights.append(overlap[keep] / (2 * half_width))
+    return sparse.csr_matrix((np.concatenate(weights).astype(np.float32), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(coordinates.size, n_src))
+
+
+def _partial_volume(data, weights):
+    """
+    Applies the per-axis overlap weights to a slab of bundle volumes.
+    Args:
+        data (np.ndarray): (x, y, z, bundles) slab.
+        weights (tuple): Overlap weights of the three axes.
+    Returns:
+        np.ndarray: (out_x, out_y, out_z, bundles) occupancy fractions.
+    """
+    out = np.asarray(data, dtype=np.float32)
+    for axis, weight in enumerate(weights):
+        # Bring the axis to the front, contract it, and put it back
+        moved = np.moveaxis(out, axis, 0)
+        contracted = weight.dot(moved.reshape(moved.shape[0], -1))
+        out = np.moveaxis(contracted.reshape((weight.shape[0],) + moved.shape[1:]), 0, axis)
+    return out
+
+
+def project_bundles(bundle_path, target_mask_path, occupancy=BUNDLE_OCCUPANCY, resolution=TARGET_RESOLUTION,
+                    slab_bundles=SLAB_BUNDLES):
+    """
+    Computes the target x bundle occupancy matrix from the high-resolution segmentation.
+    Args:
+        bundle_path (str): Path to TractSeg's bundle_segmentations.nii.gz.
+        target_mask_path (str): Path to the target mask (LowResMask.nii.gz).
+        occupancy (str): 'nearest' or 'partial'.
+        resolution (float): Resolution of the target space in mm.
+        slab_bundles (int): Number of bundles processed at a time.
+    Returns:
+        tuple: (n_targets, n_bundles) CSR matrix, with targets ordered like the columns
+        of fdt_matrix2, and the size of every bundle on the target grid.
+    """
+    if occupancy not in OCCUPANCY_MODES:
+        raise ValueError(f"Unknown occupancy {occupancy!r}; expected one of {OCCUPANCY_MODES}.")
+    # Read straight from the file rather than through volume_cache, which would decode
+    # all bundles at once on a cache miss and defeat the slab bound
+    bundle_img = nib.load(bundle_path, keep_file_open=True)
+    mask_img = load_volume(target_mask_path)
+    src_geometry, ref_geometry = image_geometry(bundle_img), image_geometry(mask_img)
+    n_bundles = bundle_img.shape[3] if len(bundle_img.shape) > 3 else 1
+
+    mask = np.asanyarray(mask_img.dataobj)
+    # Column order of probtrackx's target2 matrix: x fastest, then y, then z
+    x, y, z = np.unravel_index(np.flatnonzero(mask.ravel(order='F')), mask.shape, order='F')
+    if occupancy == 'partial':
+        _, coordinates = source_coordinates(src_geometry, ref_geometry, resolution)
+        half_width = [resolution / (2 * zoom) for zoom in src_geometry[1]]
+        weights = tuple(overlap_weights(coordinates[axis], src_geometry[0][axis], half_width[axis]) for axis in range(3))
+
+    roi_size = np.zeros(n_bundles, dtype=np.float64)
+    blocks = []
+    for start in range(0, n_bundles, slab_bundles):
+        stop = min(start + slab_bundles, n_bundles)
+        if len(bundle_img.shape) > 3:
+            slab = np.asanyarray(bundle_img.dataobj[..., start:stop])
+        else:
+            slab = np.asanyarray(bundle_img.dataobj)[..., np.newaxis]
+        if occupancy == 'nearest':
+            projected = resample_array(slab, src_geometry, ref_geometry, resolution)
+        else:
+            projected = _partial_volume(slab, weights)
+        del slab
+        roi_size[start:stop] = projected.sum(axis=(0, 1, 2), dtype=np.float64)
+        inside = (x < projected.shape[0]) & (y < projected.shape[1]) & (z < projected.shape[2])
+        values = np.zeros((x.size, stop - start), dtype=np.float64)
+        values[inside] = projected[x[inside], y[inside], z[inside], :]
+        blocks.append(sparse.csr_matrix(values))
+    bundle_img.uncache()
+    mat = sparse.hstack(blocks, format='csr') if blocks else sparse.csr_matrix((x.size, 0))
+    return mat, roi_size
+
+
+def stage_spec(subject_path):
+    """
+    Declares the inputs, outputs and parameters of the bundle projection stage.
+    Args:
+        subject_path (str): Path to the subject's folder.
+    Returns:
+        StageSpec: Declaration of the stage.
+    """
+    return StageSpec(
+        name="bundle_targets",
+        inputs=[os.path.join(subject_path, "tractseg_output", "bundle_segmentations.nii.gz"),
+                os.path.join(subject_path, "DTI", "LowResMask.nii.gz")],
+        outputs=[os.path.join(subject_path, "DTI", "bundle_targets.npz")],
+        params={"occupancy": BUNDLE_OCCUPANCY, "resolution": TARGET_RESOLUTION},
+    )
+
+
+def save_bundle_targets(path, mat, roi_size):
+    """
+    Atomically saves a projection.
+    Args:
+        path (str): Output `.npz` file.
+        mat (scipy.sparse.csr_matrix): Target x bundle matrix.
+        roi_size (np.ndarray): Bundle sizes.
+    """
+    # Both hemispheres, or the GPU threads of the scheduler, may build it at the same time
+    tmp_path = f"{path[:-len('.npz')]}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+    np.savez(tmp_path, data=mat.data, indices=mat.indices, indptr=mat.indptr, shape=np.array(mat.shape),
+             roi_size=roi_size)
+    os.replace(tmp_path, path)
+
+
+def load_bundle_targets(path):
+    """
+    Loads a projection saved with `save_bundle_targets`.
+    Args:
+        path (str): Path to the `.npz` file.
+    Returns:
+        tuple: Target x bundle CSR matrix and bundle sizes.
+    """
+    with np.load(path) as f:
+        mat = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+        return mat, f["roi_size"]
+
+
+def bundle_targets(subject_path):
+    """
+    Returns a subject's target x bundle matrix, computing and caching it when the cached
+    one is missing or out of date.
+    Args:
+        subject_path (str): Path to the subject's folder.
+    Returns:
+        tuple: Target x bundle CSR matrix and bundle sizes.
+    """
+    spec = stage_spec(subject_path)
+    cache_file = spec.outputs[0]
+    if is_up_to_date(subject_path, spec):
+        return load_bundle_targets(cache_file)
+    bundle_path, target_mask_path = spec.inputs
+    with track_stage(subject_path, spec.name, BUNDLE_OCCUPANCY):
+        mat, roi_size = project_bundles(bundle_path, target_mask_path)
+        save_bundle_targets(cache_file, mat, roi_size)
+    record_stage(subject_path, spec)
+    print(f"Projected bundles onto the target space ({BUNDLE_OCCUPANCY}): {cache_file}")
+    return mat, roi_size
+
+
+def process_subject(subject_path):
+    """
+    Computes the bundle projection of a subject if its inputs are available.
+    Args:
+        subject_path (str): Path to the subject's folder.
+    Returns:
+        bool: True if the projection is up to date, either already or after this run.
+    """
+    missing = [path for path in stage_spec(subject_path).inputs if not os.path.exists(path)]
+    if missing:
+        print(f"Missing {missing[0]}. Skipping subject: {os.path.basename(subject_path)}")
+        return False
+    # Raises if the projection cannot be computed
+    bundle_targets(subject_path)
+    return True
+
+
+def main():
+    """
+    Main function to project the bundles of all subjects onto their target space.
+    """
+    for subject_dir in os.listdir(DATA_DIRECTORY):
+        subject_path = os.path.join(DATA_DIRECTORY, subject_dir)
+        if os.path.isdir(subject_path):
+            process_subject(subject_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+import argparse
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import adaptive_sampling
+import bundle_projection
+import generate_masks
+import generate_seeds
+import post_probtrack
+import resource_model
+import run_bedpostx
+import run_probtrack
+import run_tractseg
+from instrumentation import load_metrics
+from pipeline_state import STAGE_DEPENDENCIES
+
+"""
+Runs the whole pipeline over a cohort with the machine's CPUs and GPUs kept busy.
+
+The CPU stages (mask generation, seed generation, bundle projection and post_probtrack) run in a process
+pool. The GPU stages (bedpostX, TractSeg and ProbtrackX2) are handed to a fixed set of GPU
+slots, one job per slot, with CUDA_VISIBLE_DEVICES set to the slot's device. Within a
+subject, a job starts only once the jobs producing its inputs have finished, following
+the stage graph in pipeline_state; jobs of different subjects run freely in parallel.
+
+Ready jobs are admitted against memory budgets rather than started straight away:
+resource_model predicts the peak RAM, GPU memory and runtime of each one from the size of
+its inputs and the cohort's logged runs. A job starts only while its predicted RAM fits
+in what the running jobs leave of the host budget (--memory-mb) and, for a GPU job, a
+slot is free on a device whose budget (--gpu-memory-mb) fits its predicted GPU memory.
+The ready jobs with the longest predicted runtime are admitted first; a job larger than
+a whole budget starts once it would run alone. --cpu-workers only caps the number of
+concurrent CPU jobs.
+
+Each stage keeps its own up-to-date check, so re-running the scheduler only does the
+outstanding work. Given a watcher (see watch_ingest), the scheduler keeps running and
+adds each subject to the queue as the watcher reports its inputs complete.
+
+The FSL and TractSeg executables can be replaced by stubs through the
+SPLIT_PARTS_COMMAND, XFIBRES_COMMAND, POSTPROC_COMMAND, TRACTSEG_COMMAND and
+PROBTRACKX_COMMAND environment variables to exercise the scheduler on a CPU-only machine.
+"""
+
+# Define the root data directory
+DATA_DIRECTORY = "/home/test/lmq/data/HCP"
+
+# Host memory budget in MB; 0 uses MEMORY_FRACTION of the machine's memory. Override with
+# COHORT_MEMORY_MB.
+MEMORY_BUDGET_MB = float(os.environ.get("COHORT_MEMORY_MB", "0"))
+MEMORY_FRACTION = 0.8
+
+# Memory budget of each GPU in MB; 0 limits GPU jobs by their slots only. Override with
+# COHORT_GPU_MEMORY_MB.
+GPU_MEMORY_MB = float(os.environ.get("COHORT_GPU_MEMORY_MB", "0"))
+
+# A unit of work: the pipeline stages it covers, whether it needs a GPU slot, and the
+# module-level function (so that it can be sent to worker processes) running it
+Job = namedtuple("Job", ["subject_dir", "name", "stages", "gpu", "func", "args"])
+
+
+def _check(succeeded):
+    # Stages report a skipped or failed run by returning False; raising marks the subject
+    # as failed, so that the jobs depending on the stage are dropped
+    if not succeeded:
+        raise RuntimeError("stage did not complete, see its output above")
+
+
+def _masks(subject_path):
+    _check(generate_masks.process_subject(subject_path))
+
+
+def _seeds(subject_path):
+    _check(generate_seeds.process_subject(subject_path))
+
+
+def _bedpostx(subject_path, devices, gpu=None):
+    # The parts spread over every GPU of the cohort, starting on the one the job was given;
+    # on CPU cores (BEDPOSTX_CPU_CORES) the job runs without a GPU
+    if gpu is not None:
+        devices = [gpu] + [device for device in devices if device != gpu]
+    _check(run_bedpostx.run_bedpostx(os.path.basename(subject_path), os.path.dirname(subject_path),
+                                     gpu=gpu or 0, devices=devices))
+
+
+def _tractseg(subject_path, gpu):
+    _check(run_tractseg.run_tractseg(os.path.basename(subject_path), os.path.dirname(subject_path), gpu=gpu))
+
+
+def _bundle_targets(subject_path):
+    _check(bundle_projection.process_subject(subject_path))
+
+
+def _probtrack(subject_path, hemisphere, gpu):
+    _check(adaptive_sampling.run_tractography(os.path.basename(subject_path), os.path.dirname(subject_path),
+                                              hemisphere, gpu=gpu))
+
+
+def _post_probtrack(subject_path, hemisphere):
+    _check(post_probtrack.process_hemisphere(subject_path, hemisphere))
+
+
+def subject_jobs(data_directory, subject_dir, gpus=(0,)):
+    """
+    Lists the jobs needed to process one subject.
+    Args:
+        data_directory (str): The root directory containing all subject data.
+        subject_dir (str): The subject's directory name.
+        gpus (list): CUDA device ids of the cohort, which the bedpostX parts spread over.
+    Returns:
+        list: Jobs in an order compatible with their dependencies.
+    """
+    subject_path = os.path.join(data_directory, subject_dir)
+    jobs = [
+        Job(subject_dir, "masks", ["masks"], False, _masks, (subject_path,)),
+        Job(subject_dir, "seeds", ["seeds"], False, _seeds, (subject_path,)),
+        Job(subject_dir, "bedpostx", ["bedpostx"], run_bedpostx.BEDPOSTX_CPU_CORES == 0, _bedpostx,
+            (subject_path, list(gpus))),
+        Job(subject_dir, "tractseg", ["tractseg"], True, _tractseg, (subject_path,)),
+        Job(subject_dir, "bundle_targets", ["bundle_targets"], False, _bundle_targets, (subject_path,)),
+    ]
+    for hemisphere in ["left", "right"]:
+        jobs.append(Job(subject_dir, f"probtrack_{hemisphere}", ["probtrack"], True, _probtrack, (subject_path, hemisphere)))
+    for hemisphere in ["R", "L"]:
+        jobs.append(Job(subject_dir, f"post_probtrack_{hemisphere}", ["post_probtrack"], False, _post_probtrack, (subject_path, hemisphere)))
+    return jobs
+
+
+def job_dependencies(job, jobs):
+    """
+    Finds the jobs of the same subject that produce the inputs of a job.
+    Args:
+        job (Job): The job.
+        jobs (list): All jobs of the subject.
+    Returns:
+        list: Names of the jobs that must finish first.
+    """
+    needed = {dependency for stage in job.stages for dependency in STAGE_DEPENDENCIES[stage]} - set(job.stages)
+    if "probtrack" in job.stages and run_probtrack.PROBTRACK_ROUND_SAMPLES > 0:
+        # Adaptive sampling compares the fingerprints of successive rounds
+        needed.add("bundle_targets")
+    return [other.name for other in jobs if other is not job and needed & set(other.stages)]
+
+
+def total_memory_mb():
+    """
+    Returns the physical memory of the machine in MB.
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 / 1024
+
+
+def run_cohort(data_directory, cpu_workers, gpus, memory_mb=None, gpu_memory_mb=GPU_MEMORY_MB, watcher=None):
+    """
+    Processes every subject of a cohort with a CPU process pool and a set of GPU slots,
+    starting a ready job only while its predicted memory fits in the budgets.
+    Args:
+        data_directory (str): The root directory containing all subject data.
+        cpu_workers (int): Maximum number of processes for the CPU stages.
+        gpus (list): CUDA device ids, one GPU slot each. Repeat an id to share a device.
+        memory_mb (float): Host memory budget in MB; defaults to MEMORY_FRACTION of the machine's.
+        gpu_memory_mb (float): Memory budget of each GPU in MB; 0 limits GPU jobs by slots only.
+        watcher (watch_ingest.SubjectWatcher): Source of the subjects to process as they
+            arrive, instead of the subjects present now; the call then runs until interrupted.
+    Returns:
+        dict: Number of subjects completed and failed, elapsed seconds and subjects per hour.
+    """
+    if memory_mb is None:
+        memory_mb = MEMORY_FRACTION * total_memory_mb()
+    if watcher is None:
+        subjects = sorted(d for d in os.listdir(data_directory) if os.path.isdir(os.path.join(data_directory, d)))
+    else:
+        subjects = []
+    pending = {}
+    models = resource_model.fit_models(load_metrics(data_directory), data_directory)
+
+    free_slots = {gpu: gpus.count(gpu) for gpu in gpus}
+    free_gpu_mb = {gpu: gpu_memory_mb for gpu in gpus}
+    free_mb = memory_mb
+    # Jobs whose dependencies are done, with their estimates, waiting for memory
+    ready = []
+    done = {}
+    failed_subjects, running = set(), {}
+    completed = 0
+    start = time.perf_counter()
+    # Workers come from a fork server: forking from this process while a GPU thread is in
+    # Popen would hand the worker Popen's exec-status pipe and stall that thread
+    cpu_context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=cpu_workers, mp_context=cpu_context) as cpu_pool, \
+            ThreadPoolExecutor(max_workers=len(gpus)) as gpu_pool:
+
+        def queue_ready(subject_dir):
+            for name, (job, dependencies) in list(pending[subject_dir].items()):
+                if dependencies <= done[subject_dir]:
+                    subject_path = os.path.join(data_directory, subject_dir)
+                    features = resource_model.stage_features(subject_path, name)
+                    ready.append((job, features, resource_model.predict(models, name, features)))
+                    del pending[subject_dir][name]
+
+        def add_subject(subject_dir):
+            jobs = subject_jobs(data_directory, subject_dir, list(dict.fromkeys(gpus)))
+            pending[subject_dir] = {job.name: (job, set(job_dependencies(job, jobs))) for job in jobs}
+            done[subject_dir] = set()
+            queue_ready(subject_dir)
+
+        def admit():
+            nonlocal free_mb
+            # Longest predicted runtime first; smaller jobs fill the memory a larger one leaves
+            ready.sort(key=lambda item: -item[2].runtime_s)
+            cpu_running = sum(1 for _, _, _, gpu in running.values() if gpu is None)
+            for item in list(ready):
+                job, features, estimate = item
+                # A job larger than the whole budget runs alone rather than never
+                if estimate.ram_mb > free_mb and running:
+                    continue
+                gpu = None
+                if job.gpu:
+                    # An idle device takes any job, even one predicted to exceed its budget
+                    devices = [device for device in free_slots if free_slots[device] > 0 and
+                               (not gpu_memory_mb or estimate.gpu_mb <= free_gpu_mb[device] or
+                                free_slots[device] == gpus.count(device))]
+                    if not devices:
+                        continue
+                    gpu = max(devices, key=lambda device: (free_gpu_mb[device], free_slots[device]))
+                elif cpu_running >= cpu_workers:
+                    continue
+                # Logged before the job starts, so that the estimate precedes the job's own entries
+                resource_model.log_estimate(os.path.join(data_directory, job.subject_dir), job.name, features, estimate)
+                if job.gpu:
+                    free_slots[gpu] -= 1
+                    free_gpu_mb[gpu] -= estimate.gpu_mb
+                    future = gpu_pool.submit(job.func, *job.args, gpu=gpu)
+                else:
+                    cpu_running += 1
+                    future = cpu_pool.submit(job.func, *job.args)
+                free_mb -= estimate.ram_mb
+                running[future] = (job.subject_dir, job.name, estimate, gpu)
+                ready.remove(item)
+
+        for subject_dir in subjects:
+            add_subject(subject_dir)
+        admit()
+
+        while running or watcher is not None:
+            finished = ()
+            if running:
+                finished, _ = wait(running, timeout=watcher and watcher.poll_seconds, return_when=FIRST_COMPLETED)
+            for future in finished:
+                subject_dir, name, estimate, gpu = running.pop(future)
+                free_mb += estimate.ram_mb
+                if gpu is not None:
+                    free_slots[gpu] += 1
+                    free_gpu_mb[gpu] += estimate.gpu_mb
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Job {name} failed for subject {subject_dir}: {e}")
+                    failed_subjects.add(subject_dir)
+                    pending[subject_dir].clear()
+                    ready[:] = [item for item in ready if item[0].subject_dir != subject_dir]
+                    continue
+                done[subject_dir].add(name)
+                queue_ready(subject_dir)
+                if not pending[subject_dir] and subject_dir not in failed_subjects and \
+                        not any(item[0].subject_dir == subject_dir for item in ready) and \
+                        not any(key[0] == subject_dir for key in running.values()):
+                    completed += 1
+                    hours = (time.perf_counter() - start) / 3600
+                    print(f"Completed subject {subject_dir} ({completed}/{len(subjects)}, "
+                          f"{completed / max(hours, 1e-9):.1f} subjects/hour)")
+            if watcher is not None:
+                # Blocks for new subjects only while nothing is running
+                arrived = watcher.ready(0 if running else watcher.poll_seconds)
+                if arrived:
+                    # Refitted so that a long-running watch learns from the runs logged since it started
+                    models = resource_model.fit_models(load_metrics(data_directory), data_directory)
+                for subject_dir in arrived:
+                    print(f"Queued subject {subject_dir}")
+                    subjects.append(subject_dir)
+                    add_subject(subject_dir)
+            admit()
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "completed": completed,
+        "failed": len(failed_subjects),
+        "seconds": elapsed,
+        "subjects_per_hour": completed / max(elapsed / 3600, 1e-9),
+    }
+    print(f"Processed {completed} subject(s), {len(failed_subjects)} failed, in {elapsed:.1f}s "
+          f"({summary['subjects_per_hour']:.1f} subjects/hour)")
+    return summary
+
+
+def main():
+    """
+    Main function to run the pipeline over all subjects in the data directory.
+    """
+    parser = argparse.ArgumentParser(description="Run the pipeline over a cohort with CPU and GPU worker pools.")
+    parser.add_argument("--data-directory", default=DATA_DIRECTORY)
+    parser.add_argument("--cpu-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--gpus", default="0", help="Comma-separated CUDA device ids, one GPU slot each.")
+    parser.add_argument("--memory-mb", type=float, default=MEMORY_BUDGET_MB or None,
+                        help="Host memory budget; defaults to MEMORY_FRACTION of the machine's memory.")
+    parser.add_argument("--gpu-memory-mb", type=float, default=GPU_MEMORY_MB,
+                        help="Memory budget of each GPU; 0 limits GPU jobs by slots only.")
+    args = parser.parse_args()
+    run_cohort(args.data_directory, args.cpu_workers, [int(gpu) for gpu in args.gpus.split(",")],
+               args.memory_mb, args.gpu_memory_mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import argparse
+import csv
+import os
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from post_probtrack import FINGERPRINT_FORMAT, load_fingerprint
+from parcellation import HEMISPHERES, list_subjects, output_dir
+
+"""
+Streams the fingerprints of a cohort into group statistics and per-subject outlier scores.
+
+Every subject and hemisphere is reduced in a worker process to the moments of each
+bundle's connectivity over its seed voxels (count, mean and sum of squared deviations,
+M2), read in batches of BATCH_SIZE rows, and to its profile: the mean fingerprint over
+its voxels. The parent merges the moments as results arrive with Chan et al.'s pairwise
+update, the parallel form of Welford's algorithm, which stays accurate where the naive
+sum of squares cancels. The profiles are merged the same way into the group mean and
+variance of the subject profiles, and appended to a scratch file.
+
+A second pass over that file scores every subject against the group profile:
+
+    rms_z          root mean square of the bundle z-scores of the subject's profile
+    max_abs_z      largest absolute bundle z-score, and the bundle it occurs in
+    correlation    Pearson correlation between the subject's profile and the group mean
+
+Nothing grows with the cohort in memory: the parent holds one set of moments per
+hemisphere and the workers one subject at a time. The outputs go to the output directory:
+
+    cohort_stats_{R|L}.npz      voxel-level count, mean and variance per bundle, and the
+                                mean and variance of the subject profiles
+    cohort_outliers_{R|L}.csv   one row of scores per subject
+
+    python cohort_stats.py --data-directory /path/to/dataset --workers 16
+"""
+
+# Define the root data directory
+DATA_DIRECTORY = "/home/test/lmq/data/HCP"
+
+# Fingerprint rows read at a time
+BATCH_SIZE = 4096
+
+# Count, mean and sum of squared deviations of a set of samples, per column
+Moments = namedtuple("Moments", ["count", "mean", "m2"])
+
+
+def batch_moments(values):
+    """
+    Computes the moments of a batch of samples with two passes over the batch.
+    Args:
+        values (np.ndarray): (n, d) samples.
+    Returns:
+        Moments: Moments of every column.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    mean = values.mean(axis=0)
+    return Moments(values.shape[0], mean, ((values - mean) ** 2).sum(axis=0))
+
+
+def merge_moments(a, b):
+    """
+    Combines the moments of two disjoint sets of samples (Chan et al.).
+    Args:
+        a (Moments): Moments of the first set, or None.
+        b (Moments): Moments of the second set, or None.
+    Returns:
+        Moments: Moments of the union.
+    """
+    if a is None or a.count == 0:
+        return b
+    if b is None or b.count == 0:
+        return a
+    count = a.count + b.count
+    delta = b.mean - a.mean
+    mean = a.mean + delta * (b.count / count)
+    m2 = a.m2 + b.m2 + delta ** 2 * (a.count * b.count / count)
+    return Moments(count, mean, m2)
+
+
+def variance(moments, ddof=1):
+    """
+    Returns the variance of every column, NaN where there are too few samples.
+    """
+    if moments is None or moments.count <= ddof:
+        return None if moments is None else np.full_like(moments.mean, np.nan)
+    return moments.m2 / (moments.count - ddof)
+
+
+def subject_moments(subject_path, hemisphere, batch_size=BATCH_SIZE):
+    """
+    Reduces one fingerprint to the moments of its bundle columns over the seed voxels.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        batch_size (int): Rows read at a time.
+    Returns:
+        tuple: Subject name, hemisphere and the Moments (None if there is no fingerprint).
+    """
+    fingerprint = load_fingerprint(output_dir(subject_path, hemisphere), hemisphere, FINGERPRINT_FORMAT)
+    if fingerprint is None:
+        return os.path.basename(subject_path), hemisphere, None
+    moments = None
+    for start in range(0, fingerprint.shape[0], batch_size):
+        stop = start + batch_size
+        block = fingerprint.rows(start, stop) if hasattr(fingerprint, 'rows') else fingerprint[start:stop]
+        moments = merge_moments(moments, batch_moments(block.toarray()))
+    return os.path.basename(subject_path), hemisphere, moments
+
+
+def outlier_scores(profile, group_mean, group_std):
+    """
+    Scores a subject's profile against the group.
+    Args:
+        profile (np.ndarray): Mean fingerprint of the subject.
+        group_mean (np.ndarray): Mean of the subject profiles.
+        group_std (np.ndarray): Standard deviation of the subject profiles.
+    Returns:
+        dict: rms_z, max_abs_z, max_z_bundle and correlation.
+    """
+    z = np.divide(profile - group_mean, group_std, out=np.zeros_like(profile), where=group_std > 0)
+    worst = int(np.abs(z).argmax())
+    if profile.std() > 0 and group_mean.std() > 0:
+        correlation = float(np.corrcoef(profile, group_mean)[0, 1])
+    else:
+        correlation = float('nan')
+    return {"rms_z": float(np.sqrt((z ** 2).mean())), "max_abs_z": float(abs(z[worst])),
+            "max_z_bundle": worst, "correlation": correlation}
+
+
+def aggregate(data_directory, output_directory=None, workers=None):
+    """
+    Computes the group statistics and outlier scores of every hemisphere of a cohort.
+    Args:
+        data_directory (str): The root directory containing all subject data.
+        output_directory (str): Where to write the results; defaults to the data directory.
+        workers (int): Number of processes reading fingerprints.
+    Returns:
+        dict: Hemisphere -> number of subjects aggregated.
+    """
+    output_directory = output_directory or data_directory
+    os.makedirs(output_directory, exist_ok=True)
+    subject_paths = list_subjects(data_directory)
+    voxels = {hemisphere: None for hemisphere in HEMISPHERES}
+    profiles = {hemisphere: None for hemisphere in HEMISPHERES}
+    with tempfile.TemporaryDirectory(dir=output_directory) as scratch:
+        scratch_files = {hemisphere: open(os.path.join(scratch, f"profiles_{hemisphere}.csv"), "w", newline="")
+                         for hemisphere in HEMISPHERES}
+        try:
+            writers = {hemisphere: csv.writer(f) for hemisphere, f in scratch_files.items()}
+            tasks = [(path, hemisphere) for path in subject_paths for hemisphere in HEMISPHERES]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for subject, hemisphere, moments in pool.map(subject_moments, *zip(*tasks), chunksize=4):
+                    if moments is None:
+                        continue
+                    voxels[hemisphere] = merge_moments(voxels[hemisphere], moments)
+                    profiles[hemisphere] = merge_moments(profiles[hemisphere], Moments(1, moments.mean, 0.0))
+                    writers[hemisphere].writerow([subject, moments.count] + moments.mean.tolist())
+        finally:
+            for f in scratch_files.values():
+                f.close()
+
+        counts = {}
+        for hemisphere in HEMISPHERES:
+            counts[hemisphere] = 0 if profiles[hemisphere] is None else profiles[hemisphere].count
+            if not counts[hemisphere]:
+                print(f"No fingerprints found for hemisphere {hemisphere}")
+                continue
+            write_results(output_directory, hemisphere, voxels[hemisphere], profiles[hemisphere],
+                          os.path.join(scratch, f"profiles_{hemisphere}.csv"))
+    return counts
+
+
+def write_results(output_directory, hemisphere, voxels, profiles, profile_file):
+    """
+    Writes the group statistics of a hemisphere and scores its subjects, reading the
+    subject profiles back one line at a time.
+    Args:
+        output_directory (str): Where to write the results.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        voxels (Moments): Voxel-level moments of the cohort.
+        profiles (Moments): Moments of the subject profiles.
+        profile_file (str): Scratch file of subject profiles.
+    """
+    profile_variance = variance(profiles)
+    stats_file = os.path.join(output_directory, f"cohort_stats_{hemisphere}.npz")
+    np.savez(stats_file, voxel_count=voxels.count, voxel_mean=voxels.mean, voxel_variance=variance(voxels),
+             subject_count=profiles.count, profile_mean=profiles.mean, profile_variance=profile_variance)
+    print(f"Saved cohort statistics ({profiles.count} subjects, {voxels.count} voxels): {stats_file}")
+
+    group_std = np.sqrt(np.nan_to_num(profile_variance))
+    outlier_file = os.path.join(output_directory, f"cohort_outliers_{hemisphere}.csv")
+    with open(profile_file, newline="") as f, open(outlier_file, "w", newline="") as out:
+        writer = csv.DictWriter(out, fieldnames=["subject", "n_voxels", "rms_z", "max_abs_z", "max_z_bundle", "correlation"])
+        writer.writeheader()
+        for record in csv.reader(f):
+            profile = np.array(record[2:], dtype=np.float64)
+            writer.writerow(dict(subject=record[0], n_voxels=int(record[1]),
+                                 **outlier_scores(profile, profiles.mean, group_std)))
+    print(f"Saved outlier scores: {outlier_file}")
+
+
+def main():
+    """
+    Main function to aggregate the fingerprints of all subjects.
+    """
+    parser = argparse.ArgumentParser(description="Stream cohort statistics and outlier scores from the fingerprints.")
+    parser.add_argument("--data-directory", default=DATA_DIRECTORY)
+    parser.add_argument("--output-directory", default=None, help="Defaults to the data directory.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    aggregate(args.data_directory, args.output_directory, args.workers)
+
+
+if __name__ == "__main__":
+    main()
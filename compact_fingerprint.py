@@ -0,0 +1,414 @@
+import argparse
+import json
+import os
+import numpy as np
+import scipy.sparse as sparse
+from pathlib import Path
+from seed_index import lookup_rows, lookup_volume
+
+"""
+Compact, lazily readable storage for fiber fingerprints.
+
+`get_fiber_fingerprint` produces float64 fingerprints, 8 bytes per value, saved in a zip
+that has to be inflated whole before any of it can be read. This layout stores a
+fingerprint as a directory of uncompressed arrays, in column-major (CSC) order so that
+one bundle is a contiguous slice:
+
+    finger_print_fiber_R_compact/
+        header.json    {"format": "compact_fingerprint", "shape": [...], "dtype": ..., errors, ...}
+        indptr.npy     start of each bundle column, int64
+        indices.npy    seed row of every value, sorted within each column; uint16 when
+                       there are at most 65536 seeds, as at 3mm, int32 otherwise
+        data.npy       the values, float32 or uint16
+        scale.npy      per-bundle scale of uint16 values (1 for float32)
+        coords.npy     (n_seeds, 3) int16 voxel coordinates of the rows, when known
+
+The arrays are memory-mapped when opened, so reading one bundle only reads that column,
+and reading a set of voxels only reads the pages its binary searches touch.
+
+Precision, against the float64 fingerprint:
+
+    float32   every value is rounded to 24 significant bits: relative error <= 2**-24 (6e-8)
+    uint16    value = q * scale_j with scale_j = max of bundle j / 65535, so the absolute
+              error is <= scale_j / 2, i.e. <= 7.6e-6 of the bundle's largest value.
+              Values below scale_j / 2 round to zero and are dropped.
+
+`save_compact` measures the actual error against the float64 input, records it in the
+header and raises if it exceeds these bounds. Fingerprints must be non-negative, which
+all normalizations in post_probtrack produce.
+
+    python compact_fingerprint.py convert finger_print_fiber_R.npz --dtype uint16 [--coords coords_for_fdt_matrix2]
+    python compact_fingerprint.py check finger_print_fiber_R.npz finger_print_fiber_R_compact
+"""
+
+HEADER_FILE = 'header.json'
+ARRAY_FILES = ('indptr.npy', 'indices.npy', 'data.npy', 'scale.npy')
+COORDS_FILE = 'coords.npy'
+FORMAT_VERSION = 1
+
+QUANTIZATIONS = ('float32', 'uint16')
+
+# Largest uint16 code; scale_j maps it to the largest value of bundle j
+UINT16_MAX = np.iinfo(np.uint16).max
+
+
+def compact_files(path):
+    """
+    Lists the files making up a compact fingerprint, without the optional coordinates.
+
+    Args:
+        path (Path): Directory of the compact fingerprint.
+
+    Returns:
+        list: Paths of the files.
+    """
+    path = Path(path)
+    return [path / HEADER_FILE] + [path / name for name in ARRAY_FILES]
+
+
+def quantize(fp, dtype):
+    """
+    Quantizes a fingerprint column by column.
+
+    Args:
+        fp (sparse matrix): Non-negative seed x bundle fingerprint.
+        dtype (str): 'float32' or 'uint16'.
+
+    Returns:
+        tuple: CSC matrix of quantized values (explicit zeros removed) and the per-bundle scale.
+    """
+    if dtype not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {dtype!r}; expected one of {QUANTIZATIONS}.")
+    csc = sparse.csc_matrix(fp, dtype=np.float64)
+    csc.sum_duplicates()
+    if csc.nnz and csc.data.min() < 0:
+        raise ValueError("Only non-negative fingerprints can be quantized.")
+    if dtype == 'float32':
+        scale = np.ones(csc.shape[1])
+        data = csc.data.astype(np.float32)
+    else:
+        column_max = np.zeros(csc.shape[1])
+        nonempty = np.diff(csc.indptr) > 0
+        column_max[nonempty] = np.maximum.reduceat(csc.data, csc.indptr[:-1][nonempty]) if csc.nnz else 0.0
+        scale = np.where(column_max > 0, column_max / UINT16_MAX, 1.0)
+        columns = np.repeat(np.arange(csc.shape[1]), np.diff(csc.indptr))
+        data = np.rint(csc.data / scale[columns]).astype(np.uint16)
+    quantized = sparse.csc_matrix((data, csc.indices.copy(), csc.indptr.copy()), shape=csc.shape)
+    quantized.eliminate_zeros()
+    return quantized, scale
+
+
+def dequantize(quantized, scale):
+    """
+    Converts quantized values back to float64.
+
+    Args:
+        quantized (scipy.sparse.csc_matrix): Quantized values.
+        scale (np.ndarray): Per-bundle scale.
+
+    Returns:
+        scipy.sparse.csc_matrix: The fingerprint in float64.
+    """
+    columns = np.repeat(np.arange(quantized.shape[1]), np.diff(quantized.indptr))
+    data = quantized.data.astype(np.float64) * scale[columns]
+    return sparse.csc_matrix((data, quantized.indices, quantized.indptr), shape=quantized.shape)
+
+
+def error_bound(fp, scale, dtype):
+    """
+    Returns the largest error the quantization may introduce in each bundle.
+
+    Args:
+        fp (scipy.sparse.csc_matrix): float64 fingerprint.
+        scale (np.ndarray): Per-bundle scale.
+        dtype (str): 'float32' or 'uint16'.
+
+    Returns:
+        np.ndarray: Bound on the absolute error of every bundle.
+    """
+    if dtype == 'uint16':
+        return scale / 2
+    column_max = abs(fp).max(axis=0).toarray().ravel()
+    return column_max * 2.0 ** -24
+
+
+def _write_arrays(path, quantized, scale, seed_coords, header):
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    if (path / HEADER_FILE).exists():
+        os.remove(path / HEADER_FILE)
+    np.save(path / 'indptr.npy', quantized.indptr.astype(np.int64))
+    index_dtype = np.uint16 if quantized.shape[0] <= UINT16_MAX + 1 else np.int32
+    np.save(path / 'indices.npy', quantized.indices.astype(index_dtype))
+    np.save(path / 'data.npy', quantized.data)
+    np.save(path / 'scale.npy', np.asarray(scale, dtype=np.float64))
+    if seed_coords is not None:
+        if len(seed_coords) != quantized.shape[0]:
+            raise ValueError(f"{len(seed_coords)} seed coordinates for {quantized.shape[0]} fingerprint rows.")
+        np.save(path / COORDS_FILE, np.asarray(seed_coords, dtype=np.int16))
+    elif (path / COORDS_FILE).exists():
+        os.remove(path / COORDS_FILE)
+    header = dict(header, format='compact_fingerprint', version=FORMAT_VERSION, shape=list(quantized.shape),
+                  nnz=int(quantized.nnz), dtype=str(quantized.data.dtype))
+    # Written last, so that a complete header marks a complete fingerprint
+    with open(path / HEADER_FILE, 'w') as f:
+        json.dump(header, f, indent=1)
+
+
+def save_compact(path, fp, dtype='uint16', seed_coords=None):
+    """
+    Quantizes a fingerprint, checks its precision against the float64 input and saves it.
+
+    Args:
+        path (Path): Directory to write the fingerprint to.
+        fp (sparse matrix): float64 seed x bundle fingerprint.
+        dtype (str): 'float32' or 'uint16'.
+        seed_coords (np.ndarray): (n_seeds, 3) voxel coordinates of the rows, if known.
+
+    Returns:
+        dict: The header, with the measured maximum absolute error and the maximum error
+        relative to each bundle's largest value.
+    """
+    fp = sparse.csc_matrix(fp, dtype=np.float64)
+    quantized, scale = quantize(fp, dtype)
+    error = abs(dequantize(quantized, scale) - fp).tocsc()
+    column_error = error.max(axis=0).toarray().ravel()
+    bound = error_bound(fp, scale, dtype)
+    # The bounds are exact in real arithmetic; allow for the rounding of the check itself
+    if np.any(column_error > bound * (1 + 1e-9) + 1e-300):
+        raise ValueError(f"{dtype} quantization exceeds its error bound: {column_error.max():.3g}.")
+    column_max = abs(fp).max(axis=0).toarray().ravel()
+    relative = np.divide(column_error, column_max, out=np.zeros_like(column_error), where=column_max > 0)
+    header = {'max_abs_error': float(column_error.max(initial=0.0)),
+              'max_rel_error': float(relative.max(initial=0.0))}
+    _write_arrays(path, quantized, scale, seed_coords, header)
+    return dict(header, shape=list(fp.shape), dtype=dtype)
+
+
+class CompactFingerprint:
+    """
+    Read-only compact fingerprint whose arrays stay on disk until they are touched. It
+    offers the `shape`, `rows` and `to_csr` of sparse_store.LazyCSR, so it can stand in
+    for a fingerprint anywhere one is streamed by rows.
+
+    Args:
+        path (Path): Directory of the compact fingerprint.
+        mmap_mode (str): Passed to `np.load`; None reads the arrays into memory.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = Path(path)
+        with open(self.path / HEADER_FILE) as f:
+            self.header = json.load(f)
+        if self.header.get('format') != 'compact_fingerprint' or self.header.get('version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact fingerprint header in {self.path}: {self.header}")
+        self.shape = tuple(self.header['shape'])
+        self.nnz = self.header['nnz']
+        self.dtype = np.dtype(np.float64)
+        self.indptr, self.indices, self.data, self.scale = (
+            np.load(self.path / name, mmap_mode=mmap_mode) for name in ARRAY_FILES
+        )
+        self._lookup = None
+
+    @property
+    def seed_coords(self):
+        """
+        Voxel coordinates of the rows, or None if they were not saved.
+        """
+        coords_file = self.path / COORDS_FILE
+        return np.load(coords_file).astype(np.int64) if coords_file.exists() else None
+
+    def column(self, bundle):
+        """
+        Decodes one bundle column.
+
+        Args:
+            bundle (int): Bundle index.
+
+        Returns:
+            np.ndarray: Dense float64 values of every seed.
+        """
+        begin, end = self.indptr[bundle], self.indptr[bundle + 1]
+        values = np.zeros(self.shape[0])
+        values[np.asarray(self.indices[begin:end])] = np.asarray(self.data[begin:end], dtype=np.float64) * self.scale[bundle]
+        return values
+
+    def _row_positions(self, rows):
+        """
+        Finds the stored values of a set of rows, column by column.
+
+        Returns:
+            tuple: Output row, column and position in the data array of every value found.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        out_rows, out_cols, positions = [], [], []
+        for bundle in range(self.shape[1]):
+            begin, end = self.indptr[bundle], self.indptr[bundle + 1]
+            column_rows = self.indices[begin:end]
+            found = np.searchsorted(column_rows, rows)
+            hit = found < (end - begin)
+            hit[hit] = column_rows[found[hit]] == rows[hit]
+            out_rows.append(np.flatnonzero(hit))
+            out_cols.append(np.full(int(hit.sum()), bundle))
+            positions.append(begin + found[hit])
+        return np.concatenate(out_rows), np.concatenate(out_cols), np.concatenate(positions)
+
+    def voxels(self, rows=None, coords=None):
+        """
+        Decodes the fingerprints of a set of seeds, given by row or by voxel coordinates.
+
+        Args:
+            rows (array-like): Row indices.
+            coords (np.ndarray): (k, 3) voxel coordinates, looked up in the saved seed coordinates.
+
+        Returns:
+            np.ndarray: Dense (k, n_bundles) float64 fingerprints.
+        """
+        if coords is not None:
+            rows = self.rows_of(coords)
+        rows = np.asarray(rows, dtype=np.int64)
+        out_rows, out_cols, positions = self._row_positions(rows)
+        values = np.zeros((len(rows), self.shape[1]))
+        values[out_rows, out_cols] = np.asarray(self.data[positions], dtype=np.float64) * self.scale[out_cols]
+        return values
+
+    def rows_of(self, coords):
+        """
+        Returns the row of every voxel coordinate.
+
+        Args:
+            coords (np.ndarray): (k, 3) voxel coordinates.
+
+        Returns:
+            np.ndarray: Row indices.
+        """
+        if self._lookup is None:
+            seed_coords = self.seed_coords
+            if seed_coords is None:
+                raise ValueError(f"{self.path} has no seed coordinates.")
+            # Built once, over the bounding box of the seeds
+            self._lookup = lookup_volume(seed_coords, seed_coords.max(axis=0, initial=0) + 1)
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        rows = lookup_rows(self._lookup, coords)
+        if (rows < 0).any():
+            raise ValueError(f"Voxel {coords[rows < 0][0].tolist()} is not a seed of {self.path}.")
+        return rows
+
+    def rows(self, start, stop):
+        """
+        Decodes a contiguous block of rows.
+
+        Args:
+            start (int): First row.
+            stop (int): Row after the last one.
+
+        Returns:
+            scipy.sparse.csr_matrix: The rows in float64.
+        """
+        stop = min(stop, self.shape[0])
+        pieces, columns = [], []
+        for bundle in range(self.shape[1]):
+            begin, end = self.indptr[bundle], self.indptr[bundle + 1]
+            column_rows = self.indices[begin:end]
+            first, last = begin + np.searchsorted(column_rows, [start, stop])
+            pieces.append(np.arange(first, last))
+            columns.append(np.full(last - first, bundle))
+        positions, columns = np.concatenate(pieces), np.concatenate(columns)
+        values = np.asarray(self.data[positions], dtype=np.float64) * self.scale[columns]
+        block = sparse.coo_matrix((values, (np.asarray(self.indices[positions]) - start, columns)),
+                                  shape=(stop - start, self.shape[1]))
+        return block.tocsr()
+
+    def to_csr(self):
+        """
+        Decodes the whole fingerprint.
+
+        Returns:
+            scipy.sparse.csr_matrix: The fingerprint in float64.
+        """
+        quantized = sparse.csc_matrix((np.asarray(self.data), np.asarray(self.indices), np.asarray(self.indptr)),
+                                      shape=self.shape)
+        return dequantize(quantized, np.asarray(self.scale)).tocsr()
+
+    def save_rows(self, path, rows, seed_coords=None):
+        """
+        Saves a subset of the rows as a compact fingerprint, keeping the quantized values
+        and per-bundle scales as they are, so that no further precision is lost.
+
+        Args:
+            path (Path): Directory to write the subset to.
+            rows (array-like): Row indices, in their order in the subset.
+            seed_coords (np.ndarray): Voxel coordinates of the subset's rows.
+        """
+        quantized = sparse.csc_matrix((np.asarray(self.data), np.asarray(self.indices), np.asarray(self.indptr)),
+                                      shape=self.shape)
+        header = {key: self.header[key] for key in ('max_abs_error', 'max_rel_error') if key in self.header}
+        subset = quantized[np.asarray(rows, dtype=np.int64)].tocsc()
+        subset.sort_indices()
+        _write_arrays(path, subset, self.scale, seed_coords, header)
+
+
+def open_compact(path, mmap_mode='r'):
+    """
+    Opens a compact fingerprint.
+
+    Args:
+        path (Path): Directory of the compact fingerprint.
+        mmap_mode (str): Passed to `np.load`.
+
+    Returns:
+        CompactFingerprint: The fingerprint.
+    """
+    return CompactFingerprint(path, mmap_mode)
+
+
+def compare(reference, compact):
+    """
+    Compares a compact fingerprint with its float64 original.
+
+    Args:
+        reference (sparse matrix): float64 fingerprint.
+        compact (CompactFingerprint): The compact fingerprint.
+
+    Returns:
+        dict: Maximum absolute error and maximum error relative to each bundle's largest value.
+    """
+    reference = sparse.csc_matrix(reference, dtype=np.float64)
+    error = abs(compact.to_csr() - reference).tocsc()
+    column_error = error.max(axis=0).toarray().ravel()
+    column_max = abs(reference).max(axis=0).toarray().ravel()
+    relative = np.divide(column_error, column_max, out=np.zeros_like(column_error), where=column_max > 0)
+    return {'max_abs_error': float(column_error.max(initial=0.0)), 'max_rel_error': float(relative.max(initial=0.0))}
+
+
+def main():
+    """
+    Converts NPZ fingerprints to the compact layout, or checks a compact fingerprint
+    against its NPZ original.
+    """
+    parser = argparse.ArgumentParser(description="Convert fingerprints to the compact layout or check its precision.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert')
+    convert.add_argument('npz_files', nargs='+')
+    convert.add_argument('--dtype', choices=QUANTIZATIONS, default='uint16')
+    convert.add_argument('--coords', default=None, help="probtrackx coords_for_fdt_matrix2 of the rows.")
+    check = subparsers.add_parser('check')
+    check.add_argument('npz_file')
+    check.add_argument('compact_dir')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        seed_coords = np.loadtxt(args.coords, dtype=np.int64, ndmin=2)[:, :3] if args.coords else None
+        for npz_file in args.npz_files:
+            npz_file = Path(npz_file)
+            out_dir = npz_file.with_name(f'{npz_file.stem}_compact')
+            header = save_compact(out_dir, sparse.load_npz(npz_file), args.dtype, seed_coords)
+            size = sum(path.stat().st_size for path in out_dir.iterdir())
+            print(f"{npz_file} -> {out_dir}: {npz_file.stat().st_size / 1e6:.2f} MB -> {size / 1e6:.2f} MB, "
+                  f"max error {header['max_abs_error']:.3g} ({header['max_rel_error']:.3g} of the bundle maximum)")
+    else:
+        print(json.dumps(compare(sparse.load_npz(args.npz_file), open_compact(args.compact_dir)), indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+from parcellation import HEMISPHERES, list_subjects, output_dir
+from post_probtrack import (FINGERPRINT_FORMAT, fingerprint_files, load_fingerprint, roi_coords_file,
+                            seed_index_file, write_seed_index)
+from seed_index import load_seed_index
+from seed_shards import SEED_COORDS_FILE, read_coords
+from volume_cache import save_volume
+
+"""
+Projects fingerprints back into the seed voxels they were tracked from.
+
+The fingerprint of a hemisphere holds one row per seed voxel and one column per bundle.
+Through its seed index (see seed_index), saved next to it by get_fiber_fingerprint, it is
+scattered into a 4D volume on the seed mask's grid with one channel per bundle, 72 for
+TractSeg, and zero outside the seeds:
+
+    probtrackx_{R|L}_omatrix2/finger_print_fiber_{R|L}[_<roi>].nii.gz    float32
+
+The rows are read BATCH_SIZE at a time, in any fingerprint layout, and every batch is
+written into the volume with one vectorized assignment. The fingerprint of single voxels
+is read through the index's lookup volume without projecting the rest.
+
+Fingerprints saved before the seed index existed get theirs from coords_for_fdt_matrix2
+(or the coordinate file of their ROI) on first use. A volume newer than its fingerprint
+and index is not rewritten.
+
+    python fingerprint_volume.py export --data-directory /path/to/dataset --workers 16
+    python fingerprint_volume.py lookup /path/to/dataset/100307 R 20 31 25
+"""
+
+# Define the root data directory
+DATA_DIRECTORY = "/home/test/lmq/data/HCP"
+
+# Fingerprint rows scattered at a time
+BATCH_SIZE = 65536
+
+
+def volume_path(subject_path, hemisphere, roi=None, output_directory=None):
+    """
+    Returns the path of a fingerprint volume.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        roi (str): Seed ROI of a multi-ROI run, for the fingerprint of its rows only.
+        output_directory (str): Directory collecting the volumes of the cohort, named
+            after their subject; None writes them next to the fingerprints.
+    Returns:
+        Path or str: Path of the volume.
+    """
+    name = f'finger_print_fiber_{hemisphere}' if roi is None else f'finger_print_fiber_{hemisphere}_{roi}'
+    if output_directory is not None:
+        return os.path.join(output_directory, f'{os.path.basename(subject_path)}_{name}.nii.gz')
+    return output_dir(subject_path, hemisphere) / f'{name}.nii.gz'
+
+
+def fingerprint_index(subject_path, hemisphere, roi=None):
+    """
+    Loads the seed index of a fingerprint, creating it from the probtrackx coordinate file
+    if it is missing.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        roi (str): Seed ROI of a multi-ROI run.
+    Returns:
+        SeedIndex: The index, or None if there are no seed coordinates.
+    """
+    out_dir = output_dir(subject_path, hemisphere)
+    index_file = seed_index_file(out_dir, hemisphere, roi)
+    if not index_file.exists():
+        coords_file = out_dir / SEED_COORDS_FILE if roi is None else roi_coords_file(out_dir, roi)
+        if not coords_file.exists():
+            return None
+        write_seed_index(subject_path, hemisphere, read_coords(coords_file), roi)
+    return load_seed_index(index_file)
+
+
+def project_fingerprint(fingerprint, index, batch_size=BATCH_SIZE):
+    """
+    Scatters a fingerprint into a 4D volume with one channel per bundle.
+    Args:
+        fingerprint (sparse matrix, LazyCSR or CompactFingerprint): seed x bundle fingerprint.
+        index (SeedIndex): Seed index of its rows.
+        batch_size (int): Rows read at a time.
+    Returns:
+        np.ndarray: float32 volume of shape index.shape + (n_bundles,).
+    """
+    if fingerprint.shape[0] != len(index):
+        raise ValueError(f"{fingerprint.shape[0]} fingerprint rows but {len(index)} seeds in the index.")
+    volume = np.zeros(index.shape + (fingerprint.shape[1],), dtype=np.float32)
+    # One row of `flat` per voxel of the grid
+    flat = volume.reshape(-1, fingerprint.shape[1])
+    voxels = index.voxel_indices()
+    for start in range(0, fingerprint.shape[0], batch_size):
+        stop = start + batch_size
+        block = fingerprint.rows(start, stop) if hasattr(fingerprint, 'rows') else fingerprint[start:stop]
+        block = block.tocoo()
+        flat[voxels[start + block.row], block.col] = block.data
+    return volume
+
+
+def voxel_fingerprints(subject_path, hemisphere, coords, roi=None):
+    """
+    Reads the fingerprints of a set of seed voxels.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        coords (array-like): (k, 3) voxel coordinates in the seed mask's grid.
+        roi (str): Seed ROI of a multi-ROI run.
+    Returns:
+        np.ndarray: Dense (k, n_bundles) fingerprints.
+    """
+    fingerprint = load_fingerprint(output_dir(subject_path, hemisphere), hemisphere, FINGERPRINT_FORMAT, roi)
+    index = fingerprint_index(subject_path, hemisphere, roi)
+    if fingerprint is None or index is None:
+        raise ValueError(f"Missing fingerprint or seed coordinates for {hemisphere}: {subject_path}")
+    rows = index.rows_of(coords)
+    if hasattr(fingerprint, 'voxels'):
+        return fingerprint.voxels(rows)
+    if hasattr(fingerprint, 'to_csr'):
+        fingerprint = fingerprint.to_csr()
+    return fingerprint[rows].toarray()
+
+
+def export_subject(subject_path, hemisphere, roi=None, output_directory=None, overwrite=False):
+    """
+    Writes the fingerprint volume of one subject's hemisphere.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        roi (str): Seed ROI of a multi-ROI run.
+        output_directory (str): See volume_path.
+        overwrite (bool): Rewrite the volume even if it is newer than the fingerprint.
+    Returns:
+        bool: True if the volume was written or is up to date.
+    """
+    out_dir = output_dir(subject_path, hemisphere)
+    fingerprint = load_fingerprint(out_dir, hemisphere, FINGERPRINT_FORMAT, roi)
+    index = fingerprint_index(subject_path, hemisphere, roi)
+    if fingerprint is None or index is None:
+        print(f"Missing fingerprint or seed coordinates for {hemisphere}: {subject_path}")
+        return False
+    path = volume_path(subject_path, hemisphere, roi, output_directory)
+    sources = [file for fmt in ('npz', 'csr', 'compact') for file in fingerprint_files(out_dir, hemisphere, fmt, roi)
+               if file.exists()] + [seed_index_file(out_dir, hemisphere, roi)]
+    if not overwrite and os.path.exists(path) and \
+            os.path.getmtime(path) >= max(os.path.getmtime(source) for source in sources):
+        print(f"Fingerprint volume already up to date: {path}")
+        return True
+    volume = project_fingerprint(fingerprint, index)
+    img = nib.Nifti1Image(volume, index.affine)
+    img.header.set_data_dtype(np.float32)
+    save_volume(img, str(path))
+    print(f"Saved fingerprint volume ({len(index)} seeds, {volume.shape[-1]} bundles): {path}")
+    return True
+
+
+def export_cohort(data_directory, roi=None, output_directory=None, workers=None, overwrite=False):
+    """
+    Writes the fingerprint volumes of every subject and hemisphere, in a process pool.
+    Args:
+        data_directory (str): The root directory containing all subject data.
+        roi (str): Seed ROI of a multi-ROI run.
+        output_directory (str): See volume_path.
+        workers (int): Number of processes.
+        overwrite (bool): Rewrite volumes that are up to date.
+    Returns:
+        int: Number of volumes written or up to date.
+    """
+    if output_directory is not None:
+        os.makedirs(output_directory, exist_ok=True)
+    tasks = [(subject_path, hemisphere) for subject_path in list_subjects(data_directory) for hemisphere in HEMISPHERES]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(export_subject, *zip(*tasks), [roi] * len(tasks), [output_directory] * len(tasks),
+                           [overwrite] * len(tasks))
+        return sum(results)
+
+
+def main():
+    """
+    Exports the fingerprint volumes of a cohort, or prints the fingerprint of one voxel.
+    """
+    parser = argparse.ArgumentParser(description="Project fingerprints into 4D volumes or look up single voxels.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export = subparsers.add_parser('export')
+    export.add_argument('--data-directory', default=DATA_DIRECTORY)
+    export.add_argument('--output-directory', default=None, help="Defaults to each fingerprint's directory.")
+    export.add_argument('--roi', default=None, help="Seed ROI of a multi-ROI run.")
+    export.add_argument('--workers', type=int, default=os.cpu_count())
+    export.add_argument('--overwrite', action='store_true')
+    lookup = subparsers.add_parser('lookup')
+    lookup.add_argument('subject_path')
+    lookup.add_argument('hemisphere', choices=sorted(HEMISPHERES))
+    lookup.add_argument('voxel', type=int, nargs=3, metavar=('x', 'y', 'z'))
+    lookup.add_argument('--roi', default=None, help="Seed ROI of a multi-ROI run.")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        count = export_cohort(args.data_directory, args.roi, args.output_directory, args.workers, args.overwrite)
+        print(f"Exported {count} fingerprint volume(s)")
+    else:
+        values = voxel_fingerprints(args.subject_path, args.hemisphere, [args.voxel], args.roi)[0]
+        for bundle in np.flatnonzero(values):
+            print(f"{bundle:3d}  {values[bundle]:.6g}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import os
-import subprocess
+from instrumentation import track_stage
+from pipeline_state import StageSpec, is_up_to_date, record_stage
+from resample import resample_iso
 
 """
 This script performs the following operations:
@@ -25,56 +27,68 @@ The "T1" folder must contain:
 # Define the root directory for HCP data
 DATA_DIRECTORY = "/home/test/lmq/data/HCP"
 
-def run_flirt(input_path, ref_path, output_path, resolution):
+def run_flirt(input_path, ref_path, output_paths, resolution):
     """
-    Wrapper function for the FSL flirt command to perform image resampling.
+    Resamples an image to an isotropic resolution, equivalent to
+    `flirt -applyisoxfm <resolution> -interp nearestneighbour`.
     Args:
         input_path (str): Path to the input NIfTI file.
         ref_path (str): Path to the reference NIfTI file.
-        output_path (str): Path to save the output NIfTI file.
+        output_paths (str or list): Path, or paths, to save the output NIfTI file to.
         resolution (float): Isotropic resolution for the output.
     """
     try:
-        command = [
-            "flirt", 
-            "-ref", ref_path,
-            "-in", input_path,
-            "-o", output_path,
-            "-applyisoxfm", str(resolution),
-            "-interp", "nearestneighbour"
-        ]
-        subprocess.run(command, check=True)
-        print(f"Generated {output_path} at {resolution}mm resolution.")
-    except subprocess.CalledProcessError as e:
-        print(f"Error running flirt for {output_path}: {e}")
+        resample_iso(input_path, ref_path, output_paths, resolution)
+    except (OSError, ValueError) as e:
+        print(f"Error resampling {input_path}: {e}")
 
-def process_subject(subject_path):
+def stage_spec(subject_path):
     """
-    Process a single subject's data for T1 downsampling and DTI mask generation.
+    Declares the inputs, outputs and parameters of the mask generation stage.
     Args:
         subject_path (str): Path to the subject's folder.
+    Returns:
+        StageSpec: Declaration of the stage.
     """
     dti_dir = os.path.join(subject_path, "DTI")
     t1_dir = os.path.join(subject_path, "T1")
+    return StageSpec(
+        name="masks",
+        inputs=[os.path.join(t1_dir, "T1w_acpc_dc_restore_brain.nii.gz")],
+        outputs=[
+            os.path.join(t1_dir, "T1_1mm.nii.gz"),
+            os.path.join(t1_dir, "T1_3mm.nii.gz"),
+            os.path.join(dti_dir, "LowResMask.nii.gz"),
+        ],
+        params={"resolutions": [1, 3], "interp": "nearestneighbour"},
+    )
+
+def process_subject(subject_path):
+    """
+    Process a single subject's data for T1 downsampling and DTI mask generation.
+    Args:
+        subject_path (str): Path to the subject's folder.
+    Returns:
+        bool: True if the stage is up to date, either already or after this run.
+    """
+    spec = stage_spec(subject_path)
 
     # Check if processing is needed
-    if not os.path.exists(os.path.join(dti_dir, "nodif_brain.nii.gz")):
+    if not is_up_to_date(subject_path, spec):
         print(f"Processing subject: {os.path.basename(subject_path)}")
         
         # Define paths for T1 files
-        t1_input = os.path.join(t1_dir, "T1w_acpc_dc_restore_brain.nii.gz")
-        t1_1mm_output = os.path.join(t1_dir, "T1_1mm.nii.gz")
-        t1_3mm_output = os.path.join(t1_dir, "T1_3mm.nii.gz")
-        low_res_mask_output = os.path.join(dti_dir, "LowResMask.nii.gz")
-        
-        # Generate T1 downsampled images
-        run_flirt(t1_input, t1_input, t1_1mm_output, 1)
-        run_flirt(t1_input, t1_input, t1_3mm_output, 3)
+        t1_input = spec.inputs[0]
+        t1_1mm_output, t1_3mm_output, low_res_mask_output = spec.outputs
         
-        # Generate low-resolution mask
-        run_flirt(t1_input, t1_input, low_res_mask_output, 3)
+        # Generate T1 downsampled images; the low-resolution mask is the same 3mm image
+        with track_stage(subject_path, spec.name, "resample"):
+            run_flirt(t1_input, t1_input, t1_1mm_output, 1)
+            run_flirt(t1_input, t1_input, [t1_3mm_output, low_res_mask_output], 3)
+        return record_stage(subject_path, spec)
     else:
         print(f"Subject {os.path.basename(subject_path)} already processed. Skipping.")
+        return True
 
 def main():
     """
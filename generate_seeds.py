@@ -1,9 +1,17 @@
 import os
-import subprocess
+import numpy as np
+import nibabel as nib
+from instrumentation import track_stage
+from pipeline_state import StageSpec, is_up_to_date, record_stage
+from volume_cache import load_volume, save_volume
+from resample import resample_iso
+from run_probtrack import PROBTRACK_SEED_ROIS
 
 """
 This script processes anatomical masks for T1-weighted images, including generating
-masks for striatum, cortex, and white matter, followed by resampling them to 3mm resolution.
+masks for striatum, cortex and white matter, and for the other subcortical seed ROIs
+(thalamus, pallidum, amygdala) that run_probtrack.PROBTRACK_SEED_ROIS tracks, followed
+by resampling them to 3mm resolution.
 
 Label values used for segmentation are based on:
 https://surfer.nmr.mgh.harvard.edu/fswiki/FsTutorial/AnatomicalROI/FreeSurferColorLUT
@@ -14,127 +22,190 @@ Prerequisites:
     - wmparc.nii.gz (segmentation file).
 
 Outputs:
-- Segmented masks (striatum, cortex, white matter) for left, right, and full regions.
+- Segmented masks (striatum, cortex, white matter, and any further seed ROIs) for left,
+  right, and full regions.
+  All masks are generated in a single lookup-table pass over wmparc (see mask_label_sets).
 - 3mm resampled versions of these masks.
 """
 
 # Define the root directory for HCP data
 DATA_DIRECTORY = "/home/test/lmq/data/HCP"
 
+# Inclusive FreeSurfer label ranges for each ROI and hemisphere. Add an entry here to
+# generate masks for a new ROI; all ROIs are extracted in the same pass over wmparc.
+MASK_LABELS = {
+    "striatum": {"left": [(11, 12)], "right": [(50, 51)]},
+    "cortex": {"left": [(1000, 1035)], "right": [(2000, 2035)]},
+    "white": {"left": [(3001, 3035), (5001, 5001)], "right": [(4001, 4035), (5002, 5002)]},
+}
 
-def run_command(command):
+# Label ranges of further seed ROIs for multi-ROI tractography. Their masks are only
+# generated when run_probtrack.PROBTRACK_SEED_ROIS lists them.
+SEED_ROI_LABELS = {
+    "thalamus": {"left": [(10, 10)], "right": [(49, 49)]},
+    "pallidum": {"left": [(13, 13)], "right": [(52, 52)]},
+    "amygdala": {"left": [(18, 18)], "right": [(54, 54)]},
+}
+
+
+def mask_label_sets(seed_rois=PROBTRACK_SEED_ROIS):
     """
-    Executes a shell command and handles errors.
+    Returns the label ranges of the masks to generate: MASK_LABELS, plus the seed ROIs of
+    SEED_ROI_LABELS that are tracked.
     Args:
-        command (str): The shell command to execute.
+        seed_rois (list): Seed ROI names.
+    Returns:
+        dict: ROI name -> hemisphere -> list of inclusive (lower, upper) label ranges.
     """
-    try:
-        subprocess.run(command, shell=True, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error occurred while running command: {command}\n{e}")
+    unknown = [roi for roi in seed_rois if roi not in MASK_LABELS and roi not in SEED_ROI_LABELS]
+    if unknown:
+        raise ValueError(f"Unknown seed ROI {unknown[0]!r}; expected one of {list(MASK_LABELS) + list(SEED_ROI_LABELS)}.")
+    return dict(MASK_LABELS, **{roi: SEED_ROI_LABELS[roi] for roi in seed_rois if roi in SEED_ROI_LABELS})
 
 
-def generate_mask(input_seg, output_mask, lower_thr, upper_thr):
+def build_label_lut(label_sets):
+    """
+    Builds a lookup table mapping every segmentation label to a bit field of masks.
+    Args:
+        label_sets (dict): ROI name -> hemisphere -> list of inclusive (lower, upper) label ranges.
+    Returns:
+        tuple: The lookup table (one entry per label value, plus a trailing zero entry for
+        out-of-range labels) and the list of (roi, hemisphere) pairs, one per bit.
+    """
+    masks = [(roi, hemisphere) for roi, hemispheres in label_sets.items() for hemisphere in hemispheres]
+    if len(masks) > 64:
+        raise ValueError(f"At most 64 ROI/hemisphere masks are supported, got {len(masks)}.")
+    dtype = next(t for t in (np.uint8, np.uint16, np.uint32, np.uint64) if np.iinfo(t).bits >= len(masks))
+    max_label = max(upper for hemispheres in label_sets.values()
+                    for ranges in hemispheres.values() for _, upper in ranges)
+    lut = np.zeros(max_label + 2, dtype=dtype)
+    for bit, (roi, hemisphere) in enumerate(masks):
+        for lower_thr, upper_thr in label_sets[roi][hemisphere]:
+            lut[lower_thr:upper_thr + 1] |= dtype(1) << dtype(bit)
+    return lut, masks
+
+
+def generate_label_masks(input_seg, output_dir, label_sets=MASK_LABELS):
     """
-    Generates a binary mask using fslmaths.
+    Generates left, right and full binary masks for every ROI in one pass over the segmentation.
     Args:
         input_seg (str): Path to the segmentation file.
-        output_mask (str): Path to save the binary mask.
-        lower_thr (int): Lower threshold for segmentation.
-        upper_thr (int): Upper threshold for segmentation.
+        output_dir (str): Directory in which to save the masks.
+        label_sets (dict): ROI name -> hemisphere -> list of inclusive (lower, upper) label ranges.
+    Returns:
+        dict: (roi, hemisphere) -> path of the saved mask, with hemisphere "full" for the union.
     """
-    command = f"fslmaths {input_seg} -thr {lower_thr} -uthr {upper_thr} -bin {output_mask}"
-    run_command(command)
-    print(f"Generated mask: {output_mask}")
-
-
-def add_masks(mask1, mask2, output_mask):
+    seg_img = load_volume(input_seg)
+    seg = np.asanyarray(seg_img.dataobj)
+    if not np.issubdtype(seg.dtype, np.integer):
+        seg = np.rint(seg).astype(np.int32)
+
+    lut, masks = build_label_lut(label_sets)
+    codes = lut.take(np.clip(seg, 0, lut.size - 1))
+    del seg
+
+    header = seg_img.header.copy()
+    header.set_data_dtype(np.uint8)
+    full_masks = {}
+    outputs = {}
+    for bit, (roi, hemisphere) in enumerate(masks):
+        mask = (codes & (lut.dtype.type(1) << lut.dtype.type(bit))) != 0
+        full_masks[roi] = mask | full_masks[roi] if roi in full_masks else mask
+        outputs[(roi, hemisphere)] = _save_mask(mask, seg_img, header, output_dir, f"{hemisphere}_{roi}_mask.nii.gz")
+    for roi, mask in full_masks.items():
+        outputs[(roi, "full")] = _save_mask(mask, seg_img, header, output_dir, f"full_{roi}_mask.nii.gz")
+    return outputs
+
+
+def _save_mask(mask, ref_img, header, output_dir, file_name):
     """
-    Combines two binary masks into one using fslmaths.
+    Saves a boolean mask as a uint8 NIfTI file in the geometry of the reference image.
     Args:
-        mask1 (str): Path to the first mask.
-        mask2 (str): Path to the second mask.
-        output_mask (str): Path to save the combined mask.
+        mask (np.ndarray): Boolean mask.
+        ref_img (nib.Nifti1Image): Image providing the affine.
+        header (nib.Nifti1Header): Header to save the mask with.
+        output_dir (str): Directory in which to save the mask.
+        file_name (str): File name of the mask.
+    Returns:
+        str: Path of the saved mask.
     """
-    command = f"fslmaths {mask1} -add {mask2} {output_mask}"
-    run_command(command)
-    print(f"Combined masks into: {output_mask}")
+    output_mask = os.path.join(output_dir, file_name)
+    save_volume(nib.Nifti1Image(mask.astype(np.uint8), ref_img.affine, header), output_mask)
+    print(f"Generated mask: {output_mask}")
+    return output_mask
 
 
 def resample_to_3mm(input_mask, output_mask):
     """
-    Resamples a mask to 3mm resolution using flirt.
+    Resamples a mask to 3mm resolution, equivalent to
+    `flirt -applyisoxfm 3 -interp nearestneighbour` with the mask as its own reference.
     Args:
         input_mask (str): Path to the input mask.
         output_mask (str): Path to save the resampled mask.
     """
-    command = f"flirt -ref {input_mask} -in {input_mask} -o {output_mask} -applyisoxfm 3 -interp nearestneighbour"
-    run_command(command)
+    resample_iso(input_mask, input_mask, output_mask, 3)
     print(f"Resampled mask to 3mm: {output_mask}")
 
 
+def stage_spec(subject_path, label_sets=None):
+    """
+    Declares the inputs, outputs and parameters of the seed generation stage.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        label_sets (dict): ROI name -> hemisphere -> list of inclusive (lower, upper) label ranges;
+            defaults to mask_label_sets().
+    Returns:
+        StageSpec: Declaration of the stage.
+    """
+    label_sets = label_sets or mask_label_sets()
+    t1_dir = os.path.join(subject_path, "T1")
+    outputs = []
+    for roi, hemispheres in label_sets.items():
+        for hemisphere in hemispheres:
+            outputs.append(os.path.join(t1_dir, f"{hemisphere}_{roi}_mask.nii.gz"))
+            outputs.append(os.path.join(t1_dir, f"{hemisphere}_{roi}_mask_3mm.nii.gz"))
+        outputs.append(os.path.join(t1_dir, f"full_{roi}_mask.nii.gz"))
+    return StageSpec(
+        name="seeds",
+        inputs=[os.path.join(t1_dir, "wmparc.nii.gz")],
+        outputs=outputs,
+        params={"labels": label_sets, "resolution": 3},
+    )
+
+
 def process_subject(subject_path):
     """
     Processes a single subject: generates anatomical masks and resamples them.
     Args:
         subject_path (str): Path to the subject's folder.
+    Returns:
+        bool: True if the stage is up to date, either already or after this run.
     """
     t1_dir = os.path.join(subject_path, "T1")
     t1_seg = os.path.join(t1_dir, "wmparc.nii.gz")
 
     if not os.path.exists(t1_seg):
         print(f"Segmentation file missing for {subject_path}. Skipping.")
-        return
+        return False
+
+    spec = stage_spec(subject_path)
+    if is_up_to_date(subject_path, spec):
+        print(f"Seeds already generated for subject: {os.path.basename(subject_path)}")
+        return True
 
     print(f"Processing subject: {os.path.basename(subject_path)}")
 
-    # Striatum masks
-    left_striatum = os.path.join(t1_dir, "left_striatum_mask.nii.gz")
-    right_striatum = os.path.join(t1_dir, "right_striatum_mask.nii.gz")
-    full_striatum = os.path.join(t1_dir, "full_striatum_mask.nii.gz")
-
-    generate_mask(t1_seg, left_striatum, 11, 12)
-    generate_mask(t1_seg, right_striatum, 50, 51)
-    add_masks(left_striatum, right_striatum, full_striatum)
-
-    # Cortex masks
-    left_cortex = os.path.join(t1_dir, "left_cortex_mask.nii.gz")
-    right_cortex = os.path.join(t1_dir, "right_cortex_mask.nii.gz")
-    full_cortex = os.path.join(t1_dir, "full_cortex_mask.nii.gz")
-
-    generate_mask(t1_seg, left_cortex, 1000, 1035)
-    generate_mask(t1_seg, right_cortex, 2000, 2035)
-    add_masks(left_cortex, right_cortex, full_cortex)
-
-    # White matter masks
-    left_white_known = os.path.join(t1_dir, "left_white_mask_known.nii.gz")
-    left_white_unknown = os.path.join(t1_dir, "left_white_mask_unknown.nii.gz")
-    left_white = os.path.join(t1_dir, "left_white_mask.nii.gz")
-    right_white_known = os.path.join(t1_dir, "right_white_mask_known.nii.gz")
-    right_white_unknown = os.path.join(t1_dir, "right_white_mask_unknown.nii.gz")
-    right_white = os.path.join(t1_dir, "right_white_mask.nii.gz")
-    full_white = os.path.join(t1_dir, "full_white_mask.nii.gz")
-
-    generate_mask(t1_seg, left_white_known, 3001, 3035)
-    generate_mask(t1_seg, left_white_unknown, 5001, 5001)
-    add_masks(left_white_known, left_white_unknown, left_white)
-    generate_mask(t1_seg, right_white_known, 4001, 4035)
-    generate_mask(t1_seg, right_white_unknown, 5002, 5002)
-    add_masks(right_white_known, right_white_unknown, right_white)
-    add_masks(left_white, right_white, full_white)
-
-    # Resample masks to 3mm
-    masks_to_resample = [
-        (left_striatum, os.path.join(t1_dir, "left_striatum_mask_3mm.nii.gz")),
-        (right_striatum, os.path.join(t1_dir, "right_striatum_mask_3mm.nii.gz")),
-        (left_cortex, os.path.join(t1_dir, "left_cortex_mask_3mm.nii.gz")),
-        (right_cortex, os.path.join(t1_dir, "right_cortex_mask_3mm.nii.gz")),
-        (left_white, os.path.join(t1_dir, "left_white_mask_3mm.nii.gz")),
-        (right_white, os.path.join(t1_dir, "right_white_mask_3mm.nii.gz"))
-    ]
-
-    for input_mask, output_mask in masks_to_resample:
-        resample_to_3mm(input_mask, output_mask)
+    # Striatum, cortex, white matter and tracked seed ROI masks for both hemispheres
+    with track_stage(subject_path, spec.name, "label_masks"):
+        masks = generate_label_masks(t1_seg, t1_dir, spec.params["labels"])
+
+    # Resample the hemisphere masks to 3mm
+    with track_stage(subject_path, spec.name, "resample"):
+        for (roi, hemisphere), input_mask in masks.items():
+            if hemisphere != "full":
+                resample_to_3mm(input_mask, os.path.join(t1_dir, f"{hemisphere}_{roi}_mask_3mm.nii.gz"))
+
+    return record_stage(subject_path, spec)
 
 
 def main():
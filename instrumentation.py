@@ -0,0 +1,343 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+from pipeline_state import STATE_DIRNAME
+
+"""
+Per-stage timing, memory and I/O instrumentation shared by all pipeline scripts.
+
+Every external command goes through `run_logged` and every Python stage runs inside
+`track_stage`. Each appends one JSON line per run to <subject>/.pipeline/metrics/<stage>.jsonl
+with:
+
+    wall_seconds, cpu_seconds          elapsed and user+system CPU time
+    peak_rss_mb                        peak resident set size
+    read_bytes, write_bytes            bytes passed through read/write calls
+    disk_read_bytes, disk_write_bytes  bytes that actually reached the storage layer
+    exit_status                        process exit status; 1 for a Python stage that raised
+
+For commands, the resource usage covers the process and the children it waited for (the
+shell and, e.g., probtrackx). For Python stages it covers the current process. A stage
+that runs alone in its process resets the peak RSS at its start where the kernel allows
+it. The reset is process-wide, so when stages overlap in threads of one process (the GPU
+threads of cohort_scheduler and async_pipeline) the others sample the process's RSS
+every RSS_SAMPLE_SECONDS instead (peak_rss_sampled), which includes the memory of the
+stages running beside them but leaves their peaks intact.
+
+Usage: python instrumentation.py report <data_directory> [--json report.json]
+prints per-stage percentiles over a whole cohort.
+"""
+
+METRICS_DIRNAME = "metrics"
+
+# Fields summarised by the report
+REPORT_FIELDS = ("wall_seconds", "cpu_seconds", "peak_rss_mb", "read_bytes", "write_bytes")
+REPORT_PERCENTILES = (50, 90, 99)
+
+# Interval between RSS samples of a Python stage that cannot reset the peak RSS
+RSS_SAMPLE_SECONDS = 0.05
+
+# Python stages running in this process, guarded by _stages_lock
+_active_stages = 0
+_stages_lock = threading.Lock()
+
+
+def metrics_path(subject_path, stage):
+    """
+    Returns the JSON-lines log of a subject's stage.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        stage (str): Stage name.
+    Returns:
+        str: Path to the log.
+    """
+    return os.path.join(subject_path, STATE_DIRNAME, METRICS_DIRNAME, f"{stage}.jsonl")
+
+
+def append_metrics(subject_path, stage, entry):
+    """
+    Appends one run to a stage's log. Each entry is written with a single append, so
+    concurrent writers do not interleave lines.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        stage (str): Stage name.
+        entry (dict): Measurements of the run.
+    """
+    path = metrics_path(subject_path, stage)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    entry = dict(entry, subject=os.path.basename(os.path.normpath(subject_path)), stage=stage)
+    with open(path, "a") as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+
+def _read_proc_io(pid="self"):
+    """
+    Reads the I/O counters of a process, or returns None where /proc is unavailable.
+    """
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            fields = dict(line.split(":") for line in f)
+    except (OSError, ValueError):
+        return None
+    return {name: int(value) for name, value in fields.items()}
+
+
+def _io_entry(after, before=None):
+    """
+    Converts I/O counters, or their difference from earlier counters, into log fields.
+    """
+    names = {"read_bytes": "rchar", "write_bytes": "wchar", "disk_read_bytes": "read_bytes", "disk_write_bytes": "write_bytes"}
+    if after is None:
+        return {field: None for field in names}
+    return {field: after[name] - (before[name] if before else 0) for field, name in names.items()}
+
+
+def _reset_peak_rss():
+    """
+    Resets this process's peak RSS (VmHWM) so that it covers only what follows.
+    Returns:
+        bool: True if the kernel supports the reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _rss_mb():
+    """
+    Returns this process's current resident set size, or None where /proc is unavailable.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return None
+
+
+class _RSSSampler(threading.Thread):
+    """
+    Records the largest RSS of this process seen every RSS_SAMPLE_SECONDS until stopped.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak_mb = _rss_mb()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(RSS_SAMPLE_SECONDS):
+            rss_mb = _rss_mb()
+            if rss_mb is not None:
+                self.peak_mb = max(self.peak_mb or 0, rss_mb)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        rss_mb = _rss_mb()
+        return max(self.peak_mb, rss_mb) if rss_mb is not None and self.peak_mb is not None else self.peak_mb
+
+
+def run_logged(command, subject_path, stage, step=None, **popen_kwargs):
+    """
+    Runs a command and logs its wall time, CPU time, peak RSS, I/O and exit status.
+    Args:
+        command (str or list): Command, run through the shell if it is a string.
+        subject_path (str): Path to the subject's folder.
+        stage (str): Stage name, selecting the log.
+        step (str): Name of the step within the stage; defaults to the executable name.
+        popen_kwargs: Passed to subprocess.Popen.
+    Returns:
+        int: Exit status of the command.
+    """
+    popen_kwargs.setdefault("shell", isinstance(command, str))
+    if step is None:
+        words = command.split() if isinstance(command, str) else command
+        step = os.path.basename(next((word for word in words if "=" not in word and word != "export"), "command"))
+    start_time, start = time.time(), time.perf_counter()
+    process = subprocess.Popen(command, **popen_kwargs)
+    try:
+        # Wait without reaping, so that the I/O counters of the exited process can still be read
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        io = _read_proc_io(process.pid)
+        _, status, usage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    process.returncode = os.waitstatus_to_exitcode(status)
+    entry = {
+        "step": step,
+        "kind": "command",
+        "command": command if isinstance(command, str) else " ".join(command),
+        "start": start_time,
+        "wall_seconds": time.perf_counter() - start,
+        "cpu_seconds": usage.ru_utime + usage.ru_stime,
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "exit_status": process.returncode,
+    }
+    entry.update(_io_entry(io))
+    append_metrics(subject_path, stage, entry)
+    return process.returncode
+
+
+@contextlib.contextmanager
+def track_stage(subject_path, stage, step="python"):
+    """
+    Logs the wall time, CPU time, peak RSS, I/O and outcome of the enclosed Python code.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        stage (str): Stage name, selecting the log.
+        step (str): Name of the step within the stage.
+    """
+    global _active_stages
+    with _stages_lock:
+        _active_stages += 1
+        # Resetting while another stage runs in this process would wipe that stage's peak
+        peak_reset = _active_stages == 1 and _reset_peak_rss()
+    sampler = None
+    if not peak_reset:
+        sampler = _RSSSampler()
+        sampler.start()
+    io_before = _read_proc_io()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start_time, start = time.time(), time.perf_counter()
+    exit_status = 1
+    try:
+        yield
+        exit_status = 0
+    finally:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        peak_rss_mb = sampler.stop() if sampler is not None else None
+        with _stages_lock:
+            _active_stages -= 1
+        entry = {
+            "step": step,
+            "kind": "python",
+            "start": start_time,
+            "wall_seconds": time.perf_counter() - start,
+            "cpu_seconds": (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime),
+            "peak_rss_mb": peak_rss_mb if peak_rss_mb is not None else _peak_rss_mb(),
+            "peak_rss_reset": peak_reset,
+            "peak_rss_sampled": peak_rss_mb is not None,
+            "exit_status": exit_status,
+        }
+        entry.update(_io_entry(_read_proc_io() if io_before else None, io_before))
+        append_metrics(subject_path, stage, entry)
+
+
+def load_metrics(data_directory):
+    """
+    Loads every logged run of a cohort.
+    Args:
+        data_directory (str): The root directory containing all subject data.
+    Returns:
+        list: Logged entries.
+    """
+    entries = []
+    pattern = os.path.join(data_directory, "*", STATE_DIRNAME, METRICS_DIRNAME, "*.jsonl")
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+    return entries
+
+
+def summarize(entries):
+    """
+    Computes per-stage and per-step percentiles of the logged measurements.
+    Args:
+        entries (list): Logged entries, as returned by load_metrics.
+    Returns:
+        dict: "stage/step" -> run and failure counts, total wall time and percentiles per field.
+    """
+    groups = {}
+    for entry in entries:
+        # Records without a measured run, such as the scheduler's resource estimates
+        if "wall_seconds" not in entry:
+            continue
+        groups.setdefault(f"{entry['stage']}/{entry['step']}", []).append(entry)
+    summary = {}
+    for key, runs in sorted(groups.items()):
+        stats = {
+            "runs": len(runs),
+            "failures": sum(1 for run in runs if run.get("exit_status") != 0),
+            "subjects": len({run.get("subject") for run in runs}),
+            "total_wall_seconds": sum(run["wall_seconds"] for run in runs),
+        }
+        for field in REPORT_FIELDS:
+            values = np.array([run[field] for run in runs if run.get(field) is not None], dtype=np.float64)
+            if values.size:
+                stats[field] = {f"p{p}": float(np.percentile(values, p)) for p in REPORT_PERCENTILES}
+                stats[field]["max"] = float(values.max())
+        summary[key] = stats
+    return summary
+
+
+def print_report(summary):
+    """
+    Prints the per-stage summary, slowest total first.
+    Args:
+        summary (dict): Output of summarize.
+    """
+    header = f"{'stage/step':<40} {'runs':>5} {'fail':>5} {'total h':>8} " + \
+             " ".join(f"{'wall p' + str(p):>10}" for p in REPORT_PERCENTILES) + \
+             f" {'cpu p50':>9} {'rss p90 MB':>10} {'read p50 MB':>11} {'write p50 MB':>12}"
+    print(header)
+    for key, stats in sorted(summary.items(), key=lambda item: -item[1]["total_wall_seconds"]):
+        value = lambda field, name, scale=1.0: stats[field][name] / scale if field in stats else float("nan")
+        print(f"{key:<40} {stats['runs']:>5} {stats['failures']:>5} {stats['total_wall_seconds'] / 3600:>8.2f} " +
+              " ".join(f"{value('wall_seconds', f'p{p}'):>10.1f}" for p in REPORT_PERCENTILES) +
+              f" {value('cpu_seconds', 'p50'):>9.1f} {value('peak_rss_mb', 'p90'):>10.0f}"
+              f" {value('read_bytes', 'p50', 1e6):>11.1f} {value('write_bytes', 'p50', 1e6):>12.1f}")
+
+
+def main():
+    """
+    Reports per-stage percentiles over all subjects of a cohort.
+    """
+    parser = argparse.ArgumentParser(description="Summarise the per-stage metrics logged for a cohort.")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("data_directory")
+    parser.add_argument("--json", default=None, help="Also save the summary to this JSON file.")
+    args = parser.parse_args()
+
+    entries = load_metrics(args.data_directory)
+    if not entries:
+        print(f"No metrics found under {args.data_directory}")
+        sys.exit(1)
+    summary = summarize(entries)
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+import scipy.sparse as sparse
+from sklearn.cluster import MiniBatchKMeans, SpectralClustering
+from sklearn.preprocessing import normalize
+from pipeline_state import StageSpec, is_up_to_date, record_stage
+from post_probtrack import FINGERPRINT_FORMAT, fingerprint_files, load_fingerprint, roi_coords_file
+from run_probtrack import PROBTRACK_SEED_ROIS
+from seed_shards import SEED_COORDS_FILE, read_coords
+from volume_cache import load_volume, save_volume
+
+"""
+Parcellates the striatum by clustering the voxels' 72-dimensional fiber fingerprints.
+
+Clustering runs on the sparse fingerprints as post_probtrack saves them; nothing is
+densified. Rows are scaled to unit L2 norm first (ROW_NORMALIZATION), so voxels are
+grouped by the shape of their connectivity profile rather than its strength. Seed voxels
+without any streamline to a bundle are left unlabelled (0); the clusters are labelled
+1..k. The labels are written back into the geometry of the seed mask, as
+probtrackx_{R|L}_omatrix2/parcellation_{R|L}_k<k>.nii.gz, following the seed order of
+coords_for_fdt_matrix2. When several seed ROIs were tracked together (PROBTRACK_SEED_ROIS),
+only the striatum's rows are clustered, from the fingerprint post_probtrack split off for
+it and its own coordinate file.
+
+Two modes:
+
+    subject   every subject and hemisphere is clustered on its own, in a process pool,
+              with mini-batch k-means or spectral clustering (a k-nearest-neighbour
+              affinity graph, which stays sparse). Cluster numbers are arbitrary per subject.
+    group     one mini-batch k-means model is fitted over the whole cohort by
+              `partial_fit` on batches of BATCH_SIZE voxels, streaming one subject at a
+              time for GROUP_EPOCHS passes, so the cohort matrix is never held in memory.
+              The centroids are saved to the data directory and every subject is then
+              labelled against them in the process pool, giving the same cluster numbers
+              across subjects (group_parcellation_{R|L}_k<k>.nii.gz).
+
+    python parcellation.py --clusters 5 --method minibatch_kmeans --workers 16
+    python parcellation.py --clusters 5 --group
+"""
+
+# Define the root data directory
+DATA_DIRECTORY = "/home/test/lmq/data/HCP"
+
+# Number of clusters per hemisphere
+N_CLUSTERS = 5
+
+# Clustering of single subjects: 'minibatch_kmeans' or 'spectral'
+CLUSTER_METHOD = 'minibatch_kmeans'
+CLUSTER_METHODS = ('minibatch_kmeans', 'spectral')
+
+# Row scaling applied before clustering: 'l2', 'l1' or None
+ROW_NORMALIZATION = 'l2'
+
+# Voxels per mini-batch, and passes over the cohort for the group model
+BATCH_SIZE = 4096
+GROUP_EPOCHS = 3
+
+# Neighbours per voxel in the spectral affinity graph
+SPECTRAL_NEIGHBORS = 10
+
+RANDOM_STATE = 0
+
+HEMISPHERES = {'L': 'left', 'R': 'right'}
+
+# Seed ROI parcellated, whose split fingerprint is used in a multi-ROI run
+PARCELLATION_ROI = 'striatum'
+
+
+def output_dir(subject_path, hemisphere):
+    """
+    Returns the probtrackx output directory of a hemisphere.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+    Returns:
+        Path: The directory holding the fingerprint.
+    """
+    return Path(subject_path) / f'probtrackx_{hemisphere}_omatrix2'
+
+
+def fingerprint_roi():
+    """
+    Returns the seed ROI of the split fingerprint to parcellate, or None when the
+    hemisphere's fingerprint only holds the striatum.
+    """
+    return PARCELLATION_ROI if len(PROBTRACK_SEED_ROIS) > 1 else None
+
+
+def load_striatal_fingerprint(subject_path, hemisphere):
+    """
+    Loads the fingerprint of the striatal seeds of a hemisphere, or None if it is missing.
+    """
+    return load_fingerprint(output_dir(subject_path, hemisphere), hemisphere, FINGERPRINT_FORMAT, fingerprint_roi())
+
+
+def seed_mask_path(subject_path, hemisphere):
+    """
+    Returns the path of the striatal seed mask a hemisphere was tracked from.
+    """
+    return os.path.join(subject_path, "T1", f"{HEMISPHERES[hemisphere]}_{PARCELLATION_ROI}_mask_3mm.nii.gz")
+
+
+def label_path(subject_path, hemisphere, n_clusters, group=False):
+    """
+    Returns the path of a parcellation volume.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        n_clusters (int): Number of clusters.
+        group (bool): Whether the labels come from the group model.
+    Returns:
+        Path: Path of the label volume.
+    """
+    prefix = 'group_parcellation' if group else 'parcellation'
+    return output_dir(subject_path, hemisphere) / f'{prefix}_{hemisphere}_k{n_clusters}.nii.gz'
+
+
+def stage_spec(subject_path, hemisphere, n_clusters=N_CLUSTERS, method=CLUSTER_METHOD):
+    """
+    Declares the inputs, outputs and parameters of the single-subject parcellation stage.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        n_clusters (int): Number of clusters.
+        method (str): One of CLUSTER_METHODS.
+    Returns:
+        StageSpec: Declaration of the stage.
+    """
+    out_dir = output_dir(subject_path, hemisphere)
+    roi = fingerprint_roi()
+    inputs = fingerprint_files(out_dir, hemisphere, roi=roi) + ([roi_coords_file(out_dir, roi)] if roi else [])
+    return StageSpec(
+        name=f"parcellation_{hemisphere}",
+        inputs=[str(path) for path in inputs] + [seed_mask_path(subject_path, hemisphere)],
+        outputs=[str(label_path(subject_path, hemisphere, n_clusters))],
+        params={"clusters": n_clusters, "method": method, "row_normalization": ROW_NORMALIZATION,
+                "random_state": RANDOM_STATE},
+    )
+
+
+def prepare_rows(rows):
+    """
+    Casts a block of fingerprint rows for clustering and applies ROW_NORMALIZATION.
+    Args:
+        rows (sparse matrix): Fingerprint rows.
+    Returns:
+        scipy.sparse.csr_matrix: Rows ready for clustering.
+    """
+    rows = sparse.csr_matrix(rows, dtype=np.float64)
+    if ROW_NORMALIZATION:
+        rows = normalize(rows, norm=ROW_NORMALIZATION, axis=1, copy=False)
+    return rows
+
+
+def iter_fingerprint_batches(fingerprint, batch_size=BATCH_SIZE):
+    """
+    Streams the connected rows of a fingerprint in batches.
+    Args:
+        fingerprint (sparse matrix or LazyCSR): Seed x bundle fingerprint.
+        batch_size (int): Rows per batch.
+    Yields:
+        scipy.sparse.csr_matrix: Prepared rows that have at least one non-zero.
+    """
+    for start in range(0, fingerprint.shape[0], batch_size):
+        stop = start + batch_size
+        block = fingerprint.rows(start, stop) if hasattr(fingerprint, 'rows') else fingerprint[start:stop]
+        block = prepare_rows(block)
+        connected = np.diff(block.indptr) > 0
+        if connected.any():
+            yield block[connected]
+
+
+def cluster_fingerprint(fingerprint, n_clusters=N_CLUSTERS, method=CLUSTER_METHOD):
+    """
+    Clusters the voxels of one fingerprint.
+    Args:
+        fingerprint (sparse matrix or LazyCSR): Seed x bundle fingerprint.
+        n_clusters (int): Number of clusters.
+        method (str): One of CLUSTER_METHODS.
+    Returns:
+        np.ndarray: Label of every seed, 1..n_clusters, or 0 for seeds without connectivity.
+    """
+    if method not in CLUSTER_METHODS:
+        raise ValueError(f"Unknown clustering method {method!r}; expected one of {CLUSTER_METHODS}.")
+    rows = prepare_rows(fingerprint.to_csr() if hasattr(fingerprint, 'to_csr') else fingerprint)
+    connected = np.diff(rows.indptr) > 0
+    labels = np.zeros(rows.shape[0], dtype=np.int16)
+    if connected.sum() < n_clusters:
+        return labels
+    rows = rows[connected]
+    if method == 'spectral':
+        model = SpectralClustering(n_clusters=n_clusters, affinity='nearest_neighbors',
+                                   n_neighbors=min(SPECTRAL_NEIGHBORS, rows.shape[0] - 1),
+                                   assign_labels='cluster_qr', random_state=RANDOM_STATE)
+    else:
+        model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=BATCH_SIZE, n_init=3, random_state=RANDOM_STATE)
+    labels[connected] = model.fit_predict(rows) + 1
+    return labels
+
+
+def assign_clusters(fingerprint, centroids):
+    """
+    Labels every seed with its nearest group centroid, batch by batch.
+    Args:
+        fingerprint (sparse matrix or LazyCSR): Seed x bundle fingerprint.
+        centroids (np.ndarray): (n_clusters, n_bundles) centroids of the group model.
+    Returns:
+        np.ndarray: Label of every seed, 1..n_clusters, or 0 for seeds without connectivity.
+    """
+    labels = np.zeros(fingerprint.shape[0], dtype=np.int16)
+    squared_norms = (centroids ** 2).sum(axis=1)
+    for start in range(0, fingerprint.shape[0], BATCH_SIZE):
+        stop = min(start + BATCH_SIZE, fingerprint.shape[0])
+        block = fingerprint.rows(start, stop) if hasattr(fingerprint, 'rows') else fingerprint[start:stop]
+        block = prepare_rows(block)
+        # ||x - c||^2 without the ||x||^2 term, which does not change the nearest centroid
+        distances = squared_norms[np.newaxis, :] - 2 * np.asarray(block.dot(centroids.T))
+        connected = np.diff(block.indptr) > 0
+        labels[start:stop][connected] = distances[connected].argmin(axis=1) + 1
+    return labels
+
+
+def seed_voxels(subject_path, hemisphere, mask_img):
+    """
+    Returns the voxel coordinates of the fingerprint rows, from coords_for_fdt_matrix2 (or
+    the coordinate file of the split ROI) when it exists, and otherwise in probtrackx order
+    (x fastest) from the seed mask.
+    """
+    roi = fingerprint_roi()
+    out_dir = output_dir(subject_path, hemisphere)
+    coords_file = roi_coords_file(out_dir, roi) if roi else out_dir / SEED_COORDS_FILE
+    if coords_file.exists():
+        return read_coords(coords_file)
+    mask = np.asanyarray(mask_img.dataobj)
+    return np.column_stack(np.unravel_index(np.flatnonzero(mask.ravel(order='F')), mask.shape, order='F'))
+
+
+def write_labels(subject_path, hemisphere, labels, path):
+    """
+    Writes seed labels as a volume in the geometry of the seed mask.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        labels (np.ndarray): Label of every fingerprint row.
+        path (Path): Output NIfTI file.
+    """
+    mask_img = load_volume(seed_mask_path(subject_path, hemisphere))
+    coords = seed_voxels(subject_path, hemisphere, mask_img)
+    if len(coords) != labels.size:
+        raise ValueError(f"{labels.size} fingerprint rows but {len(coords)} seed voxels in {subject_path}.")
+    volume = np.zeros(mask_img.shape[:3], dtype=np.int16)
+    volume[coords[:, 0], coords[:, 1], coords[:, 2]] = labels
+    header = mask_img.header.copy()
+    header.set_data_dtype(np.int16)
+    save_volume(nib.Nifti1Image(volume, mask_img.affine, header), str(path))
+    print(f"Saved parcellation: {path}")
+
+
+def parcellate_subject(subject_path, hemisphere, n_clusters=N_CLUSTERS, method=CLUSTER_METHOD):
+    """
+    Clusters one subject's hemisphere and writes its label volume, unless it is up to date.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        n_clusters (int): Number of clusters.
+        method (str): One of CLUSTER_METHODS.
+    Returns:
+        bool: True if the parcellation is up to date.
+    """
+    spec = stage_spec(subject_path, hemisphere, n_clusters, method)
+    if is_up_to_date(subject_path, spec):
+        print(f"Parcellation already up to date for {hemisphere}: {subject_path}")
+        return True
+    fingerprint = load_striatal_fingerprint(subject_path, hemisphere)
+    if fingerprint is None or not os.path.exists(seed_mask_path(subject_path, hemisphere)):
+        print(f"Missing fingerprint or seed mask for {hemisphere}: {subject_path}")
+        return False
+    labels = cluster_fingerprint(fingerprint, n_clusters, method)
+    write_labels(subject_path, hemisphere, labels, label_path(subject_path, hemisphere, n_clusters))
+    return record_stage(subject_path, spec)
+
+
+def fit_group_model(subject_paths, hemisphere, n_clusters=N_CLUSTERS, epochs=GROUP_EPOCHS):
+    """
+    Fits mini-batch k-means over the fingerprints of a cohort, reading one subject at a time.
+    Args:
+        subject_paths (list): Paths to the subjects' folders.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        n_clusters (int): Number of clusters.
+        epochs (int): Passes over the cohort.
+    Returns:
+        MiniBatchKMeans: The fitted model, or None if no subject has a fingerprint.
+    """
+    model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=BATCH_SIZE, random_state=RANDOM_STATE)
+    rng = np.random.default_rng(RANDOM_STATE)
+    pending = None
+    fitted = False
+    for epoch in range(epochs):
+        # Visit the subjects in a new order every pass so no subject always comes last
+        for index in rng.permutation(len(subject_paths)):
+            fingerprint = load_striatal_fingerprint(subject_paths[index], hemisphere)
+            if fingerprint is None:
+                continue
+            for batch in iter_fingerprint_batches(fingerprint):
+                # partial_fit needs at least n_clusters rows; carry small batches over
+                pending = batch if pending is None else sparse.vstack([pending, batch], format='csr')
+                if pending.shape[0] >= max(n_clusters, BATCH_SIZE // 4):
+                    model.partial_fit(pending)
+                    pending, fitted = None, True
+        print(f"Group model, hemisphere {hemisphere}: finished pass {epoch + 1} of {epochs}")
+    if pending is not None and pending.shape[0] >= n_clusters:
+        model.partial_fit(pending)
+        fitted = True
+    return model if fitted else None
+
+
+def label_subject(subject_path, hemisphere, centroids):
+    """
+    Labels one subject's hemisphere with the group centroids and writes its label volume.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        centroids (np.ndarray): (n_clusters, n_bundles) centroids of the group model.
+    Returns:
+        bool: True if the label volume was written.
+    """
+    fingerprint = load_striatal_fingerprint(subject_path, hemisphere)
+    if fingerprint is None:
+        return False
+    labels = assign_clusters(fingerprint, centroids)
+    write_labels(subject_path, hemisphere, labels, label_path(subject_path, hemisphere, len(centroids), group=True))
+    return True
+
+
+def list_subjects(data_directory):
+    """
+    Lists the subject folders of the data directory.
+    """
+    return [os.path.join(data_directory, d) for d in sorted(os.listdir(data_directory))
+            if os.path.isdir(os.path.join(data_directory, d))]
+
+
+def run_subjects(data_directory, n_clusters=N_CLUSTERS, method=CLUSTER_METHOD, workers=None):
+    """
+    Parcellates every subject and hemisphere on its own, in a process pool.
+    Args:
+        data_directory (str): The root directory containing all subject data.
+        n_clusters (int): Number of clusters.
+        method (str): One of CLUSTER_METHODS.
+        workers (int): Number of processes.
+    Returns:
+        int: Number of hemispheres parcellated or already up to date.
+    """
+    tasks = [(subject_path, hemisphere) for subject_path in list_subjects(data_directory) for hemisphere in HEMISPHERES]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(parcellate_subject, *zip(*tasks), [n_clusters] * len(tasks), [method] * len(tasks))
+        return sum(results)
+
+
+def run_group(data_directory, n_clusters=N_CLUSTERS, workers=None, epochs=GROUP_EPOCHS):
+    """
+    Fits the group model of each hemisphere, saves its centroids and labels every subject.
+    Args:
+        data_directory (str): The root directory containing all subject data.
+        n_clusters (int): Number of clusters.
+        workers (int): Number of processes labelling the subjects.
+        epochs (int): Passes over the cohort.
+    Returns:
+        int: Number of hemispheres labelled.
+    """
+    subject_paths = list_subjects(data_directory)
+    labelled = 0
+    for hemisphere in HEMISPHERES:
+        model = fit_group_model(subject_paths, hemisphere, n_clusters, epochs)
+        if model is None:
+            print(f"No fingerprints found for hemisphere {hemisphere}")
+            continue
+        centroids = model.cluster_centers_
+        centroid_file = os.path.join(data_directory, f"group_parcellation_{hemisphere}_k{n_clusters}.npz")
+        np.savez(centroid_file, centroids=centroids, row_normalization=str(ROW_NORMALIZATION))
+        print(f"Saved group centroids: {centroid_file}")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            labelled += sum(pool.map(label_subject, subject_paths, [hemisphere] * len(subject_paths),
+                                     [centroids] * len(subject_paths)))
+    return labelled
+
+
+def main():
+    """
+    Main function to parcellate all subjects, one by one or with a group model.
+    """
+    parser = argparse.ArgumentParser(description="Cluster the striatal fiber fingerprints into parcellations.")
+    parser.add_argument("--data-directory", default=DATA_DIRECTORY)
+    parser.add_argument("--clusters", type=int, default=N_CLUSTERS)
+    parser.add_argument("--method", choices=CLUSTER_METHODS, default=CLUSTER_METHOD)
+    parser.add_argument("--group", action="store_true", help="Fit one mini-batch k-means model over the cohort.")
+    parser.add_argument("--epochs", type=int, default=GROUP_EPOCHS, help="Passes over the cohort in --group mode.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    if args.group:
+        count = run_group(args.data_directory, args.clusters, args.workers, args.epochs)
+    else:
+        count = run_subjects(args.data_directory, args.clusters, args.method, args.workers)
+    print(f"Parcellated {count} hemisphere(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import namedtuple
+
+"""
+Content-addressed build records shared by all pipeline stages.
+
+Every stage declares, per subject, the files it reads, the files it writes and the
+parameters it runs with (a StageSpec). When a stage finishes, a record holding the
+SHA-256 of every input and output and a hash of the parameters is written atomically to
+<subject>/.pipeline/<stage>.json. A stage is up to date, and is skipped, only while its
+parameters, the content of its inputs and its outputs all still match that record.
+
+Upstream outputs are downstream inputs, so re-running one stage only re-runs the stages
+whose inputs actually changed. Hashes are reused while a file's size and mtime match a
+previous record, so unchanged multi-GB files are not read again. Outputs that a later
+stage deletes (the probtrackx `.dot` files) are declared transient; their recorded
+hash stands in for the file once it is gone.
+
+To force a stage to re-run after changing its code, bump a "version" entry in its params.
+"""
+
+STATE_DIRNAME = ".pipeline"
+
+# Stage graph: each stage lists the stages whose outputs it consumes
+STAGE_DEPENDENCIES = {
+    "masks": [],
+    "seeds": [],
+    "bedpostx": [],
+    "tractseg": [],
+    "bundle_targets": ["tractseg", "masks"],
+    "probtrack": ["bedpostx", "seeds", "masks"],
+    "post_probtrack": ["probtrack", "bundle_targets", "masks"],
+    "parcellation": ["post_probtrack", "seeds"],
+}
+
+StageSpec = namedtuple("StageSpec", ["name", "inputs", "outputs", "params", "transient"])
+StageSpec.__new__.__defaults__ = ((),)
+
+_HASH_BLOCK = 8 * 1024 * 1024
+
+
+def stage_order():
+    """
+    Orders the stages so that every stage comes after the stages it depends on.
+    Returns:
+        list: Stage names in dependency order.
+    """
+    order = []
+
+    def visit(name):
+        if name not in order:
+            for dependency in STAGE_DEPENDENCIES[name]:
+                visit(dependency)
+            order.append(name)
+
+    for name in STAGE_DEPENDENCIES:
+        visit(name)
+    return order
+
+
+def stage_type(name):
+    """
+    Returns the graph node of a stage record name, e.g. "probtrack" for "probtrack_left".
+    Args:
+        name (str): Stage record name.
+    Returns:
+        str: Name of the stage in STAGE_DEPENDENCIES.
+    """
+    return max((stage for stage in STAGE_DEPENDENCIES if name == stage or name.startswith(stage + "_")), key=len)
+
+
+def _record_path(subject_path, name):
+    return os.path.join(subject_path, STATE_DIRNAME, f"{name}.json")
+
+
+def _relative(subject_path, path):
+    return os.path.relpath(os.path.abspath(path), os.path.abspath(subject_path))
+
+
+def params_digest(params):
+    """
+    Hashes stage parameters.
+    Args:
+        params (dict): JSON-serialisable parameters.
+    Returns:
+        str: SHA-256 hex digest of the canonical JSON encoding.
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_digest(path):
+    """
+    Hashes the content of a file.
+    Args:
+        path (str): Path to the file.
+    Returns:
+        str: SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_records(subject_path):
+    """
+    Loads every stage record of a subject.
+    Args:
+        subject_path (str): Path to the subject's folder.
+    Returns:
+        dict: Stage name -> record.
+    """
+    state_dir = os.path.join(subject_path, STATE_DIRNAME)
+    records = {}
+    if os.path.isdir(state_dir):
+        for file_name in os.listdir(state_dir):
+            if file_name.endswith(".json"):
+                try:
+                    with open(os.path.join(state_dir, file_name)) as f:
+                        records[file_name[:-5]] = json.load(f)
+                except (OSError, ValueError):
+                    continue
+    return records
+
+
+def _known_files(records):
+    """
+    Collects the last recorded state of every file mentioned in any record. The state
+    recorded by the stage that produced a file takes precedence over what consumers saw.
+    """
+    known = {}
+    for section in ("inputs", "outputs"):
+        for record in records.values():
+            known.update(record.get(section, {}))
+    return known
+
+
+def _file_state(subject_path, path, known, transient=False):
+    """
+    Describes a file by size, mtime and content hash, reusing a known hash when possible.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        path (str): Path to the file.
+        known (dict): Relative path -> previously recorded file state.
+        transient (bool): Whether a missing file may be described by its recorded state.
+    Returns:
+        dict: File state, or None if the file is missing and has no usable record.
+    """
+    rel_path = _relative(subject_path, path)
+    previous = known.get(rel_path)
+    if not os.path.exists(path):
+        return previous if transient else None
+    stat = os.stat(path)
+    if previous and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+        return previous
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_digest(path)}
+
+
+def is_up_to_date(subject_path, spec):
+    """
+    Checks whether a stage's recorded run still matches its inputs, outputs and parameters.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        spec (StageSpec): Declaration of the stage.
+    Returns:
+        bool: True if the stage can be skipped.
+    """
+    records = load_records(subject_path)
+    record = records.get(spec.name)
+    if record is None or record.get("params") != params_digest(spec.params):
+        return False
+
+    known = _known_files(records)
+    transient = {_relative(subject_path, path) for path in spec.transient}
+    recorded_inputs = record.get("inputs", {})
+    if set(recorded_inputs) != {_relative(subject_path, path) for path in spec.inputs}:
+        return False
+    for path in spec.inputs:
+        rel_path = _relative(subject_path, path)
+        state = _file_state(subject_path, path, known, rel_path in transient)
+        if state is None or state["sha256"] != recorded_inputs[rel_path]["sha256"]:
+            return False
+
+    recorded_outputs = record.get("outputs", {})
+    for path in spec.outputs:
+        rel_path = _relative(subject_path, path)
+        if rel_path not in recorded_outputs:
+            return False
+        if not os.path.exists(path):
+            if rel_path in transient:
+                continue
+            return False
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) != (recorded_outputs[rel_path]["size"], recorded_outputs[rel_path]["mtime_ns"]):
+            return False
+    return True
+
+
+def snapshot_inputs(subject_path, spec):
+    """
+    Captures the state of a stage's inputs, for stages that consume (delete) an input
+    before they can be recorded.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        spec (StageSpec): Declaration of the stage.
+    Returns:
+        dict: Relative path -> file state, with None for missing inputs.
+    """
+    known = _known_files(load_records(subject_path))
+    transient = {_relative(subject_path, path) for path in spec.transient}
+    return {
+        _relative(subject_path, path): _file_state(subject_path, path, known, _relative(subject_path, path) in transient)
+        for path in spec.inputs
+    }
+
+
+def record_stage(subject_path, spec, inputs=None):
+    """
+    Atomically records a completed stage run.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        spec (StageSpec): Declaration of the stage.
+        inputs (dict): Input states taken with `snapshot_inputs` before the stage ran.
+            The inputs are described as they are now if None.
+    Returns:
+        bool: True if the record was written, False if an input or output is missing,
+        in which case the stage is treated as not completed.
+    """
+    known = _known_files(load_records(subject_path))
+    transient = {_relative(subject_path, path) for path in spec.transient}
+    record = {"stage": spec.name, "params": params_digest(spec.params), "inputs": {}, "outputs": {}}
+    for section, paths in (("inputs", spec.inputs), ("outputs", spec.outputs)):
+        for path in paths:
+            rel_path = _relative(subject_path, path)
+            if section == "inputs" and inputs is not None:
+                state = inputs.get(rel_path)
+            else:
+                state = _file_state(subject_path, path, known, rel_path in transient)
+            if state is None:
+                print(f"Not recording stage {spec.name}: missing {path}")
+                return False
+            record[section][rel_path] = state
+
+    state_dir = os.path.join(subject_path, STATE_DIRNAME)
+    os.makedirs(state_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=state_dir, prefix=f".{spec.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, _record_path(subject_path, spec.name))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+
+def invalidate_stage(subject_path, name):
+    """
+    Removes a stage record so that the stage runs again.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        name (str): Stage name.
+    """
+    record_path = _record_path(subject_path, name)
+    if os.path.exists(record_path):
+        os.remove(record_path)
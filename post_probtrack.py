@@ -1,142 +1,673 @@
+import io
 import os
+import time
 import numpy as np
 from sklearn.preprocessing import normalize
 import scipy.sparse as sparse
 from pathlib import Path
-import nibabel as nib
+from instrumentation import track_stage
+from pipeline_state import StageSpec, is_up_to_date, record_stage, snapshot_inputs
+from blocked_product import blocked_dot
+from compact_fingerprint import compact_files, open_compact, save_compact
+from bundle_projection import bundle_targets, stage_spec as bundle_stage_spec
+from sparse_store import CSRWriter, load_csr, save_csr, store_files
+from run_probtrack import PROBTRACK_SEED_ROIS, stage_spec as probtrack_stage_spec
+from seed_index import save_seed_index
+from seed_rois import ROI_LABELS_FILE, roi_mask_path, row_rois, split_rows
+from seed_shards import SEED_COORDS_FILE, SHARD_PREFIX, TARGET_COORDS_FILE, merge_shards, read_coords, write_coords
+from volume_cache import load_volume
+
+
+# Size of the text blocks streamed from fdt_matrix2.dot. Only one block (plus the
+# partial line carried over from the previous one) is held as text at any time.
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# Fingerprint normalizations supported by normalize_fingerprint, and the one used by default
+NORMALIZATION_MODES = ('roi_size', 'roi_size_log', 'l1', 'l2', 'waytotal')
+NORMALIZATION = 'roi_size'
+
+# On-disk layout of fdt_matrix2 and the fingerprints: 'npz' (zip-compressed,
+# sparse.save_npz) or 'csr' (memory-mappable arrays in fdt_matrix2_csr/, see sparse_store).
+# With 'csr', the fingerprint is computed out of core (see blocked_product) and written
+# block by block to finger_print_fiber_{R|L}_csr/.
+MATRIX_FORMAT = 'npz'
+
+# Quantization of the fingerprints: None keeps them in float64 in the MATRIX_FORMAT layout;
+# 'float32' or 'uint16' (with a per-bundle scale) saves them in the compact, lazily
+# readable layout of compact_fingerprint, with their seed coordinates, in
+# finger_print_fiber_{R|L}_compact/. See compact_fingerprint for the precision of each.
+FINGERPRINT_QUANTIZATION = None
+FINGERPRINT_FORMAT = 'compact' if FINGERPRINT_QUANTIZATION else MATRIX_FORMAT
+
+
+def iter_coomat_chunks(file, chunk_bytes=CHUNK_BYTES):
+    """
+    Streams a probtrackx coordinate matrix (`i  j  v` per line, 1-based) in blocks.
+
+    Args:
+        file (Path): Path to the `.dot` file.
+        chunk_bytes (int): Number of bytes read per block.
+
+    Yields:
+        tuple: Zero-based row indices (int32), column indices (int32) and values (float32).
+    """
+    remainder = b''
+    with open(file, 'rb') as f:
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            block = remainder + block
+            cut = block.rfind(b'\n') + 1
+            remainder = block[cut:]
+            if cut:
+                yield _parse_coo_block(block[:cut])
+    if remainder.strip():
+        yield _parse_coo_block(remainder)
+
+
+def _parse_coo_block(block):
+    """
+    Parses complete `i  j  v` lines into typed NumPy arrays.
+
+    Args:
+        block (bytes): Text containing only whole lines.
 
+    Returns:
+        tuple: Zero-based row indices, column indices and values.
+    """
+    if not block.strip():
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+    # Unlike np.fromstring, loadtxt raises on any token that is not an integer and on
+    # lines whose number of values differs, instead of stopping at the first bad one
+    values = np.loadtxt(io.BytesIO(block), dtype=np.int64, ndmin=2)
+    if values.shape[1] != 3:
+        raise ValueError(f'Malformed coordinate matrix block: {values.shape[1]} values per line, expected 3.')
+    i = (values[:, 0] - 1).astype(np.int32)
+    j = (values[:, 1] - 1).astype(np.int32)
+    v = values[:, 2].astype(np.float32)
+    return i, j, v
 
-def read_coomat(file):
+
+def read_coomat(file, chunk_bytes=CHUNK_BYTES):
     """
     Reads a coordinate matrix (COO format) from a file.
 
     Args:
         file (Path): Path to the file.
+        chunk_bytes (int): Number of bytes read per block.
 
     Returns:
-        tuple: Lists of row indices, column indices, and values.
+        tuple: Arrays of row indices, column indices, and values.
     """
-    with open(file, 'r') as f:
-        mat = [line.rstrip().split('  ') for line in f]
+    chunks = list(iter_coomat_chunks(file, chunk_bytes))
     print('Finished loading file:', file)
-    i = [int(l[0]) - 1 for l in mat]
-    j = [int(l[1]) - 1 for l in mat]
-    v = [int(l[2]) for l in mat]
+    if not chunks:
+        return (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                np.zeros(0, dtype=np.float32))
+    i, j, v = (np.concatenate(parts) for parts in zip(*chunks))
     return i, j, v
 
 
-def compress_sparse(file):
+def read_coomat_csr(file, shape=None, chunk_bytes=CHUNK_BYTES):
     """
-    Converts a dense matrix to a sparse format and saves it as an NPZ file.
+    Builds a CSR matrix from a coordinate matrix file without materialising it as text.
+
+    probtrackx writes `fdt_matrix2.dot` row by row, so the row pointer is accumulated
+    block by block and only the column indices and values are kept. Files that are not
+    row-sorted fall back to a COO to CSR conversion, keeping the row indices from the
+    first block found out of order on.
 
     Args:
         file (Path): Path to the `.dot` file.
+        shape (tuple): Matrix shape. Inferred from the largest indices if None.
+        chunk_bytes (int): Number of bytes read per block.
+
+    Returns:
+        scipy.sparse.csr_matrix: The connectivity matrix.
+    """
+    row_counts = np.zeros(0, dtype=np.int64)
+    rows, cols, vals = [], [], []
+    n_cols = 0
+    last_row = -1
+    row_sorted = True
+    for i, j, v in iter_coomat_chunks(file, chunk_bytes):
+        if not i.size:
+            continue
+        if row_sorted and (i[0] < last_row or np.any(np.diff(i) < 0)):
+            row_sorted = False
+            # The blocks read so far were sorted, so their rows follow from the counts
+            rows.append(np.repeat(np.arange(row_counts.size, dtype=np.int32), row_counts))
+        last_row = i[-1]
+        n_cols = max(n_cols, int(j.max()) + 1)
+        if row_sorted:
+            counts = np.bincount(i)
+            if counts.size > row_counts.size:
+                counts[:row_counts.size] += row_counts
+                row_counts = counts
+            else:
+                row_counts[:counts.size] += counts
+        else:
+            rows.append(i)
+        cols.append(j)
+        vals.append(v)
+    print('Finished loading file:', file)
+
+    indices = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int32)
+    del cols
+    data = np.concatenate(vals) if vals else np.zeros(0, dtype=np.float32)
+    del vals
+    if shape is None:
+        n_rows = row_counts.size if row_sorted else max(int(r.max()) for r in rows if r.size) + 1
+        shape = (n_rows, n_cols)
+    if not row_sorted:
+        row_index = np.concatenate(rows)
+        del rows
+        return sparse.csr_matrix((data, (row_index, indices)), shape=shape)
+    del rows
+    indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+    np.cumsum(row_counts, out=indptr[1:row_counts.size + 1])
+    indptr[row_counts.size + 1:] = indptr[row_counts.size]
+    if indptr[-1] <= np.iinfo(np.int32).max:
+        indptr = indptr.astype(np.int32)
+    mat = sparse.csr_matrix((data, indices, indptr), shape=shape)
+    mat.sum_duplicates()
+    return mat
+
+
+def matrix_files(out_dir, matrix_format=MATRIX_FORMAT):
+    """
+    Lists the files holding the converted connectivity matrix.
+
+    Args:
+        out_dir (Path): probtrackx output directory.
+        matrix_format (str): 'npz' or 'csr'.
+
+    Returns:
+        list: Paths of the files.
+    """
+    if matrix_format == 'csr':
+        return store_files(out_dir / 'fdt_matrix2_csr')
+    return [out_dir / 'fdt_matrix2.npz']
+
+
+def fingerprint_files(out_dir, hemisphere, matrix_format=FINGERPRINT_FORMAT, roi=None):
+    """
+    Lists the files holding a hemisphere's fingerprint.
+
+    Args:
+        out_dir (Path): probtrackx output directory.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        matrix_format (str): 'npz', 'csr' or 'compact'.
+        roi (str): Seed ROI of a multi-ROI run, for the fingerprint of its rows only.
+
+    Returns:
+        list: Paths of the files.
+    """
+    name = f'finger_print_fiber_{hemisphere}' if roi is None else f'finger_print_fiber_{hemisphere}_{roi}'
+    if matrix_format == 'csr':
+        return store_files(out_dir / f'{name}_csr')
+    if matrix_format == 'compact':
+        return compact_files(out_dir / f'{name}_compact')
+    return [out_dir / f'{name}.npz']
+
+
+def roi_coords_file(out_dir, roi):
+    """
+    Returns the file holding the seed coordinates of one ROI's fingerprint rows.
+
+    Args:
+        out_dir (Path): probtrackx output directory.
+        roi (str): Seed ROI.
+
+    Returns:
+        Path: Path of the coordinate file.
+    """
+    return out_dir / f'{SEED_COORDS_FILE}_{roi}'
+
+
+def seed_index_file(out_dir, hemisphere, roi=None):
+    """
+    Returns the file holding the seed index of a hemisphere's fingerprint (see seed_index).
+
+    Args:
+        out_dir (Path): probtrackx output directory.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        roi (str): Seed ROI of a multi-ROI run, for the index of its fingerprint.
+
+    Returns:
+        Path: Path of the index.
+    """
+    name = f'finger_print_fiber_{hemisphere}' if roi is None else f'finger_print_fiber_{hemisphere}_{roi}'
+    return out_dir / f'{name}_seeds.npz'
+
+
+def write_seed_index(workpath, hemisphere, seed_coords, roi=None):
+    """
+    Saves the seed coordinates of a fingerprint's rows with the grid of the seed masks.
+
+    Args:
+        workpath (Path): Working directory of the subject.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        seed_coords (np.ndarray): (n_seeds, 3) voxel coordinates of the rows.
+        roi (str): Seed ROI of a multi-ROI run, for the index of its fingerprint.
+
+    Returns:
+        Path: Path of the index.
+    """
+    out_dir = Path(workpath) / f'probtrackx_{hemisphere}_omatrix2'
+    # All seed ROI masks, and so their combined mask, share the grid of the first
+    reference = load_volume(roi_mask_path(workpath, {'L': 'left', 'R': 'right'}[hemisphere], roi or PROBTRACK_SEED_ROIS[0]))
+    index_file = seed_index_file(out_dir, hemisphere, roi)
+    save_seed_index(index_file, seed_coords, reference)
+    return index_file
+
+
+def load_fingerprint(out_dir, hemisphere, matrix_format=FINGERPRINT_FORMAT, roi=None):
+    """
+    Loads a hemisphere's fingerprint, falling back to the other layouts if the requested
+    one does not exist.
+
+    Args:
+        out_dir (Path): probtrackx output directory.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        matrix_format (str): Preferred layout, 'npz', 'csr' or 'compact'.
+        roi (str): Seed ROI of a multi-ROI run, for the fingerprint of its rows only.
+
+    Returns:
+        Sparse matrix (or memory-mapped LazyCSR or CompactFingerprint), or None if no
+        layout exists.
+    """
+    for fmt in sorted(('npz', 'csr', 'compact'), key=lambda fmt: fmt != matrix_format):
+        files = fingerprint_files(out_dir, hemisphere, fmt, roi)
+        if all(path.exists() for path in files):
+            if fmt == 'compact':
+                return open_compact(files[0].parent)
+            return load_csr(files[0].parent) if fmt == 'csr' else sparse.load_npz(files[0])
+    return None
+
+
+def load_connectivity(out_dir, matrix_format=MATRIX_FORMAT):
     """
-    npz_file = file.parent / 'fdt_matrix2.npz'
-    if file.exists() and not npz_file.exists():
-        i, j, v = read_coomat(file)
-        coo_mat = sparse.csr_matrix((v, (i, j)))
-        sparse.save_npz(npz_file, coo_mat)
-        print(f"Compressed and saved: {npz_file}")
+    Loads the converted connectivity matrix, falling back to the other layout if the
+    requested one does not exist.
+
+    Args:
+        out_dir (Path): probtrackx output directory.
+        matrix_format (str): Preferred layout, 'npz' or 'csr'.
+
+    Returns:
+        Sparse matrix (or memory-mapped LazyCSR), or None if neither layout exists.
+    """
+    for fmt in sorted(('npz', 'csr'), key=lambda fmt: fmt != matrix_format):
+        files = matrix_files(out_dir, fmt)
+        if all(path.exists() for path in files):
+            return load_csr(files[0].parent) if fmt == 'csr' else sparse.load_npz(files[0])
+    return None
+
+
+def matrix_shape(out_dir):
+    """
+    Reads the shape of fdt_matrix2 from the seed and target coordinate files probtrackx
+    writes next to it (one line per row and per column). The largest index in the `.dot`
+    file only gives a lower bound, as the last seeds or targets may have no streamlines.
+
+    Args:
+        out_dir (Path): probtrackx output directory.
+
+    Returns:
+        tuple: (n_seeds, n_targets), or None if the coordinate files are missing.
+    """
+    counts = []
+    for name in ('coords_for_fdt_matrix2', 'tract_space_coords_for_fdt_matrix2'):
+        coords_file = out_dir / name
+        if not coords_file.exists():
+            return None
+        with open(coords_file, 'rb') as f:
+            counts.append(sum(1 for line in f if line.strip()))
+    return tuple(counts)
+
+
+def compress_sparse(file, overwrite=False, matrix_format=MATRIX_FORMAT):
+    """
+    Converts a coordinate matrix to a sparse format and saves it as an NPZ file, or in
+    the memory-mappable layout when `matrix_format` is 'csr'.
+
+    The `.dot` file is streamed in `CHUNK_BYTES` blocks, so peak memory follows the
+    number of non-zeros rather than the size of the text. The parse throughput is
+    reported in MB/s so runs can be compared against the expected disk read rate.
+
+    Args:
+        file (Path): Path to the `.dot` file.
+        overwrite (bool): Whether to replace an existing converted matrix.
+        matrix_format (str): 'npz' or 'csr'.
+    """
+    out_file = matrix_files(file.parent, matrix_format)[0]
+    if file.exists() and (overwrite or not out_file.exists()):
+        size_mb = file.stat().st_size / 1e6
+        start = time.perf_counter()
+        csr_mat = read_coomat_csr(file, matrix_shape(file.parent))
+        elapsed = time.perf_counter() - start
+        print(f"Parsed {size_mb:.1f} MB in {elapsed:.1f} s ({size_mb / max(elapsed, 1e-9):.1f} MB/s)")
+        if matrix_format == 'csr':
+            save_csr(out_file.parent, csr_mat)
+        else:
+            sparse.save_npz(out_file, csr_mat)
+        print(f"Compressed and saved: {out_file}")
         os.remove(file)
     else:
         print(f"File already processed or does not exist: {file}")
 
 
-def PostProbtrack(work_dir, hemisphere):
+def merge_shard_matrices(out_dir, overwrite=False, matrix_format=MATRIX_FORMAT):
+    """
+    Converts the `.dot` files of a seed-sharded probtrackx run (see seed_shards.py) and
+    merges them into the matrix of the unsharded run, saved like `compress_sparse` does.
+    The merged seed and target coordinates and the total waytotal are written to
+    `out_dir`, where an unsharded run would have put them.
+
+    Args:
+        out_dir (Path): probtrackx output directory holding the shard_<k>/ directories.
+        overwrite (bool): Whether to replace an existing converted matrix.
+        matrix_format (str): 'npz' or 'csr'.
+    """
+    shard_dirs = sorted(path for path in out_dir.glob(f'{SHARD_PREFIX}*') if (path / 'fdt_matrix2.dot').exists())
+    out_file = matrix_files(out_dir, matrix_format)[0]
+    if not shard_dirs or (out_file.exists() and not overwrite):
+        print(f"Shards already merged or do not exist: {out_dir}")
+        return
+    start = time.perf_counter()
+    csr_mat, seed_coords, target_coords, waytotal = merge_shards(
+        shard_dirs, lambda directory, shape: read_coomat_csr(Path(directory) / 'fdt_matrix2.dot', shape))
+    print(f"Merged {len(shard_dirs)} shards in {time.perf_counter() - start:.1f} s")
+    if matrix_format == 'csr':
+        save_csr(out_file.parent, csr_mat)
+    else:
+        sparse.save_npz(out_file, csr_mat)
+    write_coords(out_dir / SEED_COORDS_FILE, seed_coords)
+    write_coords(out_dir / TARGET_COORDS_FILE, target_coords)
+    with open(out_dir / 'waytotal', 'w') as f:
+        f.write(f"{waytotal:.17g}\n")
+    print(f"Compressed and saved: {out_file}")
+    for shard in shard_dirs:
+        os.remove(shard / 'fdt_matrix2.dot')
+
+
+def PostProbtrack(work_dir, hemisphere, overwrite=False):
     """
-    Converts output files from probtrackx2 to sparse format for a given hemisphere.
+    Converts output files from probtrackx2 to sparse format for a given hemisphere,
+    merging the shards of a seed-sharded run. The summed matrix of an adaptive run is
+    already saved as fdt_matrix2.npz and is only converted when MATRIX_FORMAT is 'csr'.
 
     Args:
         work_dir (str): Working directory of the subject.
         hemisphere (str): Hemisphere ('R' or 'L').
+        overwrite (bool): Whether to replace an existing converted matrix.
     """
     work_dir = Path(work_dir)
-    file = work_dir / f'probtrackx_{hemisphere}_omatrix2' / 'fdt_matrix2.dot'
-    compress_sparse(file)
+    out_dir = work_dir / f'probtrackx_{hemisphere}_omatrix2'
+    if any(out_dir.glob(f'{SHARD_PREFIX}*/fdt_matrix2.dot')):
+        merge_shard_matrices(out_dir, overwrite)
+    elif MATRIX_FORMAT == 'csr' and not (out_dir / 'fdt_matrix2.dot').exists() and \
+            (out_dir / 'fdt_matrix2.npz').exists():
+        out_file = matrix_files(out_dir)[0]
+        save_csr(out_file.parent, sparse.load_npz(out_dir / 'fdt_matrix2.npz'))
+        print(f"Converted and saved: {out_file}")
+    else:
+        compress_sparse(out_dir / 'fdt_matrix2.dot', overwrite)
 
 
-def fiber2target(no_diff_path, fiber):
+def stage_spec(workpath, hemisphere):
     """
-    Maps fiber data to target ROIs.
+    Declares the inputs, outputs and parameters of the post-processing stage for one hemisphere.
 
     Args:
-        no_diff_path (Path): Path to the nodif_brain_mask NIfTI file.
-        fiber (Path): Path to the fiber bundle segmentations NIfTI file.
+        workpath (Path): Working directory of the subject.
+        hemisphere (str): Hemisphere ('R' or 'L').
 
     Returns:
-        tuple: Sparse matrix of fiber-to-target connections and ROI sizes.
+        StageSpec: Declaration of the stage.
     """
-    fiber_img = nib.load(fiber).get_fdata()
-    roi_size = np.array([fiber_img[..., i].sum() for i in range(fiber_img.shape[-1])])
-    mask_img = nib.load(no_diff_path).get_fdata()
-    z, y, x = np.nonzero(mask_img.T)
+    workpath = Path(workpath)
+    out_dir = workpath / f'probtrackx_{hemisphere}_omatrix2'
+    # One .dot file, one per shard when probtrackx ran seed-sharded, or the summed
+    # fdt_matrix2.npz of an adaptive run
+    probtrack_spec = probtrack_stage_spec(str(workpath), {'L': 'left', 'R': 'right'}[hemisphere])
+    matrices = probtrack_spec.outputs
+    inputs = matrices + [str(workpath / 'DTI' / 'LowResMask.nii.gz')] + bundle_stage_spec(str(workpath)).outputs
+    if NORMALIZATION == 'waytotal':
+        inputs += [str(Path(matrix).parent / 'waytotal') for matrix in matrices]
+    outputs = matrix_files(out_dir) + fingerprint_files(out_dir, hemisphere)
+    params = {'normalization': NORMALIZATION, 'matrix_format': MATRIX_FORMAT}
+    if FINGERPRINT_QUANTIZATION:
+        params['quantization'] = FINGERPRINT_QUANTIZATION
+    if len(PROBTRACK_SEED_ROIS) > 1:
+        inputs.append(str(out_dir / ROI_LABELS_FILE))
+        for roi in PROBTRACK_SEED_ROIS:
+            outputs += fingerprint_files(out_dir, hemisphere, roi=roi) + [roi_coords_file(out_dir, roi)]
+        params['seed_rois'] = PROBTRACK_SEED_ROIS
+    return StageSpec(
+        name=f'post_probtrack_{hemisphere}',
+        inputs=inputs,
+        outputs=[str(path) for path in outputs],
+        params=params,
+        transient=probtrack_spec.transient,
+    )
+
+
+def process_hemisphere(workpath, hemisphere):
+    """
+    Converts the probtrackx2 output and regenerates the fingerprint when any input changed.
+
+    Args:
+        workpath (Path): Working directory of the subject.
+        hemisphere (str): Hemisphere ('R' or 'L').
+
+    Returns:
+        bool: True if the stage is up to date, either already or after this run.
+    """
+    spec = stage_spec(workpath, hemisphere)
+    if is_up_to_date(workpath, spec):
+        print(f"Post-processing already up to date for {hemisphere}: {workpath}")
+        return True
+    # The bundle projection is one of the inputs and is only built on first use, from its own inputs
+    projection = bundle_stage_spec(str(workpath))
+    missing = [file for file in spec.inputs if file not in projection.outputs and not os.path.exists(file)]
+    missing += [file for file in projection.inputs if not os.path.exists(file)]
+    if missing:
+        print(f"File missing for {hemisphere}: {missing[0]}")
+        return False
+    bundle_targets(str(workpath))
+    # The .dot file is deleted once converted, so capture its hash first
+    inputs = snapshot_inputs(workpath, spec)
+    with track_stage(workpath, spec.name, 'compress_sparse'):
+        PostProbtrack(workpath, hemisphere, overwrite=True)
+    with track_stage(workpath, spec.name, 'fingerprint'):
+        get_fiber_fingerprint(workpath, hemisphere, recreation=True)
+    if len(PROBTRACK_SEED_ROIS) > 1:
+        with track_stage(workpath, spec.name, 'split_rois'):
+            split_roi_fingerprints(workpath, hemisphere)
+    return record_stage(workpath, spec, inputs)
+
+
+def split_roi_fingerprints(workpath, hemisphere, rois=PROBTRACK_SEED_ROIS, matrix_format=FINGERPRINT_FORMAT):
+    """
+    Splits the fingerprint of a multi-ROI run into one fingerprint per seed ROI (see
+    seed_rois.py), each with the seed coordinates of its rows.
 
-    if fiber_img.shape[:3] != mask_img.shape:
-        fiber_img = reshape_fiber(fiber_img, mask_img)
+    The rows keep their probtrackx order within each ROI. With the memory-mappable layout,
+    the fingerprint is streamed in blocks and every ROI's rows are written as they come.
+    Compact fingerprints are split without being decoded, keeping their quantization.
 
-    mat = fiber_img[x, y, z, :]
-    return sparse.csr_matrix(mat), roi_size
+    Args:
+        workpath (Path): Working directory of the subject.
+        hemisphere (str): Hemisphere ('R' or 'L').
+        rois (list): Seed ROIs, in the order of their labels.
+        matrix_format (str): 'npz', 'csr' or 'compact'.
+    """
+    out_dir = Path(workpath) / f'probtrackx_{hemisphere}_omatrix2'
+    fp = load_fingerprint(out_dir, hemisphere, matrix_format)
+    seed_coords = read_coords(out_dir / SEED_COORDS_FILE)
+    row_roi = row_rois(out_dir / ROI_LABELS_FILE, seed_coords)
+    if matrix_format == 'compact':
+        for index, roi in enumerate(rois, 1):
+            rows = np.flatnonzero(row_roi == index)
+            fp.save_rows(fingerprint_files(out_dir, hemisphere, 'compact', roi)[0].parent, rows, seed_coords[rows])
+    elif matrix_format == 'csr':
+        writers = [CSRWriter(fingerprint_files(out_dir, hemisphere, 'csr', roi)[0].parent, fp.shape[1], fp.dtype)
+                   for roi in rois]
+        split_rows(fp, row_roi, len(rois), writers)
+    else:
+        for roi, roi_fp in zip(rois, split_rows(fp, row_roi, len(rois))):
+            sparse.save_npz(fingerprint_files(out_dir, hemisphere, 'npz', roi)[0], roi_fp)
+    for index, roi in enumerate(rois, 1):
+        write_coords(roi_coords_file(out_dir, roi), seed_coords[row_roi == index])
+        write_seed_index(workpath, hemisphere, seed_coords[row_roi == index], roi)
+        print(f"Saved {roi} fingerprint ({int((row_roi == index).sum())} seeds) for {hemisphere} hemisphere")
 
 
-def reshape_fiber(fiber_img, mask_img):
+def fiber2target(no_diff_path, fiber):
     """
-    Reshapes the fiber image to match the mask dimensions.
+    Maps fiber data to target ROIs.
+
+    The pipeline now computes this matrix straight from the high-resolution segmentation
+    (see bundle_projection); this function is kept for existing LowRes_Fibers volumes.
+
+    The bundle volume is read in its native (uint8) dtype, memory-mapped when the file is
+    uncompressed, and only the rows of the target mask voxels are gathered. Mask voxels
+    outside the fiber volume (when the shapes differ) get empty rows, which matches
+    padding the fiber volume with zeros or cropping it to the mask.
 
     Args:
-        fiber_img (np.ndarray): Fiber image data.
-        mask_img (np.ndarray): Mask image data.
+        no_diff_path (Path): Path to the nodif_brain_mask NIfTI file.
+        fiber (Path): Path to the fiber bundle segmentations NIfTI file.
 
     Returns:
-        np.ndarray: Reshaped fiber image.
+        tuple: Sparse matrix of fiber-to-target connections and ROI sizes.
     """
-    new_shape = mask_img.shape + (fiber_img.shape[-1],)
-    reshaped_img = np.zeros(new_shape)
-    common_dims = tuple(min(a, b) for a, b in zip(fiber_img.shape[:3], mask_img.shape))
-    reshaped_img[:common_dims[0], :common_dims[1], :common_dims[2], :] = fiber_img[:common_dims[0], :common_dims[1], :common_dims[2], :]
-    return reshaped_img
+    fiber_data = np.asanyarray(load_volume(fiber).dataobj)
+    roi_size = fiber_data.sum(axis=(0, 1, 2), dtype=np.float64)
+
+    mask_data = np.asanyarray(load_volume(no_diff_path).dataobj)
+    # Column order of probtrackx's target2 matrix: x fastest, then y, then z
+    x, y, z = np.unravel_index(np.flatnonzero(mask_data.ravel(order='F')), mask_data.shape, order='F')
 
+    inside = (x < fiber_data.shape[0]) & (y < fiber_data.shape[1]) & (z < fiber_data.shape[2])
+    rows = np.flatnonzero(inside)
+    block = fiber_data[x[inside], y[inside], z[inside], :]
+    block_rows, cols = np.nonzero(block)
+    mat = sparse.csr_matrix(
+        (block[block_rows, cols].astype(np.float64), (rows[block_rows], cols)),
+        shape=(x.size, fiber_data.shape[-1]),
+    )
+    return mat, roi_size
 
-def get_fiber_fingerprint(workpath, hemisphere, recreation=False):
+
+def get_fiber_fingerprint(workpath, hemisphere, recreation=False, normalization=NORMALIZATION):
     """
     Generates and normalizes fiber fingerprints for a given hemisphere.
 
+    When the connectivity matrix is stored in the memory-mappable layout, it is
+    multiplied block by block from disk and the normalized fingerprint rows are written
+    as they are computed, so the matrix never has to fit in memory. All normalization
+    modes are row-local, so this gives the same fingerprint as the in-memory path.
+
+    The voxel coordinates of the rows are saved next to the fingerprint, as its seed
+    index (see seed_index and write_seed_index).
+
     Args:
         workpath (Path): Working directory of the subject.
         hemisphere (str): Hemisphere ('R' or 'L').
         recreation (bool): Whether to recreate fingerprints if they exist.
+        normalization (str): One of NORMALIZATION_MODES.
     """
     workpath = Path(workpath)
-    file = workpath / f'probtrackx_{hemisphere}_omatrix2' / 'fdt_matrix2.npz'
-    target_file = workpath / f'probtrackx_{hemisphere}_omatrix2' / f'finger_print_fiber_{hemisphere}.npz'
-
-    if file.exists() and (not target_file.exists() or recreation):
-        print(f"Generating fingerprint for {hemisphere} hemisphere from {file}")
-        no_diff_path = workpath / 'DTI' / 'LowResMask.nii.gz'
-        fiber = workpath / 'DTI' / 'LowRes_Fibers.nii.gz'
-        sps_mat = sparse.load_npz(file)
-        mat, roi_size = fiber2target(no_diff_path, fiber)
-        fp = sps_mat.dot(mat)
-        fp = normalize_fingerprint(fp, roi_size)
-        sparse.save_npz(target_file, fp)
+    out_dir = workpath / f'probtrackx_{hemisphere}_omatrix2'
+    target_file = fingerprint_files(out_dir, hemisphere)[0]
+    sps_mat = load_connectivity(out_dir) if not target_file.exists() or recreation else None
+
+    if sps_mat is not None:
+        print(f"Generating fingerprint for {hemisphere} hemisphere from {out_dir}")
+        mat, roi_size = bundle_targets(str(workpath))
+        waytotal = None
+        if normalization == 'waytotal':
+            waytotal = read_waytotal(out_dir / 'waytotal')
+        coords_file = out_dir / SEED_COORDS_FILE
+        seed_coords = read_coords(coords_file) if coords_file.exists() else None
+        if FINGERPRINT_QUANTIZATION:
+            # The fingerprint (seeds x bundles) fits in memory even when the matrix does not
+            if MATRIX_FORMAT == 'csr':
+                fp = blocked_dot(sps_mat, mat,
+                                 transform=lambda block: normalize_fingerprint(block, roi_size, normalization, waytotal))
+            else:
+                fp = normalize_fingerprint(sps_mat.dot(mat), roi_size, normalization, waytotal)
+            header = save_compact(target_file.parent, fp, FINGERPRINT_QUANTIZATION, seed_coords)
+            print(f"Quantized fingerprint to {FINGERPRINT_QUANTIZATION}, max error {header['max_abs_error']:.3g} "
+                  f"({header['max_rel_error']:.3g} of the bundle maximum)")
+        elif MATRIX_FORMAT == 'csr':
+            writer = CSRWriter(target_file.parent, mat.shape[1])
+            blocked_dot(sps_mat, mat, writer,
+                        transform=lambda block: normalize_fingerprint(block, roi_size, normalization, waytotal))
+        else:
+            fp = sps_mat.dot(mat)
+            fp = normalize_fingerprint(fp, roi_size, normalization, waytotal)
+            sparse.save_npz(target_file, fp)
         print(f"Saved fingerprint for {hemisphere} hemisphere: {target_file}")
+        if seed_coords is not None:
+            write_seed_index(workpath, hemisphere, seed_coords)
     else:
-        print(f"Fingerprint already exists or file missing for {hemisphere}: {file}")
+        print(f"Fingerprint already exists or file missing for {hemisphere}: {out_dir}")
 
 
-def normalize_fingerprint(fp, roi_size):
+def read_waytotal(file):
     """
-    Normalizes a fingerprint matrix by ROI sizes.
+    Reads the number of streamlines that reached the targets, as written by probtrackx.
+
+    Args:
+        file (Path): Path to the `waytotal` file.
+
+    Returns:
+        float: Total number of valid streamlines.
+    """
+    return float(np.loadtxt(file).sum())
+
+
+def normalize_fingerprint(fp, roi_size, mode=NORMALIZATION, waytotal=None):
+    """
+    Normalizes a fingerprint matrix without densifying it.
+
+    Modes:
+        roi_size: divides each bundle column by the bundle's voxel count, as one diagonal
+            scaling of the non-zeros. Empty bundles have no non-zeros and are left at zero.
+        roi_size_log: roi_size followed by log1p of the values.
+        l1, l2: scales every seed row to unit L1 or L2 norm.
+        waytotal: divides by the number of valid streamlines reported by probtrackx.
 
     Args:
         fp (sparse matrix): Fingerprint matrix.
         roi_size (np.ndarray): Sizes of ROIs.
+        mode (str): One of NORMALIZATION_MODES.
+        waytotal (float): Streamline count, required for the waytotal mode.
 
     Returns:
         sparse matrix: Normalized fingerprint matrix.
     """
-    for i in range(len(roi_size)):
-        fp[:, i] /= roi_size[i]
+    if mode not in NORMALIZATION_MODES:
+        raise ValueError(f"Unknown normalization mode {mode!r}; expected one of {NORMALIZATION_MODES}.")
+    fp = sparse.csr_matrix(fp, dtype=np.result_type(fp.dtype, np.float32))
+
+    if mode in ('roi_size', 'roi_size_log'):
+        roi_size = np.asarray(roi_size, dtype=np.float64)
+        scale = np.divide(1.0, roi_size, out=np.zeros_like(roi_size), where=roi_size > 0)
+        fp.data *= scale[fp.indices].astype(fp.dtype, copy=False)
+        if mode == 'roi_size_log':
+            np.log1p(fp.data, out=fp.data)
+    elif mode in ('l1', 'l2'):
+        fp = normalize(fp, norm=mode, axis=1, copy=False)
+    elif mode == 'waytotal':
+        if not waytotal:
+            raise ValueError("The waytotal normalization requires a non-zero waytotal.")
+        fp.data /= waytotal
     return fp
 
 
@@ -150,8 +681,7 @@ def main():
         workpath = os.path.join(data_directory, subject_dir)
         if os.path.isdir(workpath):
             for hemisphere in ['R', 'L']:
-                PostProbtrack(workpath, hemisphere)
-                get_fiber_fingerprint(workpath, hemisphere)
+                process_hemisphere(workpath, hemisphere)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,248 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+from volume_cache import load_volume, save_volume
+
+"""
+Native replacement for `flirt -ref REF -in IN -applyisoxfm N -interp nearestneighbour`.
+
+flirt first resamples the reference to an isotropic N mm grid covering the same field of
+view (truncating the number of voxels per axis), then maps every output voxel through the
+identity transform in FSL's scaled-mm coordinates (voxel * pixdim, with the x axis flipped
+for images with a positive-determinant, i.e. neurological, voxel-to-world matrix) and
+takes the nearest input voxel. Voxels falling outside the input are set to zero.
+
+Because the transform is axis-aligned, the sampling grid reduces to one index vector per
+axis. The vectors are cached per (input geometry, reference geometry, resolution), so
+resampling the many masks of a subject, which all share the same geometry, computes the
+grid once and then only costs a fancy-indexing gather per volume.
+"""
+
+# Cache of sampling grids keyed by input geometry, reference geometry and resolution
+_GRID_CACHE = {}
+
+
+def image_geometry(img):
+    """
+    Extracts the parts of an image header that determine the sampling grid.
+    Args:
+        img (nib.Nifti1Image): Image to describe.
+    Returns:
+        tuple: Spatial shape, voxel sizes and whether FSL flips the x axis.
+    """
+    shape = tuple(int(n) for n in img.shape[:3])
+    zooms = tuple(float(z) for z in img.header.get_zooms()[:3])
+    flip_x = bool(np.linalg.det(img.affine[:3, :3]) > 0)
+    return shape, zooms, flip_x
+
+
+def iso_shape(ref_shape, ref_zooms, resolution):
+    """
+    Computes the shape of the isotropic grid flirt derives from the reference.
+    Args:
+        ref_shape (tuple): Spatial shape of the reference.
+        ref_zooms (tuple): Voxel sizes of the reference in mm.
+        resolution (float): Isotropic output resolution in mm.
+    Returns:
+        tuple: Spatial shape of the output grid.
+    """
+    # The small tolerance protects against 0.7mm voxel sizes that are not exact in float
+    return tuple(max(1, int(n * z / resolution + 1e-4)) for n, z in zip(ref_shape, ref_zooms))
+
+
+def source_coordinates(src_geometry, ref_geometry, resolution):
+    """
+    Maps the centres of the output voxels to continuous input voxel coordinates.
+    Args:
+        src_geometry (tuple): Geometry of the input as returned by `image_geometry`.
+        ref_geometry (tuple): Geometry of the reference as returned by `image_geometry`.
+        resolution (float): Isotropic output resolution in mm.
+    Returns:
+        tuple: Output shape and, per axis, the input voxel coordinate of every output position.
+    """
+    src_shape, src_zooms, src_flip = src_geometry
+    ref_shape, ref_zooms, ref_flip = ref_geometry
+    out_shape = iso_shape(ref_shape, ref_zooms, resolution)
+
+    coordinates = []
+    for axis in range(3):
+        out_mm = np.arange(out_shape[axis], dtype=np.float64) * resolution
+        if axis == 0 and ref_flip:
+            out_mm = out_mm[::-1]
+        src_vox = out_mm / src_zooms[axis]
+        if axis == 0 and src_flip:
+            src_vox = (src_shape[axis] - 1) - src_vox
+        coordinates.append(src_vox)
+    return out_shape, tuple(coordinates)
+
+
+def sampling_grid(src_geometry, ref_geometry, resolution):
+    """
+    Computes (or returns the cached) nearest-neighbour source index for each output voxel.
+    Args:
+        src_geometry (tuple): Geometry of the input as returned by `image_geometry`.
+        ref_geometry (tuple): Geometry of the reference as returned by `image_geometry`.
+        resolution (float): Isotropic output resolution in mm.
+    Returns:
+        tuple: Output shape, per-axis source indices (clipped into range) and per-axis
+        masks of output positions that fall inside the source.
+    """
+    key = (src_geometry, ref_geometry, float(resolution))
+    if key in _GRID_CACHE:
+        return _GRID_CACHE[key]
+
+    src_shape = src_geometry[0]
+    out_shape, coordinates = source_coordinates(src_geometry, ref_geometry, resolution)
+
+    indices, inside = [], []
+    for axis, src_vox in enumerate(coordinates):
+        # newimage rounds half up for nearest-neighbour interpolation
+        nearest = np.floor(src_vox + 0.5).astype(np.intp)
+        valid = (nearest >= 0) & (nearest < src_shape[axis])
+        indices.append(np.clip(nearest, 0, src_shape[axis] - 1))
+        inside.append(valid)
+
+    grid = (out_shape, tuple(indices), tuple(inside))
+    _GRID_CACHE[key] = grid
+    return grid
+
+
+def iso_affine(ref_img, resolution):
+    """
+    Computes the voxel-to-world matrix flirt writes for the isotropic output.
+    Args:
+        ref_img (nib.Nifti1Image): Reference image.
+        resolution (float): Isotropic output resolution in mm.
+    Returns:
+        np.ndarray: 4x4 affine of the output grid.
+    """
+    affine = ref_img.affine.copy()
+    # Rescale the columns rather than multiplying by resolution / pixdim, so that the
+    # float32 rounding of sub-millimetre voxel sizes does not leak into the output
+    affine[:3, :3] *= resolution / np.linalg.norm(affine[:3, :3], axis=0)
+    return affine
+
+
+def resample_array(data, src_geometry, ref_geometry, resolution):
+    """
+    Resamples a 3D or 4D array with the cached nearest-neighbour grid.
+    Args:
+        data (np.ndarray): Input data; any trailing axes beyond the third are carried along.
+        src_geometry (tuple): Geometry of the input.
+        ref_geometry (tuple): Geometry of the reference.
+        resolution (float): Isotropic output resolution in mm.
+    Returns:
+        np.ndarray: Resampled data with the same dtype as the input.
+    """
+    out_shape, indices, inside = sampling_grid(src_geometry, ref_geometry, resolution)
+    out = data[np.ix_(*indices)]
+    for axis, valid in enumerate(inside):
+        if not valid.all():
+            selector = [slice(None)] * out.ndim
+            selector[axis] = ~valid
+            out[tuple(selector)] = 0
+    return out
+
+
+def resample_image(input_img, ref_img, resolution):
+    """
+    Resamples an image onto the isotropic grid derived from the reference.
+    Args:
+        input_img (nib.Nifti1Image): Image to resample.
+        ref_img (nib.Nifti1Image): Reference image.
+        resolution (float): Isotropic output resolution in mm.
+    Returns:
+        nib.Nifti1Image: The resampled image.
+    """
+    data = np.asanyarray(input_img.dataobj)
+    out = resample_array(data, image_geometry(input_img), image_geometry(ref_img), resolution)
+    affine = iso_affine(ref_img, resolution)
+    header = input_img.header.copy()
+    header.set_data_shape(out.shape)
+    header.set_zooms((resolution,) * 3 + tuple(input_img.header.get_zooms()[3:]))
+    out_img = nib.Nifti1Image(out, affine, header)
+    out_img.set_sform(affine, int(ref_img.header["sform_code"]) or 1)
+    out_img.set_qform(affine, int(ref_img.header["qform_code"]) or 1)
+    return out_img
+
+
+def resample_iso(input_path, ref_path, output_paths, resolution):
+    """
+    Resamples a NIfTI file and saves the result, mirroring `flirt -applyisoxfm`.
+    Args:
+        input_path (str): Path to the input NIfTI file.
+        ref_path (str): Path to the reference NIfTI file.
+        output_paths (str or list): Path, or paths, to save the output NIfTI file to.
+        resolution (float): Isotropic resolution for the output.
+    """
+    if isinstance(output_paths, (str, os.PathLike)):
+        output_paths = [output_paths]
+    input_img = load_volume(input_path)
+    ref_img = input_img if os.path.abspath(ref_path) == os.path.abspath(input_path) else load_volume(ref_path)
+    out_img = resample_image(input_img, ref_img, resolution)
+    for output_path in output_paths:
+        save_volume(out_img, output_path)
+        print(f"Generated {output_path} at {resolution}mm resolution.")
+
+
+def benchmark_subject(subject_path, resolution=3):
+    """
+    Times flirt against the native resampler on a subject's T1 and seed masks and checks
+    that both produce identical voxels.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        resolution (float): Isotropic resolution for the output.
+    Returns:
+        dict: Total seconds for flirt and for the native resampler, and the files that differ.
+    """
+    t1_dir = os.path.join(subject_path, "T1")
+    inputs = [os.path.join(t1_dir, "T1w_acpc_dc_restore_brain.nii.gz")]
+    inputs += [os.path.join(t1_dir, f"{hemisphere}_{roi}_mask.nii.gz")
+               for roi in ("striatum", "cortex", "white") for hemisphere in ("left", "right")]
+    inputs = [path for path in inputs if os.path.exists(path)]
+
+    results = {"flirt_seconds": 0.0, "native_seconds": 0.0, "mismatches": []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for index, input_path in enumerate(inputs):
+            flirt_out = os.path.join(tmp_dir, f"flirt_{index}.nii.gz")
+            native_out = os.path.join(tmp_dir, f"native_{index}.nii.gz")
+
+            start = time.perf_counter()
+            subprocess.run(["flirt", "-ref", input_path, "-in", input_path, "-o", flirt_out,
+                            "-applyisoxfm", str(resolution), "-interp", "nearestneighbour"], check=True)
+            results["flirt_seconds"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            resample_iso(input_path, input_path, native_out, resolution)
+            results["native_seconds"] += time.perf_counter() - start
+
+            flirt_data = np.asanyarray(nib.load(flirt_out).dataobj)
+            native_data = np.asanyarray(nib.load(native_out).dataobj)
+            if flirt_data.shape != native_data.shape or not np.array_equal(flirt_data, native_data):
+                results["mismatches"].append(input_path)
+
+    speedup = results["flirt_seconds"] / max(results["native_seconds"], 1e-9)
+    print(f"{os.path.basename(subject_path)}: flirt {results['flirt_seconds']:.1f}s, "
+          f"native {results['native_seconds']:.1f}s ({speedup:.1f}x), "
+          f"{len(results['mismatches'])} mismatching file(s)")
+    return results
+
+
+def main():
+    """
+    Benchmarks the native resampler against flirt for the subjects given on the command line.
+    """
+    if shutil.which("flirt") is None:
+        print("flirt not found in PATH; cannot benchmark against FSL.")
+        return
+    for subject_path in sys.argv[1:]:
+        benchmark_subject(subject_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+import argparse
+import glob
+import os
+import time
+from collections import namedtuple
+import numpy as np
+from adaptive_sampling import max_samples
+from instrumentation import append_metrics, load_metrics
+from run_probtrack import PROBTRACK_SEED_ROIS
+from seed_rois import roi_mask_path
+from volume_cache import load_volume
+
+"""
+Predicts the peak RAM, GPU memory and runtime of each pipeline stage for a subject.
+
+Each stage is modelled per resource as a line, intercept + slope * feature, in one
+measurable feature of its inputs:
+
+    bedpostx         brain_kvoxels    thousands of voxels in DTI/nodif_brain_mask (bedpostX's nvox)
+    probtrack        seed_msamples    seed voxels of the seed ROIs x samples per seed, in millions
+    post_probtrack   dot_mb           size of the fdt_matrix2.dot file(s) in MB
+
+The other stages are modelled as constants. Until a stage has MIN_HISTORY measured runs,
+the lines of DEFAULT_MODELS are used. Once it has, they are fitted by least squares to
+the runs logged in <subject>/.pipeline/metrics (see instrumentation): the peak RSS over
+the steps of a run, and its span from the first step's start to the last step's end.
+The prediction is the fitted line plus RESIDUAL_SIGMAS standard deviations of its
+residuals, so that a budget packed with predictions is rarely exceeded.
+
+The instrumentation does not measure GPU memory, so the GPU lines keep their defaults
+unless the logged runs carry a gpu_memory_mb field.
+
+A run is paired with its features through the estimate that `log_estimate` appends to
+the stage's log when the cohort scheduler starts the job. The .dot files are deleted by
+post_probtrack, so this record is the only place their size survives. Runs logged
+before any estimate take the features that can still be read from the subject's files.
+
+    python resource_model.py /path/to/dataset     # fitted models of a cohort
+"""
+
+# Define the root data directory
+DATA_DIRECTORY = "/home/test/lmq/data/HCP"
+
+RESOURCES = ("ram_mb", "gpu_mb", "runtime_s")
+
+# Feature each stage's resources scale with; stages not listed are modelled as constants
+STAGE_FEATURES = {"bedpostx": "brain_kvoxels", "probtrack": "seed_msamples", "post_probtrack": "dot_mb"}
+
+# (intercept, slope) of each resource, used until a stage has MIN_HISTORY measured runs
+DEFAULT_MODELS = {
+    "masks": {"ram_mb": (1500, 0), "gpu_mb": (0, 0), "runtime_s": (60, 0)},
+    "seeds": {"ram_mb": (1500, 0), "gpu_mb": (0, 0), "runtime_s": (60, 0)},
+    "bedpostx": {"ram_mb": (2000, 1.0), "gpu_mb": (1000, 4.0), "runtime_s": (600, 10.0)},
+    "tractseg": {"ram_mb": (8000, 0), "gpu_mb": (4000, 0), "runtime_s": (300, 0)},
+    "bundle_targets": {"ram_mb": (2000, 0), "gpu_mb": (0, 0), "runtime_s": (60, 0)},
+    "probtrack": {"ram_mb": (3000, 0), "gpu_mb": (2000, 20.0), "runtime_s": (60, 0.5)},
+    "post_probtrack": {"ram_mb": (1000, 3.0), "gpu_mb": (0, 0), "runtime_s": (30, 0.2)},
+}
+
+# Measured runs a stage needs before its models are fitted; override with RESOURCE_MIN_HISTORY
+MIN_HISTORY = int(os.environ.get("RESOURCE_MIN_HISTORY", "3"))
+
+# Residual standard deviations added to a fitted prediction; override with RESOURCE_SIGMAS
+RESIDUAL_SIGMAS = float(os.environ.get("RESOURCE_SIGMAS", "2"))
+
+# Predicted resources of one job
+Estimate = namedtuple("Estimate", ["ram_mb", "gpu_mb", "runtime_s"])
+
+# A fitted or default line; n is the number of runs it was fitted to (0 for a default)
+Model = namedtuple("Model", ["intercept", "slope", "sigma", "n"])
+
+
+def stage_kind(stage):
+    """
+    Strips the hemisphere from a stage name ('post_probtrack_R' -> 'post_probtrack').
+    """
+    for suffix in ("_left", "_right", "_R", "_L"):
+        if stage.endswith(suffix):
+            return stage[:-len(suffix)]
+    return stage
+
+
+def _mask_voxels(path):
+    return int(np.count_nonzero(np.asanyarray(load_volume(path).dataobj))) if os.path.exists(path) else None
+
+
+def stage_features(subject_path, stage):
+    """
+    Measures the feature a stage's resources are modelled on.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        stage (str): Stage or job name, e.g. 'probtrack_left'.
+    Returns:
+        dict: Feature name -> value; empty for constant stages, None where the inputs are missing.
+    """
+    kind = stage_kind(stage)
+    if kind == "bedpostx":
+        nvox = _mask_voxels(os.path.join(subject_path, "DTI", "nodif_brain_mask.nii.gz"))
+        return {"brain_kvoxels": None if nvox is None else nvox / 1000}
+    if kind == "probtrack":
+        counts = [_mask_voxels(roi_mask_path(subject_path, stage.rsplit('_', 1)[1], roi)) for roi in PROBTRACK_SEED_ROIS]
+        return {"seed_msamples": None if None in counts else sum(counts) * max_samples() / 1e6}
+    if kind == "post_probtrack":
+        out_dir = os.path.join(subject_path, f"probtrackx_{stage.rsplit('_', 1)[1]}_omatrix2")
+        dot_files = glob.glob(os.path.join(out_dir, "fdt_matrix2.dot")) + \
+            glob.glob(os.path.join(out_dir, "*", "fdt_matrix2.dot"))
+        return {"dot_mb": sum(os.path.getsize(path) for path in dot_files) / 1024 / 1024 if dot_files else None}
+    return {}
+
+
+def stage_runs(entries):
+    """
+    Groups logged entries into runs: the entries of a subject's stage that follow one of
+    its estimates, up to the next.
+    Args:
+        entries (list): Logged entries, as returned by instrumentation.load_metrics.
+    Returns:
+        list: (subject, stage, features, measurements) of every run with at least one
+        measured step; features is None for runs logged before any estimate.
+    """
+    groups = {}
+    for entry in entries:
+        groups.setdefault((entry.get("subject"), entry.get("stage")), []).append(entry)
+    runs = []
+    for (subject, stage), group in groups.items():
+        group.sort(key=lambda entry: entry.get("start", 0))
+        current = (None, [])
+        for entry in group + [None]:
+            if entry is None or entry.get("kind") == "estimate":
+                features, steps = current
+                steps = [step for step in steps if "wall_seconds" in step and step.get("exit_status") == 0]
+                if steps:
+                    measurements = {
+                        "ram_mb": max(step.get("peak_rss_mb") or 0 for step in steps),
+                        "runtime_s": max(step["start"] + step["wall_seconds"] for step in steps) -
+                        min(step["start"] for step in steps),
+                    }
+                    gpu = [step["gpu_memory_mb"] for step in steps if step.get("gpu_memory_mb") is not None]
+                    if gpu:
+                        measurements["gpu_mb"] = max(gpu)
+                    runs.append((subject, stage, features, measurements))
+                if entry is not None:
+                    current = (entry.get("features", {}), [])
+            else:
+                current[1].append(entry)
+    return runs
+
+
+def fit_line(x, y):
+    """
+    Fits y = intercept + slope * x by least squares, with a non-negative slope.
+    Args:
+        x (np.ndarray): Feature values, or None for a constant model.
+        y (np.ndarray): Measurements.
+    Returns:
+        Model: The fitted line and the standard deviation of its residuals.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    slope = 0.0
+    if x is not None and np.ptp(x) > 0:
+        slope = max(float(np.polyfit(x, y, 1)[0]), 0.0)
+    x = np.zeros_like(y) if x is None else np.asarray(x, dtype=np.float64)
+    intercept = float((y - slope * x).mean())
+    residuals = y - intercept - slope * x
+    return Model(intercept, slope, float(residuals.std()), len(y))
+
+
+def fit_models(entries, data_directory=None, min_history=MIN_HISTORY):
+    """
+    Fits the resource models of every stage to its logged runs, falling back to
+    DEFAULT_MODELS where there are too few.
+    Args:
+        entries (list): Logged entries, as returned by instrumentation.load_metrics.
+        data_directory (str): Root of the cohort, to measure the features of runs logged
+            before any estimate; None skips those runs for the stages with a feature.
+        min_history (int): Runs needed to fit a model.
+    Returns:
+        dict: Stage kind -> resource -> Model.
+    """
+    samples = {}
+    for subject, stage, features, measurements in stage_runs(entries):
+        kind = stage_kind(stage)
+        feature = STAGE_FEATURES.get(kind)
+        if feature is not None:
+            if features is None and data_directory is not None:
+                features = stage_features(os.path.join(data_directory, subject), stage)
+            if not features or features.get(feature) is None:
+                continue
+        for resource, value in measurements.items():
+            samples.setdefault((kind, resource), []).append((features[feature] if feature else 0.0, value))
+
+    models = {}
+    for kind, defaults in DEFAULT_MODELS.items():
+        models[kind] = {}
+        for resource in RESOURCES:
+            points = samples.get((kind, resource), [])
+            if len(points) >= min_history:
+                x, y = np.array(points).T
+                models[kind][resource] = fit_line(x if kind in STAGE_FEATURES else None, y)
+            else:
+                models[kind][resource] = Model(*defaults[resource], 0.0, 0)
+    return models
+
+
+def predict(models, stage, features):
+    """
+    Predicts the resources of one job.
+    Args:
+        models (dict): Output of fit_models.
+        stage (str): Stage or job name.
+        features (dict): Output of stage_features.
+    Returns:
+        Estimate: Predicted peak RAM and GPU memory in MB and runtime in seconds.
+    """
+    kind = stage_kind(stage)
+    feature = STAGE_FEATURES.get(kind)
+    x = (features.get(feature) or 0.0) if feature else 0.0
+    values = []
+    for resource in RESOURCES:
+        model = models[kind][resource]
+        values.append(max(model.intercept + model.slope * x + RESIDUAL_SIGMAS * model.sigma, 0.0))
+    return Estimate(*values)
+
+
+def log_estimate(subject_path, stage, features, estimate):
+    """
+    Appends an estimate to a stage's log, opening a run for stage_runs.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        stage (str): Stage or job name.
+        features (dict): Output of stage_features.
+        estimate (Estimate): Output of predict.
+    """
+    append_metrics(subject_path, stage, dict(estimate._asdict(), step="admission", kind="estimate",
+                                             start=time.time(), features=features))
+
+
+def main():
+    """
+    Prints the fitted resource models of a cohort.
+    """
+    parser = argparse.ArgumentParser(description="Fit and print the per-stage resource models of a cohort.")
+    parser.add_argument("data_directory", nargs="?", default=DATA_DIRECTORY)
+    args = parser.parse_args()
+
+    models = fit_models(load_metrics(args.data_directory), args.data_directory)
+    print(f"{'stage':<16} {'resource':<10} {'intercept':>10} {'slope':>10} {'sigma':>10} {'runs':>5}  feature")
+    for kind, resources in models.items():
+        for resource, model in resources.items():
+            print(f"{kind:<16} {resource:<10} {model.intercept:>10.1f} {model.slope:>10.3f} {model.sigma:>10.1f} "
+                  f"{model.n:>5}  {STAGE_FEATURES.get(kind, '-')}")
+
+
+if __name__ == "__main__":
+    main()
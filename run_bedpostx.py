@@ -1,74 +1,320 @@
 import os
-import subprocess
+import queue
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import nibabel as nib
+from instrumentation import append_metrics, run_logged, track_stage
+from pipeline_state import StageSpec, is_up_to_date, record_stage
+from split_dwi import split_parts
+from volume_cache import load_volume, save_volume
+
+"""
+Runs bedpostX on each subject's DTI folder.
+
+This follows the stages of bedpostx_gpu_local.sh (directory setup, split_parts_gpu, one
+xfibres_gpu run per part, bedpostx_postproc_gpu.sh), but the parts run concurrently,
+BEDPOSTX_PARALLEL_PARTS at a time on each device, and are tracked through their process
+exit rather than by polling the monitor files. Post-processing starts as soon as the last
+part exits.
+
+With BEDPOSTX_CPU_CORES set, bedpostX runs on CPU cores instead, as FSL's bedpostx does:
+the data is cut into axial slices, one xfibres run per slice, that many at a time, and
+bedpostx_postproc.sh merges the slices.
+
+By default the data is split by split_dwi in one streaming pass over data.nii.gz, so no
+uncompressed data.nii is needed; BEDPOSTX_SPLITTER=fsl runs split_parts_gpu on
+DTI/data.nii instead.
+
+The FSL executables can be overridden through the SPLIT_PARTS_COMMAND, XFIBRES_COMMAND
+and POSTPROC_COMMAND environment variables, e.g. to substitute stubs on machines
+without FSL or a GPU.
+"""
 
 # Define the root data directory
 DATA_DIRECTORY = "/home/test/lmq/data/HCP"
 
-def run_command(command):
+FSLDIR = os.environ.get("FSLDIR", "/usr/local/fsl")
+SPLIT_PARTS_COMMAND = os.environ.get("SPLIT_PARTS_COMMAND", os.path.join(FSLDIR, "bin", "split_parts_gpu"))
+XFIBRES_COMMAND = os.environ.get("XFIBRES_COMMAND", os.path.join(FSLDIR, "bin", "xfibres_gpu"))
+POSTPROC_COMMAND = os.environ.get("POSTPROC_COMMAND", os.path.join(FSLDIR, "bin", "bedpostx_postproc_gpu.sh"))
+XFIBRES_CPU_COMMAND = os.environ.get("XFIBRES_CPU_COMMAND", os.path.join(FSLDIR, "bin", "xfibres"))
+POSTPROC_CPU_COMMAND = os.environ.get("POSTPROC_CPU_COMMAND", os.path.join(FSLDIR, "bin", "bedpostx_postproc.sh"))
+
+# Number of fibres per voxel modelled by bedpostX
+BEDPOSTX_FIBRES = 3
+
+# Number of parts the data is split into; parts run concurrently across the device slots
+BEDPOSTX_NJOBS = 4
+
+# Parts run at the same time on each GPU, as one xfibres_gpu run rarely fills a device.
+# Override with BEDPOSTX_PARALLEL_PARTS.
+BEDPOSTX_PARALLEL_PARTS = int(os.environ.get("BEDPOSTX_PARALLEL_PARTS", "1"))
+
+# CPU cores running xfibres at once, one slice each; 0 runs xfibres_gpu on the GPUs.
+# Override with BEDPOSTX_CPU_CORES.
+BEDPOSTX_CPU_CORES = int(os.environ.get("BEDPOSTX_CPU_CORES", "0"))
+
+# GPUs the parts of `python run_bedpostx.py` spread over; override with BEDPOSTX_GPUS
+BEDPOSTX_GPUS = [int(gpu) for gpu in os.environ.get("BEDPOSTX_GPUS", "0").split(",")]
+
+# How the data is split into parts: 'python' (split_dwi, streaming data.nii.gz) or 'fsl'
+# (split_parts_gpu, reading an uncompressed data.nii). Override with BEDPOSTX_SPLITTER.
+BEDPOSTX_SPLITTER = os.environ.get("BEDPOSTX_SPLITTER", "python")
+
+# xfibres options, matching the defaults of bedpostx_gpu_local.sh
+BEDPOSTX_OPTIONS = [
+    f"--nf={BEDPOSTX_FIBRES}", "--fudge=1", "--bi=1000", "--nj=1250", "--se=25", "--model=2", "--cnonlinear",
+]
+
+
+def stage_spec(subject_path):
     """
-    Executes a shell command and handles errors.
+    Declares the inputs, outputs and parameters of the bedpostX stage.
     Args:
-        command (str): The shell command to execute.
+        subject_path (str): Path to the subject's folder.
+    Returns:
+        StageSpec: Declaration of the stage.
     """
-    try:
-        subprocess.run(command, shell=True, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command: {command}\n{e}")
+    dti_dir = os.path.join(subject_path, "DTI")
+    bedpost_dir = os.path.join(subject_path, "DTI.bedpostX")
+    outputs = [os.path.join(bedpost_dir, "nodif_brain_mask.nii.gz")]
+    for fibre in range(1, BEDPOSTX_FIBRES + 1):
+        outputs += [os.path.join(bedpost_dir, f"merged_{name}{fibre}samples.nii.gz") for name in ("th", "ph", "f")]
+        outputs.append(os.path.join(bedpost_dir, f"dyads{fibre}.nii.gz"))
+    return StageSpec(
+        name="bedpostx",
+        inputs=[os.path.join(dti_dir, name) for name in ("data.nii.gz", "nodif_brain_mask.nii.gz", "bvals", "bvecs")],
+        outputs=outputs,
+        params={"options": BEDPOSTX_OPTIONS},
+    )
 
 
-def run_bedpostx(subject_dir, data_directory, script_path):
+def prepare_bedpostx_dir(dti_dir):
+    """
+    Creates the bedpostX directory structure and copies the gradient table and mask.
+    Args:
+        dti_dir (str): Path to the subject's DTI folder.
+    Returns:
+        tuple: Path to the bedpostX folder and the number of voxels in the brain mask.
+    """
+    bedpost_dir = f"{dti_dir}.bedpostX"
+    for sub_dir in ["diff_parts", "logs/logs_gpu", "logs/monitor", "xfms"]:
+        os.makedirs(os.path.join(bedpost_dir, sub_dir), exist_ok=True)
+    for file in ["bvals", "bvecs", "nodif_brain_mask.nii.gz"]:
+        shutil.copyfile(os.path.join(dti_dir, file), os.path.join(bedpost_dir, file))
+
+    mask_img = load_volume(os.path.join(dti_dir, "nodif_brain_mask.nii.gz"))
+    mask = np.asanyarray(mask_img.dataobj) != 0
+    nodif = os.path.join(dti_dir, "nodif.nii.gz")
+    if os.path.exists(nodif):
+        nodif_img = load_volume(nodif)
+        nodif_brain = np.where(mask, np.asanyarray(nodif_img.dataobj), 0).astype(nodif_img.get_data_dtype())
+        save_volume(nib.Nifti1Image(nodif_brain, nodif_img.affine, nodif_img.header),
+                    os.path.join(bedpost_dir, "nodif_brain.nii.gz"))
+    return bedpost_dir, int(mask.sum())
+
+
+def run_parts(part_commands, devices, subject_path, stage="bedpostx", step="xfibres_part"):
+    """
+    Runs parts concurrently, one per device slot, starting the next queued part as soon
+    as a running one exits.
+    Args:
+        part_commands (list): Commands (argument lists or shell strings), one per part.
+        devices (list): Device ids, one slot each; CUDA_VISIBLE_DEVICES is set to the slot's id.
+            An id listed several times runs that many parts at once on the device, and ""
+            hides every GPU from the parts.
+        subject_path (str): Path to the subject's folder, whose metrics log the parts.
+        stage (str): Stage the parts belong to.
+        step (str): Step name of the parts in the metrics, followed by the part number.
+    Returns:
+        bool: True if every part exited successfully.
+    """
+    free_devices = queue.Queue()
+    for device in devices:
+        free_devices.put(device)
+
+    def run_part(part, command):
+        device = free_devices.get()
+        try:
+            env = dict(os.environ, CUDA_VISIBLE_DEVICES=str(device))
+            return run_logged(command, subject_path, stage, step=f"{step}{part:04d}", env=env)
+        finally:
+            free_devices.put(device)
+
+    succeeded = True
+    with ThreadPoolExecutor(max_workers=len(devices)) as pool:
+        futures = {pool.submit(run_part, part, command): part for part, command in enumerate(part_commands)}
+        for future in as_completed(futures):
+            returncode = future.result()
+            if returncode != 0:
+                print(f"{step}{futures[future]:04d} failed with exit status {returncode}")
+                succeeded = False
+            else:
+                print(f"{step}{futures[future]:04d} finished")
+    return succeeded
+
+
+def launch_bedpostx(dti_dir, devices, njobs=BEDPOSTX_NJOBS):
+    """
+    Runs the bedpostX pre-processing, parallel and post-processing stages for one subject.
+    Args:
+        dti_dir (str): Path to the subject's DTI folder.
+        devices (list): Device ids to spread the parts over, BEDPOSTX_PARALLEL_PARTS at a
+            time on each.
+        njobs (int): Number of parts to split the data into.
+    Returns:
+        bool: True if every stage succeeded.
+    """
+    subject_path = os.path.dirname(os.path.abspath(dti_dir))
+    bedpost_dir, nvox = prepare_bedpostx_dir(dti_dir)
+    mask = os.path.join(bedpost_dir, "nodif_brain_mask")
+    bvals = os.path.join(bedpost_dir, "bvals")
+    bvecs = os.path.join(bedpost_dir, "bvecs")
+
+    # Split the dataset in parts
+    if BEDPOSTX_SPLITTER == "fsl":
+        data = os.path.join(dti_dir, "data.nii")
+        split_command = [SPLIT_PARTS_COMMAND, data, os.path.join(dti_dir, "nodif_brain_mask"), bvals, bvecs,
+                         "NULL", "0", str(njobs), bedpost_dir]
+        if run_logged(split_command, subject_path, "bedpostx", step="split_parts") != 0:
+            print(f"split_parts_gpu failed for {dti_dir}")
+            return False
+    else:
+        data = os.path.join(dti_dir, "data.nii.gz")
+        with track_stage(subject_path, "bedpostx", "split_parts"):
+            split = split_parts(data, os.path.join(dti_dir, "nodif_brain_mask.nii.gz"), njobs, bedpost_dir)
+        append_metrics(subject_path, "bedpostx", dict(split, step="split_parts_footprint"))
+        print(f"Split {split['nvox']} voxels x {split['nmeas']} volumes into {njobs} parts in {split['seconds']:.1f} s, "
+              f"writing {split['written_bytes'] / 1e6:.0f} MB (split_parts_gpu path: "
+              f"{split['fsl_written_bytes'] / 1e6:.0f} MB including data.nii)")
+
+    part_commands = [
+        [XFIBRES_COMMAND, f"--data={bedpost_dir}/data_{part}", f"--mask={mask}", "-b", bvals, "-r", bvecs,
+         "--forcedir", f"--logdir={bedpost_dir}/diff_parts/data_part_{part:04d}"]
+        + BEDPOSTX_OPTIONS + [dti_dir, str(part), str(njobs), str(nvox)]
+        for part in range(njobs)
+    ]
+    slots = [device for _ in range(BEDPOSTX_PARALLEL_PARTS) for device in devices]
+    if not run_parts(part_commands, slots, subject_path):
+        return False
+
+    post_command = [POSTPROC_COMMAND, f"--data={data}", f"--mask={mask}", "-b", bvals, "-r", bvecs,
+                    "--forcedir", f"--logdir={bedpost_dir}/diff_parts"] + BEDPOSTX_OPTIONS + \
+                   [str(nvox), str(njobs), dti_dir, FSLDIR]
+    if run_logged(post_command, subject_path, "bedpostx", step="postproc") != 0:
+        print(f"bedpostx_postproc failed for {dti_dir}")
+        return False
+    return True
+
+
+def split_slices(data_path, mask_path, slice_dir):
+    """
+    Cuts the data and brain mask into axial slices, as fslslice does for FSL's bedpostx.
+    Args:
+        data_path (str): Path to the 4D diffusion data.
+        mask_path (str): Path to the brain mask.
+        slice_dir (str): Output directory of data_slice_NNNN and nodif_brain_mask_slice_NNNN.
+    Returns:
+        int: Number of slices.
+    """
+    os.makedirs(slice_dir, exist_ok=True)
+    for path, name in ((data_path, "data"), (mask_path, "nodif_brain_mask")):
+        img = load_volume(path)
+        data = np.asanyarray(img.dataobj)
+        for z in range(data.shape[2]):
+            affine = img.affine.copy()
+            affine[:3, 3] += img.affine[:3, 2] * z
+            slice_img = nib.Nifti1Image(data[:, :, z:z + 1], affine, img.header)
+            save_volume(slice_img, os.path.join(slice_dir, f"{name}_slice_{z:04d}.nii.gz"), compression="fast",
+                        limit_mb=0)
+    return data.shape[2]
+
+
+def launch_bedpostx_cpu(dti_dir, cores=BEDPOSTX_CPU_CORES):
+    """
+    Runs bedpostX on CPU cores, one xfibres run per axial slice.
+    Args:
+        dti_dir (str): Path to the subject's DTI folder.
+        cores (int): Number of xfibres runs at a time.
+    Returns:
+        bool: True if every stage succeeded.
+    """
+    subject_path = os.path.dirname(os.path.abspath(dti_dir))
+    bedpost_dir, _ = prepare_bedpostx_dir(dti_dir)
+    bvals = os.path.join(bedpost_dir, "bvals")
+    bvecs = os.path.join(bedpost_dir, "bvecs")
+    slice_dir = os.path.join(bedpost_dir, "data_slices")
+    with track_stage(subject_path, "bedpostx", "split_slices"):
+        nslices = split_slices(os.path.join(dti_dir, "data.nii.gz"), os.path.join(dti_dir, "nodif_brain_mask.nii.gz"),
+                               slice_dir)
+
+    # bedpostx_postproc.sh merges the slices from diff_slices/data_slice_NNNN
+    slice_commands = [
+        [XFIBRES_CPU_COMMAND, f"--data={slice_dir}/data_slice_{z:04d}",
+         f"--mask={slice_dir}/nodif_brain_mask_slice_{z:04d}", "-b", bvals, "-r", bvecs,
+         "--forcedir", f"--logdir={bedpost_dir}/diff_slices/data_slice_{z:04d}"] + BEDPOSTX_OPTIONS
+        for z in range(nslices)
+    ]
+    succeeded = run_parts(slice_commands, [""] * cores, subject_path, step="xfibres_slice")
+    shutil.rmtree(slice_dir)
+    if not succeeded:
+        return False
+    if run_logged([POSTPROC_CPU_COMMAND, dti_dir], subject_path, "bedpostx", step="postproc") != 0:
+        print(f"bedpostx_postproc failed for {dti_dir}")
+        return False
+    return True
+
+
+def run_bedpostx(subject_dir, data_directory, gpu=0, devices=None):
     """
     Runs bedpostX for a given subject.
 
     Args:
         subject_dir (str): The subject's directory name.
         data_directory (str): The root directory containing all subject data.
-        script_path (str): Path to the bedpostx_gpu_local.sh script.
+        gpu (int): CUDA device to run on; unused with BEDPOSTX_CPU_CORES.
+        devices (list): Device ids to spread the parts over; defaults to [gpu].
+
+    Returns:
+        bool: True if the stage is up to date, either already or after this run.
     """
     subject_path = os.path.join(data_directory, subject_dir)
-    bedpost_dir = os.path.join(subject_path, "DTI.bedpostX")
-    os.makedirs(bedpost_dir, exist_ok=True)
 
-    # Copy required files
+    # Check if bedpostX processing is already completed
+    spec = stage_spec(subject_path)
+    if is_up_to_date(subject_path, spec):
+        print(f"BedpostX already processed for subject: {subject_dir}")
+        return True
+
     try:
-        required_files = ["bvals", "bvecs"]
-        for file in required_files:
-            source_file = os.path.join(subject_path, "DTI", file)
-            dest_file = os.path.join(bedpost_dir, file)
-            if not os.path.exists(source_file):
-                print(f"Required file missing: {source_file}. Skipping subject: {subject_dir}")
-                return
-            run_command(f"cp {source_file} {dest_file}")
-
-        # Check if bedpostX processing is already completed
-        target_file = os.path.join(bedpost_dir, "dyads3.nii.gz")
-        if os.path.exists(target_file):
-            print(f"BedpostX already processed for subject: {subject_dir}")
-            return
+        for file in spec.inputs:
+            if not os.path.exists(file):
+                print(f"Required file missing: {file}. Skipping subject: {subject_dir}")
+                return False
 
         # Run bedpostX processing
         print(f"Running bedpostX for subject: {subject_dir}")
-        run_command(f"export CUDA_VISIBLE_DEVICES=0; bash {script_path} {os.path.join(subject_path, 'DTI')}")
+        dti_dir = os.path.join(subject_path, "DTI")
+        if BEDPOSTX_CPU_CORES > 0:
+            launched = launch_bedpostx_cpu(dti_dir)
+        else:
+            launched = launch_bedpostx(dti_dir, devices or [gpu])
+        return launched and record_stage(subject_path, spec)
 
     except Exception as e:
         print(f"Error processing subject {subject_dir}: {e}")
+        return False
 
 
 def main():
     """
     Main function to iterate over all subjects and run bedpostX.
     """
-    
-    script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bedpostx_gpu_local.sh")
-
-    if not os.path.exists(script_path):
-        print(f"Script not found: {script_path}. Ensure bedpostx_gpu_local.sh is in the same directory.")
-        return
-
     for subject_dir in os.listdir(DATA_DIRECTORY):
         subject_path = os.path.join(DATA_DIRECTORY, subject_dir)
         if os.path.isdir(subject_path):
-            run_bedpostx(subject_dir, DATA_DIRECTORY, script_path)
+            run_bedpostx(subject_dir, DATA_DIRECTORY, gpu=BEDPOSTX_GPUS[0], devices=BEDPOSTX_GPUS)
 
 
 if __name__ == "__main__":
@@ -1,71 +1,206 @@
 import os
-import subprocess
+from instrumentation import run_logged
+from pipeline_state import StageSpec, is_up_to_date, record_stage
+from bundle_projection import stage_spec as bundle_stage_spec
+from run_bedpostx import run_parts, stage_spec as bedpostx_stage_spec
+from seed_rois import ROI_LABELS_FILE, build_seed_set, roi_mask_path
+from seed_shards import shard_dir, split_seed_mask
 
 # Define the root data directory
 DATA_DIRECTORY = "/home/test/lmq/data/HCP"
 
-def run_command(command):
+# probtrackx executable; override with the PROBTRACKX_COMMAND environment variable
+PROBTRACKX_COMMAND = os.environ.get("PROBTRACKX_COMMAND", "probtrackx2_gpu")
+
+# Sampling options passed to probtrackx2_gpu
+PROBTRACK_OPTIONS = "-P 5000 --loopcheck --forcedir -c 0.2 --sampvox=2 --randfib=1"
+
+# Number of disjoint seed shards per hemisphere. Each shard is an independent probtrackx
+# run and post_probtrack merges their matrices; override with PROBTRACK_SHARDS.
+PROBTRACK_SHARDS = int(os.environ.get("PROBTRACK_SHARDS", "1"))
+
+# Adaptive sampling (adaptive_sampling.py): samples per round, up to the -P of
+# PROBTRACK_OPTIONS; 0 runs all samples at once. Override with PROBTRACK_ROUND_SAMPLES.
+PROBTRACK_ROUND_SAMPLES = int(os.environ.get("PROBTRACK_ROUND_SAMPLES", "0"))
+
+# Fingerprint change between rounds below which adaptive sampling stops, measured as
+# 'frobenius' (relative Frobenius norm) or 'correlation' (1 - mean per-seed correlation)
+CONVERGENCE_METRIC = os.environ.get("PROBTRACK_CONVERGENCE_METRIC", "frobenius")
+CONVERGENCE_THRESHOLD = float(os.environ.get("PROBTRACK_CONVERGENCE_THRESHOLD", "0.01"))
+
+# Seed ROIs, tracked together in one run per hemisphere when there are several (see
+# seed_rois.py); post_probtrack then splits the fingerprint per ROI. Names are keys of
+# generate_seeds.MASK_LABELS or SEED_ROI_LABELS, whose masks generate_seeds then writes;
+# override with a comma-separated PROBTRACK_SEED_ROIS.
+PROBTRACK_SEED_ROIS = os.environ.get("PROBTRACK_SEED_ROIS", "striatum").split(",")
+
+
+def run_command(command, subject_path, stage):
     """
-    Executes a shell command and handles errors.
+    Executes a shell command, logging its run time, memory, I/O and exit status to the
+    stage's metrics.
     Args:
         command (str): The shell command to execute.
+        subject_path (str): Path to the subject's folder.
+        stage (str): Stage name the command belongs to.
+    Returns:
+        bool: True if the command succeeded.
     """
-    try:
-        subprocess.run(command, shell=True, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command: {command}\n{e}")
+    returncode = run_logged(command, subject_path, stage)
+    if returncode != 0:
+        print(f"Error running command: {command}\nExit status: {returncode}")
+        return False
+    return True
 
 
-def run_probtrack(subject_dir, data_directory, hemisphere):
+def stage_spec(subject_path, hemisphere):
     """
-    Runs ProbtrackX2 for a given subject and specified hemisphere.
-    
+    Declares the inputs, outputs and parameters of the ProbtrackX2 stage for one hemisphere.
     Args:
-        subject_dir (str): The subject's directory name.
-        data_directory (str): The root directory containing all subject data.
+        subject_path (str): Path to the subject's folder.
         hemisphere (str): Hemisphere to process ('left' or 'right').
+    Returns:
+        StageSpec: Declaration of the stage.
     """
-    subject_path = os.path.join(data_directory, subject_dir)
     output_dir = os.path.join(subject_path, f"probtrackx_{hemisphere[0].upper()}_omatrix2")
-    output_file = os.path.join(output_dir, "fdt_matrix2.dot")
-
-    # Check if processing is already done
-    if os.path.exists(output_file):
-        print(f"ProbtrackX2 already processed for subject: {subject_dir}, hemisphere: {hemisphere}")
-        return
+    bedpost_spec = bedpostx_stage_spec(subject_path)
+    extra_inputs, extra_outputs = [], []
+    if PROBTRACK_ROUND_SAMPLES > 0:
+        # Rounds run unsharded; their fingerprints need the bundle projection. The summed
+        # matrix is saved as the sparse fdt_matrix2.npz that post_probtrack would write
+        output_files = [os.path.join(output_dir, "fdt_matrix2.npz")]
+        params = {"options": PROBTRACK_OPTIONS, "round_samples": PROBTRACK_ROUND_SAMPLES,
+                  "metric": CONVERGENCE_METRIC, "threshold": CONVERGENCE_THRESHOLD}
+        extra_inputs = bundle_stage_spec(subject_path).outputs
+        extra_outputs = [os.path.join(output_dir, "samples.json")]
+    elif PROBTRACK_SHARDS > 1:
+        output_files = [os.path.join(shard_dir(output_dir, shard), "fdt_matrix2.dot") for shard in range(PROBTRACK_SHARDS)]
+        params = {"options": PROBTRACK_OPTIONS, "shards": PROBTRACK_SHARDS}
+    else:
+        output_files = [os.path.join(output_dir, "fdt_matrix2.dot")]
+        params = {"options": PROBTRACK_OPTIONS}
+    if len(PROBTRACK_SEED_ROIS) > 1:
+        params["seed_rois"] = PROBTRACK_SEED_ROIS
+        extra_outputs.append(os.path.join(output_dir, ROI_LABELS_FILE))
+    return StageSpec(
+        name=f"probtrack_{hemisphere}",
+        inputs=bedpost_spec.outputs + [
+            os.path.join(subject_path, "T1", "T1w_acpc_dc_restore_brain.nii.gz"),
+            os.path.join(subject_path, "T1", f"{hemisphere}_cortex_mask_3mm.nii.gz"),
+        ] + [roi_mask_path(subject_path, hemisphere, roi) for roi in PROBTRACK_SEED_ROIS] + [
+            os.path.join(subject_path, "DTI", "LowResMask.nii.gz"),
+            os.path.join(subject_path, "T1", f"{hemisphere}_white_mask_3mm.nii.gz"),
+        ] + extra_inputs,
+        outputs=output_files + extra_outputs,
+        params=params,
+        # post_probtrack converts the .dot files to .npz and deletes them
+        transient=[file for file in output_files if file.endswith(".dot")],
+    )
 
-    print(f"Running ProbtrackX2 for subject: {subject_dir}, hemisphere: {hemisphere}")
 
-    # Construct paths for required files
+def probtrackx_command(subject_path, hemisphere, seed_mask, output_dir, options=PROBTRACK_OPTIONS):
+    """
+    Builds the ProbtrackX2 command tracking from a seed mask into an output directory.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere to process ('left' or 'right').
+        seed_mask (str): Path to the seed mask.
+        output_dir (str): probtrackx output directory.
+        options (str): Sampling options.
+    Returns:
+        str: The shell command, without a CUDA device.
+    """
     samples_path = os.path.join(subject_path, "DTI.bedpostX", "merged")
     mask_path = os.path.join(subject_path, "DTI.bedpostX", "nodif_brain_mask")
     seedref_path = os.path.join(subject_path, "T1", "T1w_acpc_dc_restore_brain.nii.gz")
     stop_mask = os.path.join(subject_path, "T1", f"{hemisphere}_cortex_mask_3mm.nii.gz")
-    seed_mask = os.path.join(subject_path, "T1", f"{hemisphere}_striatum_mask_3mm.nii.gz")
     target_mask = os.path.join(subject_path, "DTI", "LowResMask.nii.gz")
     white_mask = os.path.join(subject_path, "T1", f"{hemisphere}_white_mask_3mm.nii.gz")
-
-    # Check if all required input files exist
-    required_files = [samples_path, mask_path, seedref_path, stop_mask, seed_mask, target_mask, white_mask]
-    for file in required_files:
-        if not os.path.exists(file):
-            print(f"Missing required file for subject {subject_dir}, hemisphere {hemisphere}: {file}")
-            return
-
-    # Build and run the ProbtrackX2 command
-    command = (
-        f"export CUDA_VISIBLE_DEVICES=0; probtrackx2_gpu "
+    return (
+        f"{PROBTRACKX_COMMAND} "
         f"--samples={samples_path} "
         f"--mask={mask_path} "
         f"--seedref={seedref_path} "
-        f"-P 5000 --loopcheck --forcedir -c 0.2 --sampvox=2 --randfib=1 "
+        f"{options} "
         f"--stop={stop_mask} --forcefirststep "
         f"-x {seed_mask} "
         f"--omatrix2 --target2={target_mask} "
         f"--wtstop={white_mask} "
         f"--dir={output_dir} --opd -o {hemisphere[0].upper()}"
     )
-    run_command(command)
+
+
+def prepare_seed_mask(subject_path, hemisphere, output_dir):
+    """
+    Returns the seed mask of a hemisphere: the ROI's 3mm mask, or with several seed ROIs
+    their combined mask, written to the output directory.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere to process ('left' or 'right').
+        output_dir (str): probtrackx output directory.
+    Returns:
+        str: Path to the seed mask.
+    """
+    if len(PROBTRACK_SEED_ROIS) > 1:
+        return build_seed_set(subject_path, hemisphere, PROBTRACK_SEED_ROIS, output_dir)
+    return roi_mask_path(subject_path, hemisphere, PROBTRACK_SEED_ROIS[0])
+
+
+def missing_inputs(spec):
+    """
+    Lists the declared inputs of a stage that do not exist. The samples and mask paths
+    probtrackx takes are FSL basenames, so the image files the stage declares are checked.
+    Args:
+        spec (StageSpec): Declaration of the stage.
+    Returns:
+        list: Missing input paths.
+    """
+    return [file for file in spec.inputs if not os.path.exists(file)]
+
+
+def run_probtrack(subject_dir, data_directory, hemisphere, gpu=0, devices=None):
+    """
+    Runs ProbtrackX2 for a given subject and specified hemisphere. With PROBTRACK_SHARDS
+    above 1, the seed mask is split into that many shards, which run concurrently across
+    the devices and write to shard_<k>/ in the output directory.
+    
+    Args:
+        subject_dir (str): The subject's directory name.
+        data_directory (str): The root directory containing all subject data.
+        hemisphere (str): Hemisphere to process ('left' or 'right').
+        gpu (int): CUDA device to run on.
+        devices (list): Device ids to spread the shards over; defaults to [gpu].
+    Returns:
+        bool: True if the connectivity matrix is up to date, either already or after this run.
+    """
+    subject_path = os.path.join(data_directory, subject_dir)
+    output_dir = os.path.join(subject_path, f"probtrackx_{hemisphere[0].upper()}_omatrix2")
+
+    # Check if processing is already done
+    spec = stage_spec(subject_path, hemisphere)
+    if is_up_to_date(subject_path, spec):
+        print(f"ProbtrackX2 already processed for subject: {subject_dir}, hemisphere: {hemisphere}")
+        return True
+
+    print(f"Running ProbtrackX2 for subject: {subject_dir}, hemisphere: {hemisphere}")
+
+    # Check if all required input files exist
+    missing = missing_inputs(spec)
+    if missing:
+        print(f"Missing required file for subject {subject_dir}, hemisphere {hemisphere}: {missing[0]}")
+        return False
+
+    # Build and run the ProbtrackX2 command
+    seeds = prepare_seed_mask(subject_path, hemisphere, output_dir)
+    if PROBTRACK_SHARDS > 1:
+        shard_masks = split_seed_mask(seeds, PROBTRACK_SHARDS, output_dir)
+        commands = [probtrackx_command(subject_path, hemisphere, shard_mask, shard_dir(output_dir, shard))
+                    for shard, shard_mask in enumerate(shard_masks)]
+        succeeded = run_parts(commands, devices or [gpu], subject_path, spec.name, "probtrackx_shard")
+    else:
+        command = f"export CUDA_VISIBLE_DEVICES={gpu}; " + probtrackx_command(subject_path, hemisphere, seeds, output_dir)
+        succeeded = run_command(command, subject_path, spec.name)
+    return succeeded and record_stage(subject_path, spec)
 
 
 def main():
@@ -1,29 +1,61 @@
 import os
-import subprocess
+from instrumentation import run_logged
+from pipeline_state import StageSpec, is_up_to_date, record_stage
 
 # Define the root data directory
 DATA_DIRECTORY = "/home/test/lmq/data/HCP"
 
+# TractSeg executable; override with the TRACTSEG_COMMAND environment variable
+TRACTSEG_COMMAND = os.environ.get("TRACTSEG_COMMAND", "TractSeg")
 
-def run_command(command):
+
+def run_command(command, subject_path, stage):
     """
-    Executes a shell command and handles errors.
+    Executes a shell command, logging its run time, memory, I/O and exit status to the
+    stage's metrics.
     Args:
         command (str): The shell command to execute.
+        subject_path (str): Path to the subject's folder.
+        stage (str): Stage name the command belongs to.
+    Returns:
+        bool: True if the command succeeded.
     """
-    try:
-        subprocess.run(command, shell=True, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command: {command}\n{e}")
+    returncode = run_logged(command, subject_path, stage)
+    if returncode != 0:
+        print(f"Error running command: {command}\nExit status: {returncode}")
+        return False
+    return True
 
 
-def run_tractseg(subject_dir, data_directory):
+def stage_spec(subject_path):
+    """
+    Declares the inputs, outputs and parameters of the TractSeg stage. Its output is
+    projected onto the 3mm target space by bundle_projection.
+    Args:
+        subject_path (str): Path to the subject's folder.
+    Returns:
+        StageSpec: Declaration of the stage.
+    """
+    dti_dir = os.path.join(subject_path, "DTI")
+    return StageSpec(
+        name="tractseg",
+        inputs=[os.path.join(dti_dir, name) for name in ("data.nii.gz", "bvals", "bvecs", "nodif_brain_mask.nii.gz")],
+        outputs=[os.path.join(subject_path, "tractseg_output", "bundle_segmentations.nii.gz")],
+        params={"options": "--raw_diffusion_input --single_output_file"},
+    )
+
+
+def run_tractseg(subject_dir, data_directory, gpu=0):
     """
     Runs TractSeg for a given subject.
     
     Args:
         subject_dir (str): The subject's directory name.
         data_directory (str): The root directory containing all subject data.
+        gpu (int): CUDA device to run on.
+
+    Returns:
+        bool: True if the stage is up to date, either already or after this run.
     """
     subject_path = os.path.join(data_directory, subject_dir)
     dti_dir = os.path.join(subject_path, "DTI")
@@ -33,41 +65,29 @@ def run_tractseg(subject_dir, data_directory):
     mask = os.path.join(dti_dir, "nodif_brain_mask.nii.gz")
     tractseg_dir = os.path.join(subject_path, "tractseg_output")
     os.makedirs(tractseg_dir, exist_ok=True)
-    output_file = os.path.join(tractseg_dir, "bundle_segmentations.nii.gz")
+    spec = stage_spec(subject_path)
 
     # Check if processing is already done
-    if os.path.exists(output_file):
+    if is_up_to_date(subject_path, spec):
         print(f"TractSeg already processed for subject: {subject_dir}")
-        return
+        return True
 
     # Check if required input files exist
     required_files = [dti_data, bval, bvec, mask]
     for file in required_files:
         if not os.path.exists(file):
             print(f"Missing required file for subject {subject_dir}: {file}")
-            return
+            return False
 
     print(f"Running TractSeg for subject: {subject_dir}")
 
     # Run TractSeg
     tractseg_command = (
-        f"export CUDA_VISIBLE_DEVICES=0; "
-        f"TractSeg -i {dti_data} -o {tractseg_dir} --bvals {bval} --bvecs {bvec} "
+        f"export CUDA_VISIBLE_DEVICES={gpu}; "
+        f"{TRACTSEG_COMMAND} -i {dti_data} -o {tractseg_dir} --bvals {bval} --bvecs {bvec} "
         f"--brain_mask {mask} --raw_diffusion_input --single_output_file"
     )
-    run_command(tractseg_command)
-
-    # Resample fiber bundle segmentations
-    low_res_mask = os.path.join(dti_dir, "LowResMask.nii.gz")
-    low_res_output = os.path.join(dti_dir, "LowRes_Fibers.nii.gz")
-    if os.path.exists(low_res_mask):
-        resample_command = (
-            f"flirt -ref {low_res_mask} -in {output_file} "
-            f"-o {low_res_output} -applyisoxfm 3 -interp nearestneighbour"
-        )
-        run_command(resample_command)
-    else:
-        print(f"LowResMask.nii.gz not found for subject: {subject_dir}")
+    return run_command(tractseg_command, subject_path, spec.name) and record_stage(subject_path, spec)
 
 
 def main():
@@ -0,0 +1,129 @@
+import os
+import numpy as np
+
+"""
+Compact index between fingerprint rows and seed voxels.
+
+probtrackx numbers the rows of fdt_matrix2, and so of the fingerprints, in the order of
+coords_for_fdt_matrix2, a text file of "x y z 0 row" lines. get_fiber_fingerprint saves
+these coordinates next to each fingerprint, as finger_print_fiber_{R|L}_seeds.npz:
+
+    coords    (n_seeds, 3) int16 voxel coordinates of the rows, in the seed mask's grid
+    shape     the grid's dimensions
+    affine    the grid's voxel-to-world affine
+
+The grid is kept with the coordinates so that fingerprints can be written back as volumes
+without locating the seed mask they were tracked from. The other direction, voxel to row,
+goes through a lookup volume of the grid holding the row of every seed voxel and -1
+elsewhere. It is built on first use (4 bytes per grid voxel, about 1 MB at 3mm), so that
+finding the rows of any number of voxels is a single vectorized array index.
+"""
+
+
+def lookup_volume(coords, shape):
+    """
+    Builds the volume mapping every voxel of a grid to its row.
+    Args:
+        coords (np.ndarray): (n, 3) voxel coordinates of the rows.
+        shape (tuple): Dimensions of the grid.
+    Returns:
+        np.ndarray: int32 volume holding the row of every seed voxel and -1 elsewhere.
+    """
+    lookup = np.full(tuple(shape), -1, dtype=np.int32)
+    lookup[coords[:, 0], coords[:, 1], coords[:, 2]] = np.arange(len(coords), dtype=np.int32)
+    return lookup
+
+
+def lookup_rows(lookup, coords):
+    """
+    Looks up the rows of a set of voxels.
+    Args:
+        lookup (np.ndarray): Output of lookup_volume.
+        coords (array-like): (k, 3) voxel coordinates.
+    Returns:
+        np.ndarray: Row of every voxel, -1 for voxels that are not seeds or lie outside the grid.
+    """
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+    inside = np.all((coords >= 0) & (coords < lookup.shape), axis=1)
+    rows = np.full(len(coords), -1, dtype=np.int64)
+    rows[inside] = lookup[coords[inside, 0], coords[inside, 1], coords[inside, 2]]
+    return rows
+
+
+class SeedIndex:
+    """
+    Voxel coordinates of the rows of a fingerprint, with the grid they index.
+    Args:
+        coords (np.ndarray): (n_seeds, 3) voxel coordinates of the rows.
+        shape (tuple): Dimensions of the grid.
+        affine (np.ndarray): 4x4 voxel-to-world affine of the grid.
+    """
+
+    def __init__(self, coords, shape, affine):
+        self.coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        self.shape = tuple(int(n) for n in shape[:3])
+        self.affine = np.asarray(affine, dtype=np.float64)
+        if len(self.coords) and (self.coords.min() < 0 or np.any(self.coords.max(axis=0) >= self.shape)):
+            raise ValueError(f"Seed coordinates fall outside the {self.shape} grid.")
+        self._lookup = None
+
+    def __len__(self):
+        return len(self.coords)
+
+    @property
+    def lookup(self):
+        """
+        Volume holding the row of every seed voxel and -1 elsewhere.
+        """
+        if self._lookup is None:
+            self._lookup = lookup_volume(self.coords, self.shape)
+        return self._lookup
+
+    def rows_of(self, coords):
+        """
+        Returns the row of every voxel coordinate.
+        Args:
+            coords (array-like): (k, 3) voxel coordinates.
+        Returns:
+            np.ndarray: Row indices.
+        """
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        rows = lookup_rows(self.lookup, coords)
+        if (rows < 0).any():
+            raise ValueError(f"Voxel {coords[rows < 0][0].tolist()} is not a seed.")
+        return rows
+
+    def voxel_indices(self):
+        """
+        Returns the linear index of every row's voxel in a C-ordered array of the grid.
+        """
+        return np.ravel_multi_index(self.coords.T, self.shape)
+
+
+def save_seed_index(path, coords, reference_img):
+    """
+    Saves the seed coordinates of a fingerprint with the grid of its seed mask.
+    Args:
+        path (Path): Output .npz file.
+        coords (np.ndarray): (n_seeds, 3) voxel coordinates of the rows.
+        reference_img (nib.Nifti1Image): Seed mask, or any volume on its grid.
+    Returns:
+        SeedIndex: The saved index.
+    """
+    index = SeedIndex(coords, reference_img.shape, reference_img.affine)
+    tmp_file = f"{path}.tmp.npz"
+    np.savez(tmp_file, coords=index.coords.astype(np.int16), shape=np.array(index.shape), affine=index.affine)
+    os.replace(tmp_file, path)
+    return index
+
+
+def load_seed_index(path):
+    """
+    Loads a seed index saved by save_seed_index.
+    Args:
+        path (Path): The .npz file.
+    Returns:
+        SeedIndex: The index.
+    """
+    with np.load(path) as f:
+        return SeedIndex(f['coords'], f['shape'], f['affine'])
@@ -0,0 +1,109 @@
+import os
+import numpy as np
+import nibabel as nib
+import scipy.sparse as sparse
+from volume_cache import load_volume, save_volume
+
+"""
+Builds the combined seed set of a multi-ROI tractography run and splits its rows per ROI.
+
+Tracking each subcortical structure in its own probtrackx run reloads the bedpostX
+samples every time. In batch mode the 3mm masks of several label-defined ROIs (see
+generate_seeds.SEED_ROI_LABELS) are merged into one seed mask, tracked in a single run per
+hemisphere, and the rows of the resulting matrix are assigned back to their ROI.
+
+Next to the combined mask, a label volume (seed_rois.nii.gz) records the ROI of every
+seed voxel, 1 for the first ROI in the list, 2 for the second, and so on. A voxel that
+falls in several masks belongs to the first of them. probtrackx numbers the rows in the
+order of the seed coordinates it writes to coords_for_fdt_matrix2, so the ROI of a row
+is the label at its coordinates. This holds for sharded and adaptive runs as well, whose
+merged coordinates are written in the same layout.
+"""
+
+SEED_MASK_FILE = "seed_mask.nii.gz"
+ROI_LABELS_FILE = "seed_rois.nii.gz"
+
+# Fingerprint rows handled at a time when splitting a memory-mapped fingerprint
+SPLIT_BATCH_ROWS = 65536
+
+
+def roi_mask_path(subject_path, hemisphere, roi):
+    """
+    Returns the path of an ROI's 3mm mask, as written by generate_seeds.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('left' or 'right').
+        roi (str): ROI name, a key of generate_seeds.MASK_LABELS or SEED_ROI_LABELS.
+    Returns:
+        str: Path of the mask.
+    """
+    return os.path.join(subject_path, "T1", f"{hemisphere}_{roi}_mask_3mm.nii.gz")
+
+
+def build_seed_set(subject_path, hemisphere, rois, output_dir):
+    """
+    Merges the masks of several ROIs into one seed mask and writes the label volume of
+    the ROIs next to it.
+    Args:
+        subject_path (str): Path to the subject's folder.
+        hemisphere (str): Hemisphere ('left' or 'right').
+        rois (list): ROI names, in the order of their labels.
+        output_dir (str): probtrackx output directory.
+    Returns:
+        str: Path of the combined seed mask.
+    """
+    labels, reference = None, None
+    for index, roi in enumerate(rois, 1):
+        img = load_volume(roi_mask_path(subject_path, hemisphere, roi))
+        mask = np.asanyarray(img.dataobj) != 0
+        if labels is None:
+            labels, reference = np.zeros(mask.shape, dtype=np.uint8), img
+        elif mask.shape != labels.shape:
+            raise ValueError(f"The {roi} mask of {subject_path} does not match the grid of the {rois[0]} mask.")
+        labels[mask & (labels == 0)] = index
+    os.makedirs(output_dir, exist_ok=True)
+    header = reference.header.copy()
+    header.set_data_dtype(np.uint8)
+    save_volume(nib.Nifti1Image(labels, reference.affine, header), os.path.join(output_dir, ROI_LABELS_FILE))
+    seed_mask = os.path.join(output_dir, SEED_MASK_FILE)
+    save_volume(nib.Nifti1Image((labels > 0).astype(np.uint8), reference.affine, header), seed_mask)
+    return seed_mask
+
+
+def row_rois(label_file, seed_coords):
+    """
+    Looks up the ROI of every row of a matrix from its seed coordinates.
+    Args:
+        label_file (str): Label volume written by build_seed_set.
+        seed_coords (np.ndarray): (n, 3) voxel coordinates of the rows.
+    Returns:
+        np.ndarray: ROI label of every row, starting at 1.
+    """
+    labels = np.asanyarray(load_volume(label_file).dataobj)
+    rois = labels[seed_coords[:, 0], seed_coords[:, 1], seed_coords[:, 2]]
+    if (rois == 0).any():
+        raise ValueError(f"{int((rois == 0).sum())} seed rows lie outside the ROIs of {label_file}.")
+    return rois
+
+
+def split_rows(mat, rois, n_rois, writers=None):
+    """
+    Splits the rows of a matrix by ROI, keeping their order within each ROI.
+    Args:
+        mat (sparse matrix or LazyCSR): Matrix whose rows are seeds.
+        rois (np.ndarray): ROI label of every row, as returned by row_rois.
+        n_rois (int): Number of ROIs.
+        writers (list): One CSRWriter per ROI; when given, the rows are streamed to them
+            in batches and the written matrices are returned.
+    Returns:
+        list: One matrix per ROI.
+    """
+    if writers is None:
+        mat = sparse.csr_matrix(mat.to_csr() if hasattr(mat, 'to_csr') else mat)
+        return [mat[np.flatnonzero(rois == index)] for index in range(1, n_rois + 1)]
+    for start in range(0, mat.shape[0], SPLIT_BATCH_ROWS):
+        stop = start + SPLIT_BATCH_ROWS
+        block = mat.rows(start, stop) if hasattr(mat, 'rows') else sparse.csr_matrix(mat[start:stop])
+        for index, writer in enumerate(writers, 1):
+            writer.append(block[np.flatnonzero(rois[start:stop] == index)])
+    return [writer.close() for writer in writers]
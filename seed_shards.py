@@ -0,0 +1,130 @@
+import os
+import numpy as np
+import nibabel as nib
+import scipy.sparse as sparse
+from volume_cache import load_volume, save_volume
+
+"""
+Splits a probtrackx seed mask into disjoint shards and merges the per-shard outputs.
+
+A shard is a contiguous run of seed voxels in the order probtrackx numbers them (x
+fastest, then y, then z), so every shard is an independent `probtrackx2_gpu -x` run that
+can go to its own GPU or node. Each run writes its own fdt_matrix2.dot, seed coordinates
+(coords_for_fdt_matrix2), target coordinates and waytotal to shard_<k>/ in the output
+directory.
+
+Merging stacks the shard matrices and puts the rows back in the order of the unsharded
+run, using the seed coordinates each shard reports rather than assuming the shard order.
+All shards share the target mask, so their columns already line up. With a tractography
+that is deterministic per seed (like the stub in benchmarks/), the merged matrix equals
+the unsharded one exactly.
+"""
+
+SHARD_PREFIX = "shard_"
+SEED_COORDS_FILE = "coords_for_fdt_matrix2"
+TARGET_COORDS_FILE = "tract_space_coords_for_fdt_matrix2"
+
+
+def shard_dir(output_dir, shard):
+    """
+    Returns the probtrackx output directory of a shard.
+    Args:
+        output_dir (str): Output directory of the unsharded run.
+        shard (int): Shard number.
+    Returns:
+        str: Path to the shard's output directory.
+    """
+    return os.path.join(output_dir, f"{SHARD_PREFIX}{shard:03d}")
+
+
+def split_seed_mask(seed_mask, n_shards, output_dir):
+    """
+    Writes `n_shards` disjoint masks that together cover the seed mask, each holding a
+    contiguous, equally sized run of seed voxels in probtrackx order.
+    Args:
+        seed_mask (str): Path to the seed mask.
+        n_shards (int): Number of shards.
+        output_dir (str): Output directory of the unsharded run; shard masks go to shard_<k>/.
+    Returns:
+        list: Paths of the shard masks.
+    """
+    img = load_volume(seed_mask)
+    data = np.asanyarray(img.dataobj)
+    seeds = np.flatnonzero(data.ravel(order="F"))
+    if seeds.size < n_shards:
+        raise ValueError(f"Cannot split {seeds.size} seed voxels of {seed_mask} into {n_shards} shards.")
+    paths = []
+    for shard, voxels in enumerate(np.array_split(seeds, n_shards)):
+        mask = np.zeros(data.size, dtype=np.uint8)
+        mask[voxels] = 1
+        os.makedirs(shard_dir(output_dir, shard), exist_ok=True)
+        path = os.path.join(shard_dir(output_dir, shard), "seed_mask.nii.gz")
+        header = img.header.copy()
+        header.set_data_dtype(np.uint8)
+        save_volume(nib.Nifti1Image(mask.reshape(data.shape, order="F"), img.affine, header), path)
+        paths.append(path)
+    return paths
+
+
+def read_coords(path):
+    """
+    Reads the voxel coordinates of a probtrackx coordinate file.
+    Args:
+        path (str): Path to the coordinate file.
+    Returns:
+        np.ndarray: (n, 3) integer voxel coordinates, one row per matrix row or column.
+    """
+    coords = np.loadtxt(path, dtype=np.int64, ndmin=2)
+    return coords[:, :3]
+
+
+def probtrackx_order(coords):
+    """
+    Returns the permutation sorting voxel coordinates into probtrackx order (x fastest).
+    Args:
+        coords (np.ndarray): (n, 3) voxel coordinates.
+    Returns:
+        np.ndarray: Indices that sort the coordinates.
+    """
+    return np.lexsort((coords[:, 0], coords[:, 1], coords[:, 2]))
+
+
+def merge_shards(shard_dirs, read_matrix):
+    """
+    Merges the outputs of the shard runs into the matrix of the unsharded run.
+    Args:
+        shard_dirs (list): Output directories of the shards.
+        read_matrix (callable): Reads a shard's fdt_matrix2.dot given its directory
+            and the expected (rows, columns) shape, returning a CSR matrix.
+    Returns:
+        tuple: Merged CSR matrix, its seed coordinates, the target coordinates and the
+        total waytotal.
+    """
+    matrices, seed_coords, target_coords, waytotal = [], [], None, 0.0
+    for directory in shard_dirs:
+        coords = read_coords(os.path.join(directory, SEED_COORDS_FILE))
+        targets = read_coords(os.path.join(directory, TARGET_COORDS_FILE))
+        if target_coords is None:
+            target_coords = targets
+        elif not np.array_equal(targets, target_coords):
+            raise ValueError(f"Shard {directory} was run with a different target mask.")
+        matrices.append(read_matrix(directory, (len(coords), len(targets))))
+        seed_coords.append(coords)
+        waytotal_file = os.path.join(directory, "waytotal")
+        if os.path.exists(waytotal_file):
+            waytotal += float(np.loadtxt(waytotal_file).sum())
+    seed_coords = np.concatenate(seed_coords)
+    order = probtrackx_order(seed_coords)
+    merged = sparse.vstack(matrices, format="csr")[order]
+    return merged, seed_coords[order], target_coords, waytotal
+
+
+def write_coords(path, coords):
+    """
+    Writes voxel coordinates in the layout of the probtrackx coordinate files.
+    Args:
+        path (str): Output path.
+        coords (np.ndarray): (n, 3) voxel coordinates.
+    """
+    rows = np.column_stack((coords, np.zeros(len(coords), dtype=np.int64), np.arange(1, len(coords) + 1)))
+    np.savetxt(path, rows, fmt="%d")
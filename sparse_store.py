@@ -0,0 +1,250 @@
+import json
+import os
+import sys
+import numpy as np
+import scipy.sparse as sparse
+from pathlib import Path
+
+"""
+Memory-mappable on-disk layout for CSR connectivity matrices.
+
+`sparse.save_npz` zip-compresses the arrays, so every reader has to inflate the whole
+matrix before using any of it. This layout stores a CSR matrix as a directory holding
+a small JSON header and the uncompressed `indptr`, `indices` and `data` arrays as `.npy`
+files:
+
+    fdt_matrix2_csr/
+        header.json    {"format": "csr", "version": 1, "shape": [...], "nnz": ..., ...}
+        indptr.npy
+        indices.npy
+        data.npy
+
+Loading maps the arrays with `mmap_mode`, so opening the matrix costs no I/O and a slice
+of seed rows only reads the pages holding those rows.
+
+Usage: python sparse_store.py <fdt_matrix2.npz> [...] converts existing NPZ matrices.
+"""
+
+HEADER_FILE = 'header.json'
+ARRAY_FILES = ('indptr.npy', 'indices.npy', 'data.npy')
+FORMAT_VERSION = 1
+
+
+def store_files(path):
+    """
+    Lists the files making up a stored matrix.
+
+    Args:
+        path (Path): Directory of the stored matrix.
+
+    Returns:
+        list: Paths of the header and the array files.
+    """
+    path = Path(path)
+    return [path / HEADER_FILE] + [path / name for name in ARRAY_FILES]
+
+
+def save_csr(path, mat):
+    """
+    Saves a sparse matrix in the memory-mappable CSR layout.
+
+    Args:
+        path (Path): Directory to write the matrix to.
+        mat (sparse matrix): Matrix to save.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    mat = sparse.csr_matrix(mat)
+    mat.sort_indices()
+    for name, array in zip(ARRAY_FILES, (mat.indptr, mat.indices, mat.data)):
+        np.save(path / name, array)
+    _write_header(path, mat.shape, mat.nnz, mat.dtype)
+
+
+def _write_header(path, shape, nnz, dtype):
+    """
+    Atomically writes the header of a stored matrix. It is written after the arrays, so
+    that a complete header means a complete matrix.
+    """
+    header = {
+        'format': 'csr',
+        'version': FORMAT_VERSION,
+        'shape': [int(n) for n in shape],
+        'nnz': int(nnz),
+        'dtype': np.dtype(dtype).str,
+    }
+    tmp_header = path / (HEADER_FILE + '.tmp')
+    with open(tmp_header, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_header, path / HEADER_FILE)
+
+
+class CSRWriter:
+    """
+    Writes a CSR matrix in the memory-mappable layout one block of rows at a time, so
+    that the matrix never has to be held in memory as a whole.
+
+    Args:
+        path (Path): Directory to write the matrix to.
+        n_cols (int): Number of columns.
+        dtype (np.dtype): Data type of the values.
+    """
+
+    _COPY_ITEMS = 1 << 22
+
+    def __init__(self, path, n_cols, dtype=np.float64):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.n_cols = n_cols
+        self.dtype = np.dtype(dtype)
+        self.row_nnz = []
+        self.nnz = 0
+        self._indices = open(self.path / 'indices.part', 'wb')
+        self._data = open(self.path / 'data.part', 'wb')
+
+    def append(self, block):
+        """
+        Appends rows to the matrix.
+
+        Args:
+            block (sparse matrix): Rows to append, with `n_cols` columns.
+        """
+        block = sparse.csr_matrix(block)
+        block.sort_indices()
+        self.row_nnz.append(np.diff(block.indptr))
+        self._indices.write(block.indices.astype(np.int32, copy=False).tobytes())
+        self._data.write(block.data.astype(self.dtype, copy=False).tobytes())
+        self.nnz += block.nnz
+
+    def close(self):
+        """
+        Finalises the `.npy` files and the header.
+
+        Returns:
+            LazyCSR: The written matrix.
+        """
+        self._indices.close()
+        self._data.close()
+        row_nnz = np.concatenate(self.row_nnz) if self.row_nnz else np.zeros(0, dtype=np.int64)
+        indptr = np.zeros(row_nnz.size + 1, dtype=np.int64)
+        np.cumsum(row_nnz, out=indptr[1:])
+        np.save(self.path / 'indptr.npy', indptr)
+        for name, dtype in (('indices', np.int32), ('data', self.dtype)):
+            part = self.path / f'{name}.part'
+            out = np.lib.format.open_memmap(self.path / f'{name}.npy', mode='w+', dtype=dtype, shape=(self.nnz,))
+            with open(part, 'rb') as f:
+                for start in range(0, self.nnz, self._COPY_ITEMS):
+                    count = min(self._COPY_ITEMS, self.nnz - start)
+                    out[start:start + count] = np.fromfile(f, dtype=dtype, count=count)
+            out.flush()
+            del out
+            os.remove(part)
+        _write_header(self.path, (row_nnz.size, self.n_cols), self.nnz, self.dtype)
+        return LazyCSR(self.path)
+
+
+class LazyCSR:
+    """
+    Read-only CSR matrix whose arrays stay on disk until they are touched.
+
+    Args:
+        path (Path): Directory of the stored matrix.
+        mmap_mode (str): Passed to `np.load`; None reads the arrays into memory.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = Path(path)
+        with open(self.path / HEADER_FILE) as f:
+            self.header = json.load(f)
+        if self.header.get('format') != 'csr' or self.header.get('version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported sparse store header in {self.path}: {self.header}")
+        self.shape = tuple(self.header['shape'])
+        self.nnz = self.header['nnz']
+        self.dtype = np.dtype(self.header['dtype'])
+        self.indptr, self.indices, self.data = (
+            np.load(self.path / name, mmap_mode=mmap_mode) for name in ARRAY_FILES
+        )
+
+    def rows(self, start, stop):
+        """
+        Reads a contiguous block of rows.
+
+        Args:
+            start (int): First row.
+            stop (int): Row after the last one.
+
+        Returns:
+            scipy.sparse.csr_matrix: The rows, as an in-memory matrix.
+        """
+        stop = min(stop, self.shape[0])
+        indptr = np.array(self.indptr[start:stop + 1])
+        begin, end = indptr[0], indptr[-1]
+        return sparse.csr_matrix(
+            (np.array(self.data[begin:end]), np.array(self.indices[begin:end]), indptr - begin),
+            shape=(stop - start, self.shape[1]),
+        )
+
+    def to_csr(self):
+        """
+        Wraps the (memory-mapped) arrays in a scipy CSR matrix without copying them.
+
+        Returns:
+            scipy.sparse.csr_matrix: The full matrix.
+        """
+        return sparse.csr_matrix((self.data, self.indices, self.indptr), shape=self.shape, copy=False)
+
+    def dot(self, other):
+        """
+        Multiplies the matrix by another matrix.
+
+        Args:
+            other (sparse matrix or np.ndarray): Right-hand operand.
+
+        Returns:
+            Product of the two matrices.
+        """
+        return self.to_csr().dot(other)
+
+
+def load_csr(path, mmap_mode='r'):
+    """
+    Opens a matrix saved with `save_csr`.
+
+    Args:
+        path (Path): Directory of the stored matrix.
+        mmap_mode (str): Passed to `np.load`; None reads the arrays into memory.
+
+    Returns:
+        LazyCSR: The matrix.
+    """
+    return LazyCSR(path, mmap_mode)
+
+
+def convert_npz(npz_file, out_path=None):
+    """
+    Converts a matrix saved with `sparse.save_npz` to the memory-mappable layout.
+
+    Args:
+        npz_file (Path): Path to the `.npz` file.
+        out_path (Path): Output directory; defaults to `<name>_csr` next to the NPZ file.
+
+    Returns:
+        Path: Directory of the converted matrix.
+    """
+    npz_file = Path(npz_file)
+    out_path = Path(out_path) if out_path else npz_file.with_name(npz_file.stem + '_csr')
+    save_csr(out_path, sparse.load_npz(npz_file))
+    print(f"Converted {npz_file} -> {out_path}")
+    return out_path
+
+
+def main():
+    """
+    Converts the NPZ matrices given on the command line.
+    """
+    for npz_file in sys.argv[1:]:
+        convert_npz(npz_file)
+
+
+if __name__ == "__main__":
+    main()
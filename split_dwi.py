@@ -0,0 +1,135 @@
+import gzip
+import os
+import time
+import numpy as np
+import nibabel as nib
+from volume_cache import load_volume
+
+"""
+Splits the diffusion data into the voxel parts that xfibres_gpu fits, in one streaming
+pass over data.nii.gz.
+
+bedpostx_gpu_local.sh needs an uncompressed data.nii next to data.nii.gz (an extra copy
+the size of the whole 4D volume), and split_parts_gpu then reads that volume in full
+before writing the parts. Here the compressed file is decoded sequentially, one volume
+at a time. The voxels inside nodif_brain_mask are gathered from each volume and appended
+to the part files, so only one volume is held in memory and nothing but the parts is
+written.
+
+The parts follow split_parts_gpu: the nvox mask voxels, taken in FSL order (x fastest),
+are split into njobs runs of nvox // njobs voxels, the last one taking the remainder.
+Part k is written to <bedpostX dir>/data_k as the raw float64 (NEWMAT Real) matrix of
+nmeas rows (one per volume) by the part's voxels, row-major and without a header, which
+is what xfibres_gpu reads with --data. Intensities are scaled by the header's scl_slope
+and scl_inter, as FSL does when it reads the volume.
+"""
+
+# Bytes read from the (compressed) data file at a time
+READ_BYTES = 16 * 1024 * 1024
+
+
+def part_sizes(nvox, njobs):
+    """
+    Returns the number of voxels of every part, as split_parts_gpu splits them.
+    Args:
+        nvox (int): Number of voxels in the brain mask.
+        njobs (int): Number of parts.
+    Returns:
+        list: Voxels per part.
+    """
+    size = nvox // njobs
+    if size == 0:
+        raise ValueError(f"Cannot split {nvox} voxels into {njobs} parts.")
+    return [size] * (njobs - 1) + [nvox - size * (njobs - 1)]
+
+
+def part_path(out_dir, part):
+    """
+    Returns the path of a part file, as passed to xfibres_gpu with --data.
+    """
+    return os.path.join(out_dir, f"data_{part}")
+
+
+def iter_volumes(path):
+    """
+    Streams the volumes of a 4D NIfTI file, compressed or not, in order.
+    Args:
+        path (str): Path to the NIfTI file.
+    Yields:
+        np.ndarray: Each volume, flattened in FSL order (x fastest), scaled to float64.
+    """
+    proxy = nib.load(path).dataobj
+    shape, dtype, offset = proxy.shape, proxy.dtype, proxy.offset
+    slope, inter = float(proxy.slope), float(proxy.inter)
+    volume_bytes = int(np.prod(shape[:3])) * dtype.itemsize
+    n_volumes = int(np.prod(shape[3:])) if len(shape) > 3 else 1
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "rb") as f:
+        f.read(offset)
+        for _ in range(n_volumes):
+            buffer = bytearray(volume_bytes)
+            view, filled = memoryview(buffer), 0
+            while filled < volume_bytes:
+                count = f.readinto(view[filled:filled + READ_BYTES])
+                if not count:
+                    raise ValueError(f"{path} ends before its last volume.")
+                filled += count
+            yield np.frombuffer(buffer, dtype=dtype).astype(np.float64) * slope + inter
+
+
+def split_parts(data_path, mask_path, njobs, out_dir):
+    """
+    Writes the xfibres_gpu parts of a diffusion volume in one pass over the data.
+    Args:
+        data_path (str): Path to data.nii.gz (or data.nii).
+        mask_path (str): Path to nodif_brain_mask.nii.gz.
+        njobs (int): Number of parts.
+        out_dir (str): bedpostX directory receiving data_0 ... data_<njobs-1>.
+    Returns:
+        dict: Voxels and volumes split, seconds, bytes written, and the bytes the FSL
+        path writes (the uncompressed data.nii plus the same parts).
+    """
+    start = time.perf_counter()
+    mask = np.asanyarray(load_volume(mask_path).dataobj).ravel(order="F") != 0
+    voxels = np.flatnonzero(mask)
+    sizes = part_sizes(voxels.size, njobs)
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+    files = [open(part_path(out_dir, part) + ".tmp", "wb") for part in range(njobs)]
+    n_volumes = 0
+    try:
+        for volume in iter_volumes(data_path):
+            if volume.size != mask.size:
+                raise ValueError(f"{data_path} and {mask_path} have different grids.")
+            gathered = volume[voxels]
+            for part, f in enumerate(files):
+                f.write(gathered[bounds[part]:bounds[part + 1]].tobytes())
+            n_volumes += 1
+    finally:
+        for f in files:
+            f.close()
+    for part in range(njobs):
+        os.replace(part_path(out_dir, part) + ".tmp", part_path(out_dir, part))
+
+    written = sum(os.path.getsize(part_path(out_dir, part)) for part in range(njobs))
+    proxy = nib.load(data_path).dataobj
+    uncompressed = proxy.offset + int(np.prod(proxy.shape)) * proxy.dtype.itemsize
+    return {
+        "nvox": int(voxels.size),
+        "nmeas": n_volumes,
+        "seconds": time.perf_counter() - start,
+        "written_bytes": written,
+        "fsl_written_bytes": uncompressed + written,
+    }
+
+
+def read_part(path, nmeas):
+    """
+    Reads a part file back.
+    Args:
+        path (str): Path to the part file.
+        nmeas (int): Number of volumes.
+    Returns:
+        np.ndarray: (nmeas, voxels) matrix.
+    """
+    data = np.fromfile(path, dtype=np.float64)
+    return data.reshape(nmeas, -1)
@@ -0,0 +1,277 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import nibabel as nib
+from pipeline_state import file_digest
+
+"""
+Persistent cache of decoded NIfTI volumes shared by all pipeline stages.
+
+The same gzipped volumes (wmparc, the T1, LowResMask, the seed masks) are read by several
+stages and scripts, each paying for the decompression again. `load_volume` decodes a file
+once and keeps its array as a `.npy` file and its header as raw bytes in CACHE_DIRECTORY;
+every later read, from any process, memory-maps the array instead of inflating the file.
+
+Entries are stored by the SHA-256 of the source file, so a copy of a file, or a file that
+was rewritten with the same content, reuses the entry. A small alias keyed by the file's
+real path, size and mtime points to the entry, so that an unchanged file is not even
+hashed again. Entries are written to a temporary directory and renamed into place, which
+makes concurrent readers and writers safe. Every hit refreshes an entry's last-use time,
+and whenever an entry is added the least recently used ones are evicted until the cache
+fits in CACHE_LIMIT_MB.
+
+`save_volume` writes the intermediate volumes of the pipeline at the gzip level of
+OUTPUT_COMPRESSION, and adds them to the cache straight away. 'none' writes stored
+(level 0) gzip streams, which keep the `.nii.gz` names that FSL and the stage records
+expect but cost no compression time.
+
+    python volume_cache.py stats      # entries and size
+    python volume_cache.py clear      # remove every entry
+"""
+
+# Cache location; override with the VOLUME_CACHE_DIR environment variable
+CACHE_DIRECTORY = os.environ.get("VOLUME_CACHE_DIR",
+                                 os.path.join(os.path.expanduser("~"), ".cache", "fiber_pipeline", "volumes"))
+
+# Size limit of the cache in MB; 0 disables it. Override with VOLUME_CACHE_MB.
+CACHE_LIMIT_MB = int(os.environ.get("VOLUME_CACHE_MB", "20480"))
+
+# gzip level of intermediate outputs: 'default' (6, like FSL), 'fast' (1) or 'none' (0,
+# stored). Override with VOLUME_OUTPUT_COMPRESSION.
+OUTPUT_COMPRESSION = os.environ.get("VOLUME_OUTPUT_COMPRESSION", "default")
+COMPRESSION_LEVELS = {"default": 6, "fast": 1, "none": 0}
+
+# Image classes whose header can be stored as its binary block
+IMAGE_CLASSES = {"Nifti1Image": nib.Nifti1Image, "Nifti2Image": nib.Nifti2Image}
+
+
+def _entries_dir(cache_dir):
+    return os.path.join(cache_dir, "entries")
+
+
+def _aliases_dir(cache_dir):
+    return os.path.join(cache_dir, "aliases")
+
+
+def _alias_key(path, stat):
+    """
+    Hashes a file's real path, size and mtime into the name of its alias.
+    """
+    return hashlib.sha256(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}".encode()).hexdigest()
+
+
+def _open_entry(entry_dir):
+    """
+    Opens a cached volume, with its array memory-mapped read-only.
+    Args:
+        entry_dir (str): Directory of the entry.
+    Returns:
+        nib.Nifti1Image: The volume.
+    """
+    with open(os.path.join(entry_dir, "meta.json")) as f:
+        meta = json.load(f)
+    image_class = IMAGE_CLASSES[meta["class"]]
+    with open(os.path.join(entry_dir, "header.bin"), "rb") as f:
+        header = image_class.header_class(binaryblock=f.read())
+    data = np.load(os.path.join(entry_dir, "data.npy"), mmap_mode="r")
+    return image_class(data, header.get_best_affine(), header)
+
+
+def _store(cache_dir, digest, img, data, limit_mb=CACHE_LIMIT_MB):
+    """
+    Adds a decoded volume to the cache under its content hash.
+    Args:
+        cache_dir (str): Cache directory.
+        digest (str): SHA-256 of the source file.
+        img (nib.Nifti1Image): Source image, providing the header.
+        data (np.ndarray): Decoded array.
+        limit_mb (int): Cache size limit in MB.
+    Returns:
+        str: Directory of the entry.
+    """
+    entry_dir = os.path.join(_entries_dir(cache_dir), digest)
+    if os.path.isdir(entry_dir):
+        return entry_dir
+    os.makedirs(_entries_dir(cache_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=_entries_dir(cache_dir), prefix=".tmp-")
+    try:
+        np.save(os.path.join(tmp_dir, "data.npy"), np.asarray(data))
+        with open(os.path.join(tmp_dir, "header.bin"), "wb") as f:
+            f.write(img.header.binaryblock)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"class": type(img).__name__, "shape": list(data.shape), "dtype": str(data.dtype)}, f)
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isdir(entry_dir):
+            raise
+    evict(cache_dir, limit_mb)
+    return entry_dir
+
+
+def _write_alias(cache_dir, key, digest):
+    """
+    Atomically points an alias at an entry.
+    """
+    os.makedirs(_aliases_dir(cache_dir), exist_ok=True)
+    alias = os.path.join(_aliases_dir(cache_dir), key)
+    tmp_alias = f"{alias}.{os.getpid()}.tmp"
+    with open(tmp_alias, "w") as f:
+        f.write(digest)
+    os.replace(tmp_alias, alias)
+
+
+def _read_alias(cache_dir, key):
+    try:
+        with open(os.path.join(_aliases_dir(cache_dir), key)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def load_volume(path, cache_dir=CACHE_DIRECTORY, limit_mb=CACHE_LIMIT_MB):
+    """
+    Loads a NIfTI volume through the cache. The returned image holds the decoded (scaled)
+    array, memory-mapped read-only, in place of nibabel's array proxy.
+    Args:
+        path (str): Path to the NIfTI file.
+        cache_dir (str): Cache directory.
+        limit_mb (int): Cache size limit in MB; 0 loads the file directly.
+    Returns:
+        nib.Nifti1Image: The volume.
+    """
+    if limit_mb <= 0:
+        return nib.load(path)
+    path = os.path.realpath(path)
+    key = _alias_key(path, os.stat(path))
+    digest = _read_alias(cache_dir, key)
+    if digest is None or not os.path.isdir(os.path.join(_entries_dir(cache_dir), digest)):
+        digest = file_digest(path)
+        entry_dir = os.path.join(_entries_dir(cache_dir), digest)
+        if not os.path.isdir(entry_dir):
+            img = nib.load(path)
+            if type(img).__name__ not in IMAGE_CLASSES:
+                return img
+            _store(cache_dir, digest, img, np.asanyarray(img.dataobj), limit_mb)
+        _write_alias(cache_dir, key, digest)
+    entry_dir = os.path.join(_entries_dir(cache_dir), digest)
+    try:
+        # The mtime of the array file records the entry's last use
+        os.utime(os.path.join(entry_dir, "data.npy"))
+        return _open_entry(entry_dir)
+    except (OSError, ValueError):
+        # Evicted by another process in the meantime
+        return nib.load(path)
+
+
+def save_volume(img, path, compression=OUTPUT_COMPRESSION, cache_dir=CACHE_DIRECTORY, limit_mb=CACHE_LIMIT_MB):
+    """
+    Saves a NIfTI volume, gzipped at the level of `compression` when the path ends in
+    `.gz`, and adds it to the cache.
+    Args:
+        img (nib.Nifti1Image): Volume to save.
+        path (str): Output path.
+        compression (str): 'default', 'fast' or 'none'.
+        cache_dir (str): Cache directory.
+        limit_mb (int): Cache size limit in MB; 0 only saves the file.
+    """
+    if compression not in COMPRESSION_LEVELS:
+        raise ValueError(f"Unknown compression {compression!r}; expected one of {tuple(COMPRESSION_LEVELS)}.")
+    serialized = img.to_bytes()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if str(path).endswith(".gz"):
+        # The header names the final file, not the temporary one, so that identical volumes
+        # give identical bytes
+        with open(tmp_path, "wb") as raw, gzip.GzipFile(filename=os.path.basename(str(path)), mode="wb", fileobj=raw,
+                                                      compresslevel=COMPRESSION_LEVELS[compression], mtime=0) as f:
+            f.write(serialized)
+    else:
+        with open(tmp_path, "wb") as f:
+            f.write(serialized)
+    os.replace(tmp_path, path)
+    if limit_mb > 0 and type(img).__name__ in IMAGE_CLASSES:
+        # Cache what a reader of the file would decode: the array scaled and cast by the header
+        saved = img.__class__.from_bytes(serialized)
+        digest = file_digest(path)
+        _store(cache_dir, digest, saved, np.asanyarray(saved.dataobj), limit_mb)
+        _write_alias(cache_dir, _alias_key(os.path.realpath(path), os.stat(path)), digest)
+
+
+def cache_entries(cache_dir=CACHE_DIRECTORY):
+    """
+    Lists the cache entries.
+    Args:
+        cache_dir (str): Cache directory.
+    Returns:
+        list: (last use, size in bytes, directory) of every entry, least recently used first.
+    """
+    entries = []
+    if not os.path.isdir(_entries_dir(cache_dir)):
+        return entries
+    for name in os.listdir(_entries_dir(cache_dir)):
+        entry_dir = os.path.join(_entries_dir(cache_dir), name)
+        if name.startswith(".tmp-"):
+            continue
+        try:
+            files = [os.stat(os.path.join(entry_dir, file)) for file in os.listdir(entry_dir)]
+            last_use = os.stat(os.path.join(entry_dir, "data.npy")).st_mtime
+        except OSError:
+            continue
+        entries.append((last_use, sum(stat.st_size for stat in files), entry_dir))
+    return sorted(entries)
+
+
+def evict(cache_dir=CACHE_DIRECTORY, limit_mb=CACHE_LIMIT_MB):
+    """
+    Removes the least recently used entries until the cache fits in its size limit, and
+    the aliases left pointing at removed entries.
+    Args:
+        cache_dir (str): Cache directory.
+        limit_mb (int): Cache size limit in MB.
+    Returns:
+        int: Number of entries removed.
+    """
+    entries = cache_entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, entry_dir in entries:
+        if total <= limit_mb * 1024 * 1024:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        removed += 1
+    if removed and os.path.isdir(_aliases_dir(cache_dir)):
+        for key in os.listdir(_aliases_dir(cache_dir)):
+            digest = _read_alias(cache_dir, key)
+            if digest and not os.path.isdir(os.path.join(_entries_dir(cache_dir), digest)):
+                try:
+                    os.remove(os.path.join(_aliases_dir(cache_dir), key))
+                except OSError:
+                    pass
+    return removed
+
+
+def main():
+    """
+    Prints the size of the cache, or clears it.
+    """
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "clear":
+        shutil.rmtree(CACHE_DIRECTORY, ignore_errors=True)
+        print(f"Cleared {CACHE_DIRECTORY}")
+    elif command == "stats":
+        entries = cache_entries()
+        size_mb = sum(size for _, size, _ in entries) / 1024 / 1024
+        print(f"{CACHE_DIRECTORY}: {len(entries)} entries, {size_mb:.1f} of {CACHE_LIMIT_MB} MB")
+    else:
+        print("Usage: python volume_cache.py [stats|clear]")
+
+
+if __name__ == "__main__":
+    main()
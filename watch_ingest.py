@@ -0,0 +1,237 @@
+import argparse
+import os
+import time
+import cohort_scheduler
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+"""
+Watches the data directory and runs the pipeline on each subject as soon as its inputs
+have been written, instead of re-running the stage scripts over the whole cohort.
+
+A subject is a folder directly under the data directory. It is queued once all of
+REQUIRED_INPUTS exist and have been fully written: their sizes and modification times
+have not changed for SETTLE_SECONDS, or were already older than that when first seen
+(subjects present when the daemon starts, copies made with preserved times). The queued
+subjects are fed to cohort_scheduler.run_cohort, which runs their stages with the same
+dependency tracking and memory-aware admission as a batch run. Each stage keeps its own
+up-to-date check, so subjects that were processed before only cost their checks.
+
+New folders and files are detected with inotify through the optional inotify_simple
+package, which watches the data directory, each pending subject and its DTI and T1
+folders, and drops a subject's watches once it is queued. Without inotify_simple, where
+inotify is unavailable, or with --poll (network filesystems such as NFS do not report
+writes made by other hosts), the pending subjects are re-scanned every POLL_SECONDS.
+A subject is queued once per daemon run; a failed subject is retried by restarting it.
+
+    python watch_ingest.py --data-directory /path/to/dataset --cpu-workers 16 --gpus 0,1
+"""
+
+# Define the root data directory
+DATA_DIRECTORY = "/home/test/lmq/data/HCP"
+
+# Files a subject needs before its stages can run, relative to its folder
+REQUIRED_INPUTS = (
+    os.path.join("DTI", "data.nii.gz"),
+    os.path.join("DTI", "bvals"),
+    os.path.join("DTI", "bvecs"),
+    os.path.join("DTI", "nodif_brain_mask.nii.gz"),
+    os.path.join("T1", "T1w_acpc_dc_restore_brain.nii.gz"),
+    os.path.join("T1", "wmparc.nii.gz"),
+)
+
+# Seconds the required inputs must stay unchanged before a subject is queued; override
+# with WATCH_SETTLE_SECONDS
+SETTLE_SECONDS = float(os.environ.get("WATCH_SETTLE_SECONDS", "30"))
+
+# Seconds between scans of the pending subjects; override with WATCH_POLL_SECONDS
+POLL_SECONDS = float(os.environ.get("WATCH_POLL_SECONDS", "10"))
+
+
+def input_signature(subject_path):
+    """
+    Returns the sizes and modification times of a subject's required inputs.
+    Args:
+        subject_path (str): Path to the subject's folder.
+    Returns:
+        tuple: (size, mtime) of every input, or None if one is missing.
+    """
+    signature = []
+    for name in REQUIRED_INPUTS:
+        try:
+            stat = os.stat(os.path.join(subject_path, name))
+        except OSError:
+            return None
+        signature.append((stat.st_size, stat.st_mtime))
+    return tuple(signature)
+
+
+class SubjectWatcher:
+    """
+    Reports the subjects of a data directory whose required inputs are complete, each once.
+    """
+
+    def __init__(self, data_directory, settle_seconds=SETTLE_SECONDS, poll_seconds=POLL_SECONDS, poll=False):
+        """
+        Args:
+            data_directory (str): The root directory containing all subject data.
+            settle_seconds (float): Seconds the inputs must stay unchanged.
+            poll_seconds (float): Seconds between scans of the pending subjects.
+            poll (bool): Scan periodically even where inotify is available.
+        """
+        self.data_directory = data_directory
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        self.queued = set()
+        # Subject -> (input signature, time it was first seen)
+        self.pending = {}
+        # Subjects to re-check at the next scan; every subject when polling
+        self.dirty = set()
+        self.scanned = time.monotonic()
+        self.inotify, self.watches, self.subject_watches = None, {}, {}
+        if not poll and inotify_simple is not None:
+            try:
+                self.inotify = inotify_simple.INotify()
+                self._watch(data_directory, None)
+            except OSError as e:
+                print(f"inotify unavailable ({e}), polling every {poll_seconds:.0f}s")
+                self.inotify = None
+        for subject_dir in self._subjects():
+            self._watch_subject(subject_dir)
+
+    def _subjects(self):
+        return [d for d in os.listdir(self.data_directory)
+                if not d.startswith('.') and d not in self.queued and
+                os.path.isdir(os.path.join(self.data_directory, d))]
+
+    def _watch(self, path, subject_dir):
+        flags = inotify_simple.flags
+        if subject_dir is None:
+            mask = flags.CREATE | flags.MOVED_TO
+        else:
+            mask = flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE | flags.ATTRIB
+        wd = self.inotify.add_watch(path, mask)
+        self.watches[wd] = subject_dir
+        if subject_dir is not None:
+            self.subject_watches.setdefault(subject_dir, set()).add(wd)
+
+    def _watch_subject(self, subject_dir):
+        # Files written before a watch was added are caught by the check that follows
+        self.dirty.add(subject_dir)
+        if self.inotify is None:
+            return
+        subject_path = os.path.join(self.data_directory, subject_dir)
+        try:
+            if not self.subject_watches.get(subject_dir):
+                self._watch(subject_path, subject_dir)
+            for folder in ("DTI", "T1"):
+                if os.path.isdir(os.path.join(subject_path, folder)):
+                    self._watch(os.path.join(subject_path, folder), subject_dir)
+        except OSError as e:
+            # Removed meanwhile, or out of watches (fs.inotify.max_user_watches)
+            print(f"Cannot watch {subject_path}: {e}")
+
+    def _unwatch_subject(self, subject_dir):
+        for wd in self.subject_watches.pop(subject_dir, ()):
+            self.watches.pop(wd, None)
+            try:
+                self.inotify.rm_watch(wd)
+            except OSError:
+                pass
+
+    def _wait(self, timeout):
+        # A timeout of 0 only collects what changed since the last call, without blocking
+        if self.inotify is None:
+            time.sleep(timeout)
+            if time.monotonic() - self.scanned >= self.poll_seconds:
+                self.scanned = time.monotonic()
+                self.dirty.update(self._subjects())
+            return
+        flags = inotify_simple.flags
+        for event in self.inotify.read(timeout=int(timeout * 1000), read_delay=100 if timeout else None):
+            if event.mask & flags.Q_OVERFLOW:
+                for subject_dir in self._subjects():
+                    self._watch_subject(subject_dir)
+                continue
+            if event.wd not in self.watches:
+                continue
+            subject_dir = self.watches[event.wd]
+            if subject_dir is None:
+                if event.mask & flags.ISDIR and not event.name.startswith('.'):
+                    self._watch_subject(event.name)
+            elif subject_dir not in self.queued:
+                if event.mask & flags.ISDIR and event.name in ("DTI", "T1"):
+                    self._watch_subject(subject_dir)
+                self.dirty.add(subject_dir)
+
+    def _check(self):
+        now = time.time()
+        ready = []
+        for subject_dir in sorted(self.dirty | set(self.pending)):
+            signature = input_signature(os.path.join(self.data_directory, subject_dir))
+            if signature is None:
+                self.pending.pop(subject_dir, None)
+                continue
+            previous = self.pending.get(subject_dir)
+            if previous is None or previous[0] != signature:
+                self.pending[subject_dir] = previous = (signature, now)
+            newest = max(mtime for _, mtime in signature)
+            if now - previous[1] >= self.settle_seconds or now - newest >= self.settle_seconds:
+                del self.pending[subject_dir]
+                self.queued.add(subject_dir)
+                if self.inotify is not None:
+                    self._unwatch_subject(subject_dir)
+                ready.append(subject_dir)
+        self.dirty.clear()
+        return ready
+
+    def ready(self, timeout=0):
+        """
+        Returns the subjects that became complete, waiting up to a timeout for one.
+        Args:
+            timeout (float): Seconds to wait when none is complete yet.
+        Returns:
+            list: Subject directory names, each returned once.
+        """
+        deadline = time.monotonic() + timeout
+        self._wait(0)
+        while True:
+            subjects = self._check()
+            remaining = deadline - time.monotonic()
+            if subjects or remaining <= 0:
+                return subjects
+            # Pending subjects are re-checked once they may have settled, without an event
+            self._wait(min(remaining, self.poll_seconds) if self.pending or self.inotify is None else remaining)
+
+
+def main():
+    """
+    Main function to watch the data directory and process subjects as they arrive.
+    """
+    parser = argparse.ArgumentParser(description="Watch the data directory and run the pipeline on new subjects.")
+    parser.add_argument("--data-directory", default=DATA_DIRECTORY)
+    parser.add_argument("--cpu-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--gpus", default="0", help="Comma-separated CUDA device ids, one GPU slot each.")
+    parser.add_argument("--memory-mb", type=float, default=cohort_scheduler.MEMORY_BUDGET_MB or None,
+                        help="Host memory budget; defaults to MEMORY_FRACTION of the machine's memory.")
+    parser.add_argument("--gpu-memory-mb", type=float, default=cohort_scheduler.GPU_MEMORY_MB,
+                        help="Memory budget of each GPU; 0 limits GPU jobs by slots only.")
+    parser.add_argument("--settle-seconds", type=float, default=SETTLE_SECONDS)
+    parser.add_argument("--poll-seconds", type=float, default=POLL_SECONDS)
+    parser.add_argument("--poll", action="store_true", help="Scan periodically instead of using inotify.")
+    args = parser.parse_args()
+
+    watcher = SubjectWatcher(args.data_directory, args.settle_seconds, args.poll_seconds, args.poll)
+    print(f"Watching {args.data_directory} ({'polling' if watcher.inotify is None else 'inotify'})")
+    try:
+        cohort_scheduler.run_cohort(args.data_directory, args.cpu_workers, [int(gpu) for gpu in args.gpus.split(",")],
+                                    args.memory_mb, args.gpu_memory_mb, watcher=watcher)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+
+if __name__ == "__main__":
+    main()